@@ -1,39 +1,111 @@
 from base64 import b64encode
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import logging
+import time
+import uuid
 
 from django import forms
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.validators import validate_email
+from django.db.models.signals import post_delete, post_save
+from django.utils.translation import gettext_lazy as _
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
 from rest_framework.exceptions import AuthenticationFailed
 
+from auth_token.models import UserProfile
+import backend_timing
 from cyclos_api import CyclosAPI, CyclosAPIException
 from dolibarr_api import DolibarrAPI, DolibarrAPIException
+from service_sessions import anonymous_dolibarr
 
 
 log = logging.getLogger(__name__)
 
 
-def authenticate(username, password):
-    user = None
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Same as TokenAuthentication, but the token, the user and its profile (where the Dolibarr and Cyclos tokens are)
+    are loaded with a single query, and kept in the Django cache for TOKEN_AUTH_CACHE_TTL seconds.
+
+    Each cached entry carries the version of its user. The version changes when the user or its profile is saved
+    (after a login or a Cyclos token refresh): the entries of the user are then reloaded by all the processes, as long
+    as they share the cache (CACHE_BACKEND).
+    """
+
+    def authenticate_credentials(self, key):
+        entry_key = _entry_key(key)
+        entry = cache.get(entry_key)
+        if entry is not None:
+            user, token, version = entry
+            if version == cache.get(_version_key(user.pk)):
+                return user, token
+
+        model = self.get_model()
+        try:
+            token = model.objects.select_related('user', 'user__profile').get(key=key)
+        except model.DoesNotExist:
+            raise AuthenticationFailed(_('Invalid token.'))
+
+        if not token.user.is_active:
+            raise AuthenticationFailed(_('User inactive or deleted.'))
+
+        # The version is read after the user: if the profile has been saved in between, the entry will be reloaded.
+        cache.set(entry_key, (token.user, token, _user_version(token.user.pk)), settings.TOKEN_AUTH_CACHE_TTL)
+        return token.user, token
+
+
+def _entry_key(key):
+    # We don't want to store the token itself in the cache keys.
+    return 'auth_token_{}'.format(hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+
+def _version_key(user_id):
+    return 'auth_token_version_{}'.format(user_id)
+
+
+def _user_version(user_id):
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        # A new random version, so that entries cached before the version was evicted from the cache don't match it.
+        cache.add(_version_key(user_id), uuid.uuid4().hex, None)
+        version = cache.get(_version_key(user_id))
+    return version
 
-    username = get_username_from_username_or_email(username)
-    if not username:
-        raise AuthenticationFailed()
 
+def _user_saved(sender, instance, **kwargs):
+    cache.set(_version_key(instance.pk), uuid.uuid4().hex, None)
+
+
+def _user_profile_saved(sender, instance, **kwargs):
+    cache.set(_version_key(instance.user_id), uuid.uuid4().hex, None)
+
+
+def _token_deleted(sender, instance, **kwargs):
+    cache.delete(_entry_key(instance.key))
+
+
+post_save.connect(_user_saved, sender=User)
+post_save.connect(_user_profile_saved, sender=UserProfile)
+post_delete.connect(_token_deleted, sender=Token)
+
+
+def _dolibarr_login(username, password):
     try:
         dolibarr = DolibarrAPI()
-        dolibarr_token = dolibarr.login(login=username, password=password, reset=True)
+        return dolibarr, dolibarr.login(login=username, password=password, reset=True)
     except (DolibarrAPIException):
         raise AuthenticationFailed()
 
-    try:
-        cyclos = CyclosAPI(mode='login')
-        cyclos_token = cyclos.login(
-            auth_string=b64encode(bytes('{}:{}'.format(username, password), 'utf-8')).decode('ascii'))
-    except CyclosAPIException:
-        raise AuthenticationFailed()
 
+def _dolibarr_user(dolibarr, dolibarr_token, username):
+    """
+    Dolibarr: load the user and, if there is a member linked to this user, its company name.
+    Returns (dolibarr_user, companyname).
+    """
     try:
         user_results = dolibarr.get(model='users', sqlfilters="login='{}'".format(username), api_key=dolibarr_token)
         dolibarr_user = [item
@@ -42,22 +114,71 @@ def authenticate(username, password):
     except (DolibarrAPIException, KeyError, IndexError):
         raise AuthenticationFailed()
 
-    user, created = User.objects.get_or_create(username=username)
-
-    user_profile = user.profile
-    user_profile.cyclos_token = cyclos_token
-    user_profile.dolibarr_token = dolibarr_token
-
     # if there is a member linked to this user, load it in order to retrieve its company name
-    user_profile.companyname = ''
+    companyname = ''
     if dolibarr_user['fk_member']:
         try:
             member = dolibarr.get(model='members', id=dolibarr_user['fk_member'], api_key=dolibarr_token)
             if member['company']:
-                user_profile.companyname = member['company']
+                companyname = member['company']
         except DolibarrAPIException:
             pass
 
+    return dolibarr_user, companyname
+
+
+def _cyclos_login(username, password):
+    try:
+        cyclos = CyclosAPI(mode='login')
+        return cyclos.login(
+            auth_string=b64encode(bytes('{}:{}'.format(username, password), 'utf-8')).decode('ascii'))
+    except CyclosAPIException:
+        raise AuthenticationFailed()
+
+
+def _timed(timings, name, func, *args):
+    start = time.monotonic()
+    try:
+        return func(*args)
+    finally:
+        timings[name] = time.monotonic() - start
+
+
+def authenticate(username, password):
+    user = None
+    timings = {}
+    start = time.monotonic()
+
+    username = _timed(timings, 'username', get_username_from_username_or_email, username)
+    if not username:
+        raise AuthenticationFailed()
+
+    # The Cyclos login is only tried once the password has been checked by Dolibarr: each failed Cyclos login counts
+    # towards blocking the user in Cyclos. The Cyclos login and the loading of the Dolibarr user are then done at the
+    # same time.
+    timed = backend_timing.bind(_timed)
+    try:
+        dolibarr, dolibarr_token = _timed(timings, 'dolibarr', _dolibarr_login, username, password)
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            dolibarr_future = executor.submit(timed, timings, 'dolibarr_user', _dolibarr_user, dolibarr, dolibarr_token,
+                                              username)
+            cyclos_future = executor.submit(timed, timings, 'cyclos', _cyclos_login, username, password)
+            dolibarr_user, companyname = dolibarr_future.result()
+            cyclos_token = cyclos_future.result()
+    finally:
+        duration = time.monotonic() - start
+        if duration > settings.LOGIN_LATENCY_BUDGET:
+            log.warning('authenticate({}) took {:.3f}s (budget: {}s): {}'.format(
+                username, duration, settings.LOGIN_LATENCY_BUDGET,
+                ', '.join('{} {:.3f}s'.format(name, timing) for name, timing in sorted(timings.items()))))
+
+    user, created = User.objects.get_or_create(username=username)
+
+    user_profile = user.profile
+    user_profile.cyclos_token = cyclos_token
+    user_profile.dolibarr_token = dolibarr_token
+    user_profile.companyname = companyname
+
     try:
         user_profile.firstname = dolibarr_user['firstname']
         user_profile.lastname = dolibarr_user['lastname']
@@ -79,13 +200,8 @@ def get_username_from_username_or_email(username_or_email):
         # we detected that our "username_or_email" variable is an email,
         # we try to find the user that has this email (there must be exactly one)
         try:
-            dolibarr = DolibarrAPI()
-            dolibarr_anonymous_token = dolibarr.login(login=settings.APPS_ANONYMOUS_LOGIN,
-                                                      password=settings.APPS_ANONYMOUS_PASSWORD,
-                                                      reset=True)
-            user_results = dolibarr.get(model='users',
-                                        sqlfilters="email='{}'".format(username_or_email),
-                                        api_key=dolibarr_anonymous_token)
+            dolibarr = anonymous_dolibarr()
+            user_results = dolibarr.get(model='users', sqlfilters="email='{}'".format(username_or_email))
             matching_users = [item
                               for item in user_results
                               if item['email'] == username_or_email]
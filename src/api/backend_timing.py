@@ -0,0 +1,159 @@
+"""
+Per-request accounting of the calls made to the backends (Cyclos, Dolibarr, wkhtmltopdf).
+
+BackendTimingMiddleware starts a collector for each request. CyclosAPI and DolibarrAPI record each HTTP call in it,
+under the name of the called method (e.g. 'account/searchAccountHistory', 'members/id'). When the response is ready,
+the middleware adds a Server-Timing header with the count, the total time and the slowest call of each method, and
+logs the same figures as a JSON line.
+
+The collector is stored in a thread-local: code which calls the backends from other threads must wrap the function
+it runs there with bind() (misc.concurrent_map does it), so that these calls are counted for the request.
+"""
+from contextlib import contextmanager
+import json
+import logging
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+log = logging.getLogger()
+
+_local = threading.local()
+
+# Characters which are not allowed in a Server-Timing metric name.
+_NOT_TOKEN_CHARS = re.compile(r"[^A-Za-z0-9!#$%&'*+\-.^_`|~]")
+
+
+class Collector:
+    """
+    Count, total time and slowest time of the calls made for one request, by backend and method.
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def record(self, backend, name, duration):
+        with self.lock:
+            stats = self.calls.setdefault((backend, name), [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+
+    def summary(self):
+        """
+        Return the list of (backend, name, count, total, slowest), the most expensive first. Times are in seconds.
+        """
+        with self.lock:
+            calls = [(backend, name, count, total, slowest)
+                     for (backend, name), (count, total, slowest) in self.calls.items()]
+        return sorted(calls, key=lambda call: call[3], reverse=True)
+
+
+def current():
+    return getattr(_local, 'collector', None)
+
+
+def record(backend, name, duration):
+    collector = current()
+    if collector is not None:
+        collector.record(backend, name, duration)
+
+
+@contextmanager
+def timed(backend, name):
+    """
+    Record the time spent in the block as a call to the backend.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record(backend, name, time.monotonic() - start)
+
+
+def bind(func):
+    """
+    Return a function which calls func with the collector of the current thread, to run it in another thread.
+    """
+    collector = current()
+
+    def wrapper(*args, **kwargs):
+        previous = current()
+        _local.collector = collector
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.collector = previous
+    return wrapper
+
+
+def endpoint_name(base_url, url):
+    """
+    Name of the API method called with url: its path relative to base_url, without the query string, and with the
+    numeric ids replaced by 'id' (so that 'members/12' and 'members/13' are counted together).
+    """
+    path = urlsplit(url).path
+    base_path = urlsplit(base_url).path
+    if path.startswith(base_path):
+        path = path[len(base_path):]
+    # CyclosAPI.get() appends its parameters with '&' directly to the path.
+    path = path.split('&')[0]
+    return '/'.join('id' if re.match(r'^-?\d+$', part) else part for part in path.strip('/').split('/'))
+
+
+def _server_timing(summary, total):
+    metrics = ['{};desc="{} call{}, slowest {:.1f}ms";dur={:.1f}'.format(
+        _NOT_TOKEN_CHARS.sub('_', '{}.{}'.format(backend, name.replace('/', '.'))),
+        count, 's' if count > 1 else '', slowest * 1000, duration * 1000)
+        for backend, name, count, duration, slowest in summary]
+    backends = sum(call[3] for call in summary)
+    # Calls made in parallel can take longer than the request itself.
+    metrics.append('app;desc="Our own code";dur={:.1f}'.format(max(total - backends, 0) * 1000))
+    metrics.append('total;dur={:.1f}'.format(total * 1000))
+    return ', '.join(metrics)
+
+
+class BackendTimingMiddleware:
+    """
+    Add a Server-Timing header to each response, and log the backend calls made for the request.
+
+    The calls made while a streaming response is being sent (after the view has returned) are not counted.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.BACKEND_TIMING_ENABLED:
+            return self.get_response(request)
+
+        collector = Collector()
+        _local.collector = collector
+        try:
+            response = self.get_response(request)
+        finally:
+            _local.collector = None
+
+        total = time.monotonic() - collector.start
+        summary = collector.summary()
+        response['Server-Timing'] = _server_timing(summary, total)
+
+        log.info('backend_timing {}'.format(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 1),
+            'calls': [{'backend': backend, 'name': name, 'count': count, 'total_ms': round(duration * 1000, 1),
+                       'slowest_ms': round(slowest * 1000, 1)}
+                      for backend, name, count, duration, slowest in summary],
+        })))
+        for backend, name, count, duration, slowest in summary:
+            if count > settings.BACKEND_TIMING_MAX_CALLS:
+                log.warning('{} {}: {} calls to {} {} ({:.1f}ms)'.format(
+                    request.method, request.path, count, backend, name, duration * 1000))
+        return response
@@ -6,7 +6,7 @@ from rest_framework.response import Response
 from cyclos_api import CyclosAPI
 from dolibarr_api import DolibarrAPI
 from members.serializers import MemberSerializer
-from pagination import CustomPagination
+from pagination import DolibarrPagination
 
 log = logging.getLogger()
 
@@ -24,9 +24,9 @@ class BaseAPIView(viewsets.ViewSet):
             self.dolibarr = DolibarrAPI()
 
     def list(self, request, *args, **kwargs):
-        objects = self.dolibarr.get(model=self.model, api_key=request.user.profile.dolibarr_token)
-        paginator = CustomPagination()
-        result_page = paginator.paginate_queryset(objects, request)
+        paginator = DolibarrPagination()
+        result_page = paginator.paginate_dolibarr(self.dolibarr, request, model=self.model,
+                                                  api_key=request.user.profile.dolibarr_token)
 
         serializer = MemberSerializer(result_page, many=True)
         return paginator.get_paginated_response(serializer.data)
@@ -8,6 +8,7 @@ from rest_framework.response import Response
 from bdc_cyclos import serializers
 from cyclos_api import CyclosAPI, CyclosAPIException
 from dolibarr_api import DolibarrAPI, DolibarrAPIException
+from misc import concurrent_map
 
 log = logging.getLogger()
 
@@ -127,29 +128,22 @@ def deposit_banks_summaries(request):
         return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
 
     # user/search for group = 'Banques de dépot'
-    banks_data = cyclos.post(method='user/search',
-                             data={'groups': [settings.CYCLOS_CONSTANTS['groups']['banques_de_depot']]})
-    banks_ids = [ item['id'] for item in banks_data['result']['pageItems'] ]
-    bank_names = []
-    for bank_id in banks_ids:
-        cyclos_user = cyclos.post(method='user/load', data=[bank_id])['result']
-        bank_names.append({'label': cyclos_user['name'], 'value': cyclos_user['id'], 'shortLabel': cyclos_user['username']})
+    bank_names = cyclos.get_group_users(groups=[settings.CYCLOS_CONSTANTS['groups']['banques_de_depot']])
 
-    res = {}
-    for bank in bank_names:
-        bank_user_query = {
-            'keywords': bank['shortLabel'],  # shortLabel = username from Cyclos
-        }
-        try:
-            bank_user_data = cyclos.post(method='user/search', data=bank_user_query)['result']['pageItems'][0]
+    # On récupère en parallèle les comptes de toutes les banques.
+    def get_bank_account(bank):
+        bank_account_query = [bank['value'], None]  # value = ID de la banque dans Cyclos
+        return cyclos.post(method='account/getAccountsSummary', data=bank_account_query)['result'][0]
 
-            bank_account_query = [bank_user_data['id'], None]
-            bank_data = cyclos.post(method='account/getAccountsSummary', data=bank_account_query)['result'][0]
-        except (KeyError, IndexError):
-                    return Response({'error': 'Unable to get bank data for one of the depositbank!'},
-                                    status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    try:
+        banks_data = concurrent_map(get_bank_account, bank_names)
+    except (KeyError, IndexError):
+        return Response({'error': 'Unable to get bank data for one of the depositbank!'},
+                        status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-        res[bank['shortLabel']] = bank
+    res = {}
+    for bank, bank_data in zip(bank_names, banks_data):
+        res[bank['shortLabel']] = dict(bank)
         res[bank['shortLabel']]['balance'] = float(bank_data['status']['balance'])
         res[bank['shortLabel']]['currency'] = bank_data['currency']['symbol']
         res[bank['shortLabel']]['type'] = {'name': bank_data['type']['name'],
@@ -449,8 +443,6 @@ def accounts_history(request):
     search_history_data = {
         'account': data['id'],  # ID du compte
         'orderBy': 'DATE_DESC',
-        'pageSize': 1000,  # maximum pageSize: 1000
-        'currentPage': 0,
     }
 
     try:
@@ -463,7 +455,7 @@ def accounts_history(request):
     except KeyError:
         pass
 
-    return Response(cyclos.post(method='account/searchAccountHistory', data=search_history_data))
+    return Response(cyclos.search_all(method='account/searchAccountHistory', data=search_history_data))
 
 
 @api_view(['POST'])
@@ -996,15 +988,13 @@ def payments_available_for_entree_stock(request):
         'statuses': [
             str(settings.CYCLOS_CONSTANTS['transfer_statuses']['a_rapprocher'])
         ],
-        'pageSize': 1000,  # maximum pageSize: 1000
-        'currentPage': 0,
     }
-    accounts_summaries_res = cyclos.post(method='account/searchAccountHistory', data=search_history_data)
+    accounts_summaries_res = cyclos.iter_search(method='account/searchAccountHistory', data=search_history_data)
 
     # Filter out the results that are not "Sortie coffre" and items that are not for this BDC
     accounts_summaries_data = [
         item
-        for item in accounts_summaries_res['result']['pageItems']
+        for item in accounts_summaries_res
         for value in item['customValues']
         if item['type']['id'] == str(settings.CYCLOS_CONSTANTS['payment_types']['sortie_coffre']) and
         value['field']['internalName'] == 'bdc' and
@@ -5,7 +5,7 @@ from rest_framework import status
 from rest_framework.response import Response
 
 from base_api import BaseAPIView
-from cyclos_api import CyclosAPIException
+from cyclos_api import CyclosAPI, CyclosAPIException
 from dolibarr_api import DolibarrAPIException
 from bureauxdechange.misc import BDC
 from bureauxdechange import serializers
@@ -65,6 +65,8 @@ class BDCAPIView(BaseAPIView):
         except CyclosAPIException:
             return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
 
+        CyclosAPI.invalidate_group_users([settings.CYCLOS_CONSTANTS['groups']['bureaux_de_change']])
+
         # Création du user dans Dolibarr
         try:
             user_id = self.dolibarr.post(
@@ -110,25 +112,13 @@ class BDCAPIView(BaseAPIView):
         """
         view_all = request.GET.get('view_all', False)
         if view_all and view_all in [True, 'true', 'True', 'yes', 'Yes']:
-            # user/search for group = 'bureaux_de_change'
-            query_data = {'groups': [str(settings.CYCLOS_CONSTANTS['groups']['bureaux_de_change'])],
-                          'userStatus': ['ACTIVE', 'DISABLED'],
-                          'pageSize': 1000,  # maximum pageSize: 1000
-                          'currentPage': 0}
+            user_statuses = ['ACTIVE', 'DISABLED']
         else:
-            # user/search for group = 'bureaux_de_change'
-            query_data = {'groups': [str(settings.CYCLOS_CONSTANTS['groups']['bureaux_de_change'])],
-                          'userStatus': ['ACTIVE'],
-                          'pageSize': 1000,  # maximum pageSize: 1000
-                          'currentPage': 0}
-
-        data = self.cyclos.post(method='user/search', data=query_data,
-                                token=request.user.profile.cyclos_token)
-        ids = [ item['id'] for item in data['result']['pageItems'] ]
-        objects = []
-        for id in ids:
-            cyclos_user = self.cyclos.post(method='user/load', data=[id])['result']
-            objects.append({'label': cyclos_user['name'], 'value': cyclos_user['id'], 'shortLabel': cyclos_user['username']})
+            user_statuses = ['ACTIVE']
+
+        # user/search for group = 'bureaux_de_change'
+        objects = self.cyclos.get_group_users(groups=[settings.CYCLOS_CONSTANTS['groups']['bureaux_de_change']],
+                                              user_statuses=user_statuses, token=request.user.profile.cyclos_token)
 
         paginator = CustomPagination()
         result_page = paginator.paginate_queryset(objects, request)
@@ -189,6 +179,7 @@ class BDCAPIView(BaseAPIView):
             'status': 'DISABLED',
         }
         self.cyclos.post(method='userStatus/changeStatus', data=deactivate_bdc_data)
+        CyclosAPI.invalidate_group_users([settings.CYCLOS_CONSTANTS['groups']['bureaux_de_change']])
 
         return Response(pk)
 
@@ -44,11 +44,10 @@ class BeneficiaireViewSet(viewsets.ModelViewSet):
             cyclos = CyclosAPI(token=request.user.profile.cyclos_token, mode='cel')
         except CyclosAPIException:
             return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
-        data = cyclos.post(method='user/search', data={'keywords': cyclos_account_number})
-        if data['result']['totalCount'] == 0:
+        cyclos_user = cyclos.resolve_account_number(cyclos_account_number)
+        if cyclos_user is None:
             return Response({'error': _("Ce numéro de compte n'existe pas")},
                             status=status.HTTP_422_UNPROCESSABLE_ENTITY)
-        cyclos_user = data['result']['pageItems'][0]
 
         # Enregistrement du bénéficiaire en base de données.
         beneficiaire = serializer.save(
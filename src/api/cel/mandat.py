@@ -76,12 +76,10 @@ class MandatViewSet(viewsets.ModelViewSet):
             return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
 
         # Pour avoir le nom du débiteur, on fait une recherche dans Cyclos par son numéro de compte.
-        data = cyclos.post(method='user/search', data={'keywords': numero_compte_debiteur})
-        if data['result']['totalCount'] == 0:
+        debiteur = cyclos.resolve_account_number(numero_compte_debiteur)
+        if debiteur is None:
             return Response({'error': _("Ce numéro de compte n'existe pas")},
                             status=status.HTTP_422_UNPROCESSABLE_ENTITY)
-        debiteur_id = data['result']['pageItems'][0]['id']
-        debiteur = cyclos.post(method='user/load', data=debiteur_id)['result']
 
         # Enregistrement du mandat en base de données.
         mandat = serializer.save(
@@ -194,10 +192,10 @@ def notifier_crediteur(request, mandat, template):
         cyclos = CyclosAPI(token=request.user.profile.cyclos_token, mode='cel')
     except CyclosAPIException:
         return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
-    data = cyclos.post(method='user/search',
-                       data={'keywords': mandat.numero_compte_crediteur})
-    crediteur_id = data['result']['pageItems'][0]['id']
-    crediteur = cyclos.post(method='user/load', data=crediteur_id)['result']
+    crediteur = cyclos.resolve_account_number(mandat.numero_compte_crediteur)
+    if crediteur is None:
+        return Response({'error': _("Ce numéro de compte n'existe pas")},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
     crediteur_dolibarr = dolibarr.get(model='members',
                                       sqlfilters="login='{}'".format(crediteur['username']))[0]
     # Activation de la langue choisie par l'adhérent et traduction du sujet et du corps de l'email.
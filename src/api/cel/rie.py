@@ -0,0 +1,85 @@
+"""
+Cache des RIE (relevés d'identité Eusko) au format PDF.
+
+Un RIE ne change que si le nom ou l'adresse du titulaire du compte change. Chaque PDF est donc enregistré sous
+MEDIA_ROOT/rie/, dans un fichier dont le nom est l'empreinte (SHA-256) du contexte du template : deux RIE identiques
+ne sont générés qu'une fois, et un changement de nom ou d'adresse donne un nouveau fichier.
+
+A chaque téléchargement, on relit le compte et son titulaire dans Cyclos (ce sont des appels rapides) pour calculer
+l'empreinte : seule la génération du PDF est évitée. Le fichier est renvoyé avec un ETag (l'empreinte) et un
+Last-Modified, ou une réponse 304 si le client l'a déjà.
+"""
+import hashlib
+import json
+import logging
+import os
+
+from django.conf import settings
+from django.http import HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe
+from rest_framework.response import Response
+
+from misc import write_atomically
+from pdf_rendering import render_pdf
+
+log = logging.getLogger()
+
+RIE_TEMPLATE = 'summary/rie.html'
+
+
+def _path(digest):
+    return os.path.join(settings.MEDIA_ROOT, 'rie', '{}.pdf'.format(digest))
+
+
+def _digest(account_number, account_owner):
+    data = {'template': RIE_TEMPLATE, 'account_number': account_number, 'account_owner': account_owner}
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_rie(cyclos, account_number, request=None):
+    """
+    Chemin du RIE du compte de l'utilisateur, généré si nécessaire, ou None si ce compte n'est pas à lui.
+    """
+    accounts_summaries = cyclos.post(method='account/getAccountsSummary', data=[cyclos.user_id, None])['result']
+    account = next((account for account in accounts_summaries if account['number'] == account_number), None)
+    if account is None:
+        return None
+    account_owner = cyclos.post(method='user/load', data=account['owner']['id'])['result']
+
+    digest = _digest(account['number'], account_owner)
+    path = _path(digest)
+    if not os.path.exists(path):
+        # Le RIE est affiché 3 fois sur la page.
+        context = {'account_number': account['number'], 'account_owner': account_owner, 'loop': range(0, 3)}
+        write_atomically(path, render_pdf(RIE_TEMPLATE, context, request))
+        log.debug("RIE {} generated for account {}".format(digest, account_number))
+    return path
+
+
+def rie_response(request, path):
+    """
+    Réponse avec le contenu du RIE, son ETag et sa date de modification.
+    Renvoie 304 Not Modified si le client a déjà ce RIE.
+    """
+    etag = '"{}"'.format(os.path.splitext(os.path.basename(path))[0])
+    last_modified = int(os.path.getmtime(path))
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        not_modified = etag in [tag.strip() for tag in if_none_match.split(',')]
+    else:
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        not_modified = if_modified_since is not None and last_modified <= if_modified_since
+
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        with open(path, 'rb') as pdf_file:
+            pdf_content = pdf_file.read()
+        response = Response(pdf_content, headers={
+            'Content-Disposition': 'filename="pdf_id.pdf"',
+            'Content-Length': len(pdf_content),
+        })
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
@@ -38,6 +38,7 @@ class HistorySerializer(serializers.Serializer):
 class ExportHistorySerializer(serializers.Serializer):
     begin = serializers.DateField(format=None)
     end = serializers.DateField(format=None)
+    stream = serializers.BooleanField(required=False, default=False)
 
 
 class ExportRIESerializer(serializers.Serializer):
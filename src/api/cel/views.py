@@ -1,4 +1,3 @@
-from base64 import b64encode
 from datetime import date, datetime, timedelta
 import logging
 import mimetypes
@@ -6,6 +5,7 @@ from uuid import uuid4
 
 import arrow
 from django.conf import settings
+from django.http import StreamingHttpResponse
 from django.template.loader import render_to_string
 from django.utils.translation import activate, gettext as _
 from drf_pdf.renderer import PDFRenderer
@@ -15,17 +15,20 @@ from rest_framework.decorators import api_view, permission_classes, renderer_cla
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.exceptions import PermissionDenied
-from rest_framework_csv.renderers import CSVRenderer
-from wkhtmltopdf import views as wkhtmltopdf_views
+from rest_framework_csv.renderers import CSVRenderer, CSVStreamingRenderer
 
-from cel import models, serializers
+from cel import models, rie, serializers
 from cel.models import Mandat
 from cel.mandat import get_current_user_account_number
 from cyclos_api import CyclosAPI, CyclosAPIException
 from dolibarr_api import DolibarrAPI, DolibarrAPIException
+from gestioninterne.balances import accounts_summary
+from gestioninterne.statements import CSV_HEADER, csv_row, iter_statement_lines, statement_context
 from gestioninterne.views import _search_account_history
 from members.misc import Member
 from misc import EuskalMonetaAPIException, sendmail_euskalmoneta, sendmailHTML_euskalmoneta
+from pdf_rendering import PDFRenderingBusy, render_pdf
+from service_sessions import anonymous_cyclos, anonymous_dolibarr
 
 log = logging.getLogger()
 
@@ -40,21 +43,19 @@ def first_connection(request):
     serializer.is_valid(raise_exception=True)  # log.critical(serializer.errors)
 
     try:
-        dolibarr = DolibarrAPI()
-        dolibarr_token = dolibarr.login(login=settings.APPS_ANONYMOUS_LOGIN,
-                                        password=settings.APPS_ANONYMOUS_PASSWORD)
+        dolibarr = anonymous_dolibarr()
 
         valid_login = Member.validate_num_adherent(request.data['login'])
 
         try:
-            dolibarr.get(model='users', sqlfilters="login='{}'".format(request.data['login']), api_key=dolibarr_token)
+            dolibarr.get(model='users', sqlfilters="login='{}'".format(request.data['login']))
             return Response({'error': 'User already exist!'}, status=status.HTTP_201_CREATED)
         except DolibarrAPIException:
             pass
 
         if valid_login:
             # We want to search in members by login (N° Adhérent)
-            response = dolibarr.get(model='members', sqlfilters="login='{}'".format(request.data['login']), api_key=dolibarr_token)
+            response = dolibarr.get(model='members', sqlfilters="login='{}'".format(request.data['login']))
             member = [item
                          for item in response
                          if item['login'] == request.data['login']][0]
@@ -63,17 +64,13 @@ def first_connection(request):
                 # We got a match!
 
                 # On vérifie si cet adhérent a un compte numérique.
-                cyclos = CyclosAPI(mode='login')
-                cyclos_token = cyclos.login(
-                    auth_string=b64encode(bytes('{}:{}'.format(settings.APPS_ANONYMOUS_LOGIN,
-                                                               settings.APPS_ANONYMOUS_PASSWORD), 'utf-8')).decode('ascii'))
+                cyclos = anonymous_cyclos()
                 data = cyclos.post(method='user/search',
                                    data={
                                        'keywords': request.data['login'],
                                        'groups': ['adherents_prestataires', 'adherents_prestataires_avec_paiement_smartphone', 'adherents_utilisateurs'],
                                        'userStatus': ['ACTIVE'],
-                                   },
-                                   token=cyclos_token)
+                                   })
                 if data['result']['totalCount'] == 0:
                     return Response({'error': _("Cet adhérent ou cette adhérente n'a pas de compte eusko.")},
                                     status=status.HTTP_400_BAD_REQUEST)
@@ -81,7 +78,7 @@ def first_connection(request):
                 # On enregistre la langue choisie par l'adhérent.
                 data = Member.validate_data({'options_langue': request.data['language']}, mode='update',
                                             base_options=member['array_options'])
-                dolibarr.put(model='members/{}'.format(member['id']), data=data, api_key=dolibarr_token)
+                dolibarr.put(model='members/{}'.format(member['id']), data=data)
 
                 # We need to mail a token etc...
                 payload = {'login': request.data['login'],
@@ -132,12 +129,10 @@ def validate_first_connection(request):
         return Response({'error': 'Unable to read token!'}, status=status.HTTP_400_BAD_REQUEST)
 
     try:
-        dolibarr = DolibarrAPI()
-        dolibarr_token = dolibarr.login(login=settings.APPS_ANONYMOUS_LOGIN,
-                                        password=settings.APPS_ANONYMOUS_PASSWORD)
+        dolibarr = anonymous_dolibarr()
         # We check if the user already exist, if he already exist we return a 400
         try:
-            dolibarr.get(model='users', sqlfilters="login='{}'".format(token_data['login']), api_key=dolibarr_token)
+            dolibarr.get(model='users', sqlfilters="login='{}'".format(token_data['login']))
             return Response({'error': 'User already exist!'}, status=status.HTTP_201_CREATED)
         except DolibarrAPIException:
             pass
@@ -149,12 +144,9 @@ def validate_first_connection(request):
         create_dolibarr_user_linked_to_member(dolibarr, token_data['login'])
 
         # 3) Dans Cyclos, initialiser le mot de passe de l'utilisateur.
-        cyclos = CyclosAPI(mode='login')
-        cyclos_token = cyclos.login(
-            auth_string=b64encode(bytes('{}:{}'.format(settings.APPS_ANONYMOUS_LOGIN,
-                                                       settings.APPS_ANONYMOUS_PASSWORD), 'utf-8')).decode('ascii'))
-        cyclos_user_id = cyclos.get_member_id_from_login(member_login=token_data['login'], token=cyclos_token)
-        change_cyclos_user_password(cyclos_token, cyclos_user_id, request.data['new_password'])
+        cyclos = anonymous_cyclos()
+        cyclos_user_id = cyclos.get_member_id_from_login(member_login=token_data['login'])
+        change_cyclos_user_password(cyclos, cyclos_user_id, request.data['new_password'])
 
         return Response({'login': token_data['login']})
 
@@ -172,15 +164,13 @@ def lost_password(request):
     serializer.is_valid(raise_exception=True)  # log.critical(serializer.errors)
 
     try:
-        dolibarr = DolibarrAPI()
-        dolibarr_token = dolibarr.login(login=settings.APPS_ANONYMOUS_LOGIN,
-                                        password=settings.APPS_ANONYMOUS_PASSWORD)
+        dolibarr = anonymous_dolibarr()
 
         valid_login = Member.validate_num_adherent(request.data['login'])
 
         if valid_login:
             # We want to search in members by login (N° Adhérent)
-            response = dolibarr.get(model='members', sqlfilters="login='{}'".format(request.data['login']), api_key=dolibarr_token)
+            response = dolibarr.get(model='members', sqlfilters="login='{}'".format(request.data['login']))
             user_data = [item
                          for item in response
                          if item['login'] == request.data['login']][0]
@@ -242,12 +232,9 @@ def validate_lost_password(request):
             return Response({'status': 'NOK'}, status=status.HTTP_400_BAD_REQUEST)
 
         # Dans Cyclos, reset le mot de passe de l'utilisateur
-        cyclos = CyclosAPI(mode='login')
-        cyclos_token = cyclos.login(
-            auth_string=b64encode(bytes('{}:{}'.format(settings.APPS_ANONYMOUS_LOGIN,
-                                                       settings.APPS_ANONYMOUS_PASSWORD), 'utf-8')).decode('ascii'))
+        cyclos = anonymous_cyclos()
 
-        cyclos_user_id = cyclos.get_member_id_from_login(member_login=token_data['login'], token=cyclos_token)
+        cyclos_user_id = cyclos.get_member_id_from_login(member_login=token_data['login'])
 
         password_data = {
             'user': cyclos_user_id,  # ID de l'utilisateur
@@ -255,7 +242,7 @@ def validate_lost_password(request):
             'newPassword': serializer.data['new_password'],  # saisi par l'utilisateur
             'confirmNewPassword': serializer.data['confirm_password'],  # saisi par l'utilisateur
         }
-        cyclos.post(method='password/change', data=password_data, token=cyclos_token)
+        cyclos.post(method='password/change', data=password_data)
 
         return Response({'status': 'success'})
 
@@ -291,13 +278,12 @@ def payments_available_for_adherents(request):
     begin_date = serializer.data['begin'].replace(hour=0, minute=0, second=0).isoformat()
     end_date = serializer.data['end'].replace(hour=23, minute=59, second=59).isoformat()
 
-    query_data = [cyclos.user_id, end_date]
-    accounts_summaries_data = cyclos.post(method='account/getAccountsSummary', data=query_data)
+    # Solde à la fin de la journée de fin de période, c'est-à-dire le lendemain à zéro heure. Pour une journée terminée,
+    # il est lu dans les soldes enregistrés localement (voir gestioninterne/balances.py).
+    accounts_summaries = accounts_summary(cyclos, cyclos.user_id, serializer.data['end'].date() + timedelta(days=1))
 
     search_history_data = {
         'orderBy': 'DATE_DESC',
-        'pageSize': 1000,  # maximum pageSize: 1000
-        'currentPage': 0,
         'period':
         {
             'begin': begin_date,
@@ -307,18 +293,22 @@ def payments_available_for_adherents(request):
     try:
         search_history_data.update({'account': request.query_params['account']})
     except KeyError:
-        search_history_data.update({'account': accounts_summaries_data['result'][0]['status']['accountId']})
+        search_history_data.update({'account': accounts_summaries[0]['status']['accountId']})
     try:
         search_history_data.update({'description': request.query_params['description']})
     except KeyError:
         pass
 
-    accounts_history_res = cyclos.post(method='account/searchAccountHistory', data=search_history_data)
-    return Response([accounts_history_res, accounts_summaries_data['result'][0]['status']['balance']])
+    accounts_history_res = cyclos.search_all(method='account/searchAccountHistory', data=search_history_data)
+    return Response([accounts_history_res, accounts_summaries[0]['status']['balance']])
 
 
 class ExportHistoryCSVRenderer(CSVRenderer):
-    header = ['Date', 'Libellé', 'Débit', 'Crédit', 'Solde']
+    header = CSV_HEADER
+
+
+class ExportHistoryCSVStreamingRenderer(CSVStreamingRenderer):
+    header = CSV_HEADER
 
 
 @api_view(['GET'])
@@ -343,9 +333,9 @@ def export_history_adherent(request):
     # à cette date (càd le solde initial pour l'historique).
     # On ne garde que le premier élément de la réponse car on sait qu'un
     # adhérent n'a qu'un compte.
-    accounts_summary_query_data = [cyclos.user_id, begin_date]
-    accounts_summary_res = cyclos.post(method='account/getAccountsSummary', data=accounts_summary_query_data)
-    account_summary = accounts_summary_res['result'][0]
+    # Pour une date passée, le solde est lu dans les soldes enregistrés
+    # localement (voir gestioninterne/balances.py).
+    account_summary = accounts_summary(cyclos, cyclos.user_id, serializer.data['begin'])[0]
     initial_balance = account_summary['status']['balance']
 
     # On récupère l'historique du compte pour la période demandée, avec
@@ -353,55 +343,35 @@ def export_history_adherent(request):
     account_history_query_data = {
         'account': account_summary['status']['accountId'],
         'orderBy': 'DATE_ASC',
-        'pageSize': 1000,  # maximum pageSize: 1000
-        'currentPage': 0,
         'period':
         {
             'begin': begin_date,
             'end': end_date,
         },
     }
-    account_history_res = cyclos.post(method='account/searchAccountHistory', data=account_history_query_data)
-    account_history = account_history_res['result']['pageItems']
-
-    # Pour chaque ligne de l'historique :
-    # - on calcule le solde (en faisant le cumul avec les lignes précédentes)
-    # - on met la date au format JJ/MM/AAAA (on n'affiche pas l'heure dans l'historique)
-    # - on ajoute "Vers : xxx" ou "De : xxx" dans la description sauf lorsque l'autre compte est un compte système
-    balance = initial_balance
-    for line in account_history:
-        balance = float(balance) + float(line['amount'])
-        line['balance'] = balance
-        line['date'] = arrow.get(line['date']).format('DD/MM/YYYY')
-        if line['relatedAccount']['type']['nature'] != 'SYSTEM':
-            line['description'] = "{}\r\n{} : {}".format(line['description'],
-                                                         'Vers' if float(line['amount']) < 0 else 'De',
-                                                         line['relatedAccount']['owner']['display'])
-
-    # On ajoute une première ligne avec le solde initial du compte.
-    account_history.insert(0, {
-        'date': arrow.get(begin_date).format('DD/MM/YYYY'),
-        'description': 'Solde initial',
-        'amount': 0,
-        'balance': initial_balance,
-    })
-
-    # On fabrique l'objet qui va servir à l'export PDF ou CSV.
-    context = {
-        'account_number': account_summary['number'],
-        'name': account_summary['owner']['display'],
-        'account_history': account_history,
-        'account_login': str(request.user),
-        'period': {
-            'begin': arrow.get(serializer.data['begin']).format('DD MMMM YYYY', locale='fr'),
-            'end': arrow.get(serializer.data['end']).format('DD MMMM YYYY', locale='fr'),
-        },
-    }
+    # L'historique est lu page après page, et les lignes du relevé (avec le solde) sont calculées au fur et à mesure.
+    account_history = cyclos.iter_search(method='account/searchAccountHistory', data=account_history_query_data)
+    lines = iter_statement_lines(account_history, begin_date, initial_balance)
+
+    if request.accepted_media_type == 'text/csv' and serializer.data['stream']:
+        # En mode streaming, chaque ligne est envoyée dès qu'elle est produite : le téléchargement commence tout de
+        # suite et le fichier n'est jamais entièrement en mémoire, quel que soit le nombre d'opérations. Par contre, si
+        # une erreur se produit en cours de route, le fichier sera incomplet (la réponse a déjà commencé).
+        response = StreamingHttpResponse(ExportHistoryCSVStreamingRenderer().render(csv_row(line) for line in lines),
+                                         content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="historique_{}_{}.csv"'.format(
+            serializer.data['begin'], serializer.data['end'])
+        return response
 
     if request.accepted_media_type == 'application/pdf':
-        response = wkhtmltopdf_views.PDFTemplateResponse(
-            request=request, context=context, template="summary/summary.html")
-        pdf_content = response.rendered_content
+        # On fabrique l'objet qui va servir à l'export PDF.
+        context = statement_context(account_summary, list(lines), str(request.user),
+                                    serializer.data['begin'], serializer.data['end'])
+        try:
+            pdf_content = render_pdf("summary/summary.html", context, request)
+        except PDFRenderingBusy:
+            return Response({'error': 'Too many PDF exports in progress, try again later.'},
+                            status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
         headers = {
             'Content-Disposition': 'filename="pdf_id.pdf"',
@@ -410,15 +380,7 @@ def export_history_adherent(request):
 
         return Response(pdf_content, headers=headers)
     elif request.accepted_media_type == 'text/csv':
-        csv_content = [{'Date': line['date'],
-                        'Libellé': line['description'],
-                        'Crédit': "{0:.2f}".format(float(line['amount'])).replace('.', ',')
-                                  if float(line['amount']) > float() else '',
-                        'Débit': "{0:.2f}".format(float(line['amount'])).replace('.', ',')
-                                  if float(line['amount']) < float() else '',
-                        'Solde': "{0:.2f}".format(float(line['balance'])).replace('.', ',')}
-                       for line in context['account_history']]
-        return Response(csv_content)
+        return Response([csv_row(line) for line in lines])
     else:
         return Response(status=status.HTTP_406_NOT_ACCEPTABLE)
 
@@ -429,40 +391,32 @@ def export_rie_adherent(request):
     serializer = serializers.ExportRIESerializer(data=request.query_params)
     serializer.is_valid(raise_exception=True)
 
+    account_number = request.query_params['account']
+
     try:
         cyclos = CyclosAPI(token=request.user.profile.cyclos_token, mode='cel')
     except CyclosAPIException:
         return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
-    query_data = [cyclos.user_id, None]
-    accounts_summaries_data = cyclos.post(method='account/getAccountsSummary', data=query_data)
-
-    for account in (accounts_summaries_data['result']):
-        if account['number'] == request.query_params['account']:
-            account_owner = cyclos.post(method='user/load', data=account['owner']['id'])['result']
-            # add loop to context to display rie 6 times
-            context = {'account_number': account['number'], 'account_owner': account_owner, 'loop': range(0, 3)}
-            response = wkhtmltopdf_views.PDFTemplateResponse(
-                request=request, context=context, template="summary/rie.html")
-            pdf_content = response.rendered_content
-
-            headers = {
-                'Content-Disposition': 'filename="pdf_id.pdf"',
-                'Content-Length': len(pdf_content),
-            }
+    # Le PDF n'est généré que si le RIE a changé depuis le dernier téléchargement.
+    try:
+        path = rie.get_rie(cyclos, account_number, request)
+    except PDFRenderingBusy:
+        return Response({'error': 'Too many PDF exports in progress, try again later.'},
+                        status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    if path is None:
+        return Response({'error': 'Account not found!'}, status=status.HTTP_404_NOT_FOUND)
 
-            return Response(pdf_content, headers=headers)
+    return rie.rie_response(request, path)
 
 
 def execute_virement(dolibarr, cyclos, virement):
     try:
         # On récupère le destinataire du virement à partir de son numéro de compte.
-        try:
-            data = cyclos.post(method='user/search', data={'keywords': virement['account']})
-            destinataire_cyclos = cyclos.post(method='user/load', data=data['result']['pageItems'][0]['id'])['result']
-            virement['name'] = destinataire_cyclos['name']
-        except IndexError:
+        destinataire_cyclos = cyclos.resolve_account_number(virement['account'])
+        if destinataire_cyclos is None:
             virement['name'] = None
             raise Exception(_("Ce numéro de compte n'existe pas"))
+        virement['name'] = destinataire_cyclos['name']
         # On fait le paiement.
         query_data = {
             'type': str(settings.CYCLOS_CONSTANTS['payment_types']['virement_inter_adherent']),
@@ -525,6 +479,8 @@ def execute_virements(request):
     except CyclosAPIException:
         return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
 
+    # On recherche en une fois les destinataires de tous les virements.
+    cyclos.resolve_account_numbers([virement['account'] for virement in virements])
     for virement in virements:
         execute_virement(dolibarr, cyclos, virement)
 
@@ -665,10 +621,7 @@ def euskokart_update_pin(request):
         return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
 
     # Connexion à Cyclos avec l'utilisateur Anonyme pour modifier le code PIN de l'utilisateur courant.
-    cyclos_anonyme = CyclosAPI(mode='login')
-    cyclos_token_anonyme = cyclos_anonyme.login(
-        auth_string=b64encode(bytes('{}:{}'.format(settings.APPS_ANONYMOUS_LOGIN,
-                                                   settings.APPS_ANONYMOUS_PASSWORD), 'utf-8')).decode('ascii'))
+    cyclos_anonyme = anonymous_cyclos()
 
     try:
         password_data = {
@@ -677,7 +630,7 @@ def euskokart_update_pin(request):
             'newPassword': serializer.validated_data['pin'],
             'confirmNewPassword': serializer.validated_data['pin']
         }
-        cyclos_anonyme.post(method='password/change', data=password_data, token=cyclos_token_anonyme)
+        cyclos_anonyme.post(method='password/change', data=password_data)
     except CyclosAPIException:
         return Response({'error': 'Unable to set your pin code!'}, status=status.HTTP_401_UNAUTHORIZED)
 
@@ -802,27 +755,27 @@ def execute_prelevements(request):
 
     # On récupère l'utilisateur créditeur à partir de son numéro de compte.
     numero_compte_crediteur = get_current_user_account_number(request)
-    data = cyclos.post(method='user/search', data={'keywords': numero_compte_crediteur})
-    crediteur = data['result']['pageItems'][0]
+    crediteur = cyclos.resolve_account_number(numero_compte_crediteur)
+    if crediteur is None:
+        return Response({'error': _("Ce numéro de compte n'existe pas")},
+                        status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    # On recherche en une fois les débiteurs de tous les prélèvements.
+    cyclos.resolve_account_numbers([prelevement['account'] for prelevement in prelevements])
 
     # Connexion à Cyclos avec l'utilisateur Anonyme, pour exécuter les prélèvements.
-    cyclos_anonyme = CyclosAPI(mode='login')
-    cyclos_token_anonyme = cyclos_anonyme.login(
-        auth_string=b64encode(bytes('{}:{}'.format(settings.APPS_ANONYMOUS_LOGIN,
-                                                   settings.APPS_ANONYMOUS_PASSWORD), 'utf-8')).decode('ascii'))
+    cyclos_anonyme = anonymous_cyclos()
 
     # Pour chaque prélèvement à faire, on recherche le mandat correspondant et on vérifie s'il est valide.
     # Si c'est le cas, on fait le prélèvement (le paiement est fait par l'utilisateur Anonyme).
     for prelevement in prelevements:
         try:
             # On récupère le débiteur à partir de son numéro de compte.
-            try:
-                data = cyclos.post(method='user/search', data={'keywords': prelevement['account']})
-                debiteur = data['result']['pageItems'][0]
-                prelevement['name'] = debiteur['display']
-            except IndexError:
+            debiteur = cyclos.resolve_account_number(prelevement['account'])
+            if debiteur is None:
                 prelevement['name'] = None
                 raise Exception(_("Ce numéro de compte n'existe pas"))
+            prelevement['name'] = debiteur['display']
             try:
                 mandat = Mandat.objects.get(numero_compte_crediteur=numero_compte_crediteur,
                                             numero_compte_debiteur=prelevement['account'])
@@ -844,7 +797,7 @@ def execute_prelevements(request):
                 'description': prelevement['description'],
             }
             try:
-                cyclos_anonyme.post(method='payment/perform', data=query_data, token=cyclos_token_anonyme)
+                cyclos_anonyme.post(method='payment/perform', data=query_data)
             except CyclosAPIException as err:
                 if str(err).find('INSUFFICIENT_BALANCE') != -1:
                     raise Exception(_("Solde insuffisant"))
@@ -878,13 +831,8 @@ def creer_compte_vee(request):
 
     try:
         # Connexion à Dolibarr et Cyclos avec l'utilisateur Anonyme.
-        dolibarr = DolibarrAPI()
-        dolibarr.login(login=settings.APPS_ANONYMOUS_LOGIN,
-                       password=settings.APPS_ANONYMOUS_PASSWORD)
-        cyclos = CyclosAPI(mode='login')
-        cyclos_token = cyclos.login(
-            auth_string=b64encode(bytes('{}:{}'.format(settings.APPS_ANONYMOUS_LOGIN,
-                                                       settings.APPS_ANONYMOUS_PASSWORD), 'utf-8')).decode('ascii'))
+        dolibarr = anonymous_dolibarr()
+        cyclos = anonymous_cyclos()
         # Générer un nouveau numéro d'adhérent.
         adherent = models.AdherentTouriste()
         adherent.save()
@@ -915,7 +863,7 @@ def creer_compte_vee(request):
         # Créer l'utilisateur Dolibarr lié à cet adhérent.
         create_dolibarr_user_linked_to_member(dolibarr, num_adherent)
         # Créer l'utilisateur Cyclos.
-        create_cyclos_user(cyclos_token, 'adherents_utilisateurs', '{} {}'.format(firstname, lastname), num_adherent,
+        create_cyclos_user(cyclos, 'adherents_utilisateurs', '{} {}'.format(firstname, lastname), num_adherent,
                            serializer.validated_data['password'], serializer.validated_data['pin_code'])
         # Enregistrer la question/réponse de sécurité.
         create_security_qa(num_adherent, serializer.validated_data['question'], serializer.validated_data['answer'])
@@ -945,15 +893,12 @@ def verifier_existence_compte(request):
 
     email = serializer.validated_data['email']
 
-    dolibarr = DolibarrAPI()
-    dolibarr_token = dolibarr.login(login=settings.APPS_ANONYMOUS_LOGIN,
-                                    password=settings.APPS_ANONYMOUS_PASSWORD)
+    dolibarr = anonymous_dolibarr()
 
     try:
         response = dolibarr.get(model='members',
                                 typeid=3, #FIXME Particulier
-                                sqlfilters="email='{}' and statut=1".format(email),
-                                api_key=dolibarr_token)
+                                sqlfilters="email='{}' and statut=1".format(email))
     except DolibarrAPIException:
         return Response(status=status.HTTP_404_NOT_FOUND)
 
@@ -1010,13 +955,8 @@ def creer_compte(request):
 
     try:
         # Connexion à Dolibarr et Cyclos avec l'utilisateur Anonyme.
-        dolibarr = DolibarrAPI()
-        dolibarr.login(login=settings.APPS_ANONYMOUS_LOGIN,
-                       password=settings.APPS_ANONYMOUS_PASSWORD)
-        cyclos = CyclosAPI(mode='login')
-        cyclos_token = cyclos.login(
-            auth_string=b64encode(bytes('{}:{}'.format(settings.APPS_ANONYMOUS_LOGIN,
-                                                       settings.APPS_ANONYMOUS_PASSWORD), 'utf-8')).decode('ascii'))
+        dolibarr = anonymous_dolibarr()
+        cyclos = anonymous_cyclos()
         if nouvel_adherent:
             # Générer un nouveau numéro d'adhérent.
             adherent = models.AdherentParticulier()
@@ -1066,7 +1006,7 @@ def creer_compte(request):
         # Créer l'utilisateur Dolibarr lié à cet adhérent.
         create_dolibarr_user_linked_to_member(dolibarr, num_adherent)
         # Créer l'utilisateur Cyclos.
-        create_cyclos_user(cyclos_token, 'adherents_utilisateurs', '{} {}'.format(firstname, lastname), num_adherent,
+        create_cyclos_user(cyclos, 'adherents_utilisateurs', '{} {}'.format(firstname, lastname), num_adherent,
                            serializer.validated_data['password'], serializer.validated_data['pin_code'])
         # Enregistrer la question/réponse de sécurité.
         create_security_qa(num_adherent, serializer.validated_data['question'], serializer.validated_data['answer'])
@@ -1108,13 +1048,8 @@ def adherer(request):
 
     try:
         # Connexion à Dolibarr et Cyclos avec l'utilisateur Anonyme.
-        dolibarr = DolibarrAPI()
-        dolibarr.login(login=settings.APPS_ANONYMOUS_LOGIN,
-                       password=settings.APPS_ANONYMOUS_PASSWORD)
-        cyclos = CyclosAPI(mode='login')
-        cyclos_token = cyclos.login(
-            auth_string=b64encode(bytes('{}:{}'.format(settings.APPS_ANONYMOUS_LOGIN,
-                                                       settings.APPS_ANONYMOUS_PASSWORD), 'utf-8')).decode('ascii'))
+        dolibarr = anonymous_dolibarr()
+        cyclos = anonymous_cyclos()
         if nouvel_adherent:
             # Générer un nouveau numéro d'adhérent.
             adherent = models.AdherentParticulier()
@@ -1146,7 +1081,7 @@ def adherer(request):
                                              filename="{}-Mandat-SEPA.pdf".format(num_adherent),
                                              filecontent=serializer.validated_data['sepa_document'])
         # Créer l'utilisateur Cyclos.
-        create_cyclos_user(cyclos_token, 'adherents_sans_compte', '{} {}'.format(firstname, lastname), num_adherent)
+        create_cyclos_user(cyclos, 'adherents_sans_compte', '{} {}'.format(firstname, lastname), num_adherent)
         # Envoi d'un mail de notification.
         dolibarr_member = dolibarr.get(model='members', sqlfilters="login='{}'".format(num_adherent))[0]
         activate('fr')
@@ -1181,9 +1116,7 @@ def enregistrer_mandat_cotisation(request):
 
     try:
         # Connexion à Dolibarr avec l'utilisateur Anonyme.
-        dolibarr = DolibarrAPI()
-        dolibarr.login(login=settings.APPS_ANONYMOUS_LOGIN,
-                       password=settings.APPS_ANONYMOUS_PASSWORD)
+        dolibarr = anonymous_dolibarr()
         # Mettre à jour l'adhérent dans Dolibarr
         num_adherent = serializer.validated_data['login']
         data = serializer.validated_data
@@ -1353,10 +1286,10 @@ def add_attached_file_to_dolibarr_member(dolibarr, dolibarr_member_rowid, filena
     })
 
 
-def create_cyclos_user(cyclos_token, group, name, login, password=None, pin_code=None):
+def create_cyclos_user(cyclos, group, name, login, password=None, pin_code=None):
     """
     Crée un utilisateur dans Cyclos.
-    :param cyclos_token: token de connexion à Cyclos
+    :param cyclos: connexion à Cyclos (CyclosAPI)
     :param group:
     :param name:
     :param login: numéro d'adhérent
@@ -1364,13 +1297,12 @@ def create_cyclos_user(cyclos_token, group, name, login, password=None, pin_code
     :param pin_code: code PIN de l'utilisateur (optionnel)
     :return: id de l'utilisateur créé
     """
-    cyclos = CyclosAPI()
     # On vérifie si un utilisateur avec ce login existe. Si c'est le cas, on le met à jour, sinon on en crée un nouveau.
     data = {
         'keywords': login,
         'userStatus': ['ACTIVE', 'BLOCKED', 'DISABLED']
     }
-    res = cyclos.post(method='user/search', data=data, token=cyclos_token)
+    res = cyclos.post(method='user/search', data=data)
     if res['result']['totalCount']==1:
         cyclos_user_id = res['result']['pageItems'][0]['id']
         res = cyclos.post(method='user/load', data=cyclos_user_id)
@@ -1388,24 +1320,24 @@ def create_cyclos_user(cyclos_token, group, name, login, password=None, pin_code
             'username': login,
             'skipActivationEmail': True,
         }
-        res = cyclos.post(method='user/register', data=data, token=cyclos_token)
+        res = cyclos.post(method='user/register', data=data)
         cyclos_user_id = res['result']['user']['id']
     # S'il s'agit d'un groupe dans lequel les utilisateurs ont un QR code, il faut générer celui-ci.
     if group in ('adherents_utilisateurs', 'adherents_prestataires', 'adherents_prestataires_avec_paiement_smartphone'):
-        generate_qr_code_for_cyclos_user(cyclos_token, cyclos_user_id, login)
+        generate_qr_code_for_cyclos_user(cyclos, cyclos_user_id, login)
     # Si un mot de passe est fourni, cela signifie que cet utilisateur doit pouvoir se connecter donc il faut l'activer.
     if password:
-        activate_cyclos_user(cyclos_token, cyclos_user_id)
-        change_cyclos_user_password(cyclos_token, cyclos_user_id, password)
+        activate_cyclos_user(cyclos, cyclos_user_id)
+        change_cyclos_user_password(cyclos, cyclos_user_id, password)
     if pin_code:
-        change_cyclos_user_pincode(cyclos_token, cyclos_user_id, pin_code)
+        change_cyclos_user_pincode(cyclos, cyclos_user_id, pin_code)
     return cyclos_user_id
 
 
-def activate_cyclos_user(cyclos_token, cyclos_user_id):
+def activate_cyclos_user(cyclos, cyclos_user_id):
     """
     Activer un utilisateur Cyclos.
-    :param cyclos_token: token de connexion à Cyclos
+    :param cyclos: connexion à Cyclos (CyclosAPI)
     :param user_id: id de l'utilisateur Cyclos
     :return:
     """
@@ -1413,14 +1345,13 @@ def activate_cyclos_user(cyclos_token, cyclos_user_id):
         'user': cyclos_user_id,
         'status': 'ACTIVE',
     }
-    cyclos = CyclosAPI()
-    cyclos.post(method='userStatus/changeStatus', data=data, token=cyclos_token)
+    cyclos.post(method='userStatus/changeStatus', data=data)
 
 
-def change_cyclos_user_password(cyclos_token, cyclos_user_id, password):
+def change_cyclos_user_password(cyclos, cyclos_user_id, password):
     """
     Change le mot de passe d'un utilisateur Cyclos.
-    :param cyclos_token: token de connexion à Cyclos
+    :param cyclos: connexion à Cyclos (CyclosAPI)
     :param user_id: id de l'utilisateur Cyclos
     :param password: nouveau mot de passe de l'utilisateur
     :return:
@@ -1431,14 +1362,13 @@ def change_cyclos_user_password(cyclos_token, cyclos_user_id, password):
         'newPassword': password,
         'confirmNewPassword': password,
     }
-    cyclos = CyclosAPI()
-    cyclos.post(method='password/change', data=data, token=cyclos_token)
+    cyclos.post(method='password/change', data=data)
 
 
-def change_cyclos_user_pincode(cyclos_token, cyclos_user_id, pin_code):
+def change_cyclos_user_pincode(cyclos, cyclos_user_id, pin_code):
     """
     Change le code PIN d'un utilisateur Cyclos.
-    :param cyclos_token: token de connexion à Cyclos
+    :param cyclos: connexion à Cyclos (CyclosAPI)
     :param user_id: id de l'utilisateur Cyclos
     :param pin_code: nouveau code PIN de l'utilisateur
     :return:
@@ -1449,27 +1379,25 @@ def change_cyclos_user_pincode(cyclos_token, cyclos_user_id, pin_code):
         'newPassword': pin_code,
         'confirmNewPassword': pin_code,
     }
-    cyclos = CyclosAPI()
-    cyclos.post(method='password/change', data=data, token=cyclos_token)
+    cyclos.post(method='password/change', data=data)
 
 
-def generate_qr_code_for_cyclos_user(cyclos_token, cyclos_user_id, login):
+def generate_qr_code_for_cyclos_user(cyclos, cyclos_user_id, login):
     """
     Génère un QR code pour un utilisateur Cyclos et active ce QR code.
-    :param cyclos_token: token de connexion à Cyclos
+    :param cyclos: connexion à Cyclos (CyclosAPI)
     :param user_id: id de l'utilisateur Cyclos
     :param login: numéro d'adhérent
     :return:
     """
-    cyclos = CyclosAPI()
     data = {
         'type': 'qr_code',
         'user': cyclos_user_id,
         'value': login,
     }
-    res = cyclos.post(method='token/save', data=data, token=cyclos_token)
+    res = cyclos.post(method='token/save', data=data)
     qr_code_id = res['result']
-    cyclos.post(method='token/activatePending', data=[qr_code_id], token=cyclos_token)
+    cyclos.post(method='token/activatePending', data=[qr_code_id])
 
 
 def create_security_qa(login, question, answer):
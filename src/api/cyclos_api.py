@@ -1,10 +1,16 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import logging
 
 from django.conf import settings
+from django.core.cache import cache
 from rest_framework.exceptions import APIException
 import requests
 
 from auth_token.models import UserProfile
+import backend_timing
+from http_pool import get_session
+from misc import concurrent_map
 
 log = logging.getLogger(__name__)
 
@@ -19,6 +25,26 @@ class CyclosAPILoggedOutException(APIException):
     default_detail = 'Cyclos API LoggedOut Exception'
 
 
+def _group_users_cache_key(groups):
+    return 'cyclos_group_users_{}'.format('_'.join(groups))
+
+
+def _identity_cache_key(kind, value):
+    # kind: 'login' or 'account' for the identities (see CyclosAPI.resolve_account_numbers()), 'member_id' for the
+    # Cyclos id alone (see CyclosAPI.get_member_id_from_login())
+    return 'cyclos_identity_{}_{}'.format(kind, hashlib.sha256(str(value).encode('utf-8')).hexdigest())
+
+
+def _cache_identities(identities):
+    """
+    Store identities in the cache: {cache key: identity, or None if there is no such user}.
+    Users not found are not cached: they may be created at any time.
+    """
+    found = {key: identity for key, identity in identities.items() if identity}
+    if found:
+        cache.set_many(found, settings.CYCLOS_IDENTITY_CACHE_TTL)
+
+
 class CyclosAPI(object):
 
     def __init__(self, **kwargs):
@@ -44,35 +70,52 @@ class CyclosAPI(object):
 
     def _init_bdc(self):
         # getCurrentUser => get ID for current user
-        try:
-            self.user_profile = self.post(method='user/getCurrentUser', data=[])
-            self.user_id = self.user_profile['result']['id']
-        except CyclosAPIException:
-            raise CyclosAPIException(detail='Unable to connect to Cyclos!')
-        except KeyError:
-            raise CyclosAPIException(detail='Unable to fetch Cyclos data! Maybe your credentials are invalid!?')
+        session_state = self._init_current_user()
 
         # user/load for this ID to get field BDC ID
-        self.user_bdc_id = self.get_bdc_id_from_operator_id(self.user_id)
+        if 'user_bdc_id' not in session_state:
+            session_state['user_bdc_id'] = self.get_bdc_id_from_operator_id(self.user_id)
+            self._set_session_state(session_state)
+        self.user_bdc_id = session_state['user_bdc_id']
 
     def _init_cel(self):
-        try:
-            self.user_profile = self.post(method='user/getCurrentUser', data=[])
-            self.user_id = self.user_profile['result']['id']
-        except CyclosAPIException:
-            raise CyclosAPIException(detail='Unable to connect to Cyclos!')
-        except KeyError:
-            raise CyclosAPIException(detail='Unable to fetch Cyclos data! Maybe your credentials are invalid!?')
+        self._init_current_user()
 
     def _init_gi(self):
         # getCurrentUser => get ID for current user
-        try:
-            self.user_profile = self.post(method='user/getCurrentUser', data=[])
-            self.user_id = self.user_profile['result']['id']
-        except CyclosAPIException:
-            raise CyclosAPIException(detail='Unable to connect to Cyclos!')
-        except KeyError:
-            raise CyclosAPIException(detail='Unable to fetch Cyclos data! Maybe your credentials are invalid!?')
+        self._init_current_user()
+
+    def _init_current_user(self):
+        """
+        Set user_profile and user_id for the current token.
+
+        The result of user/getCurrentUser is cached per token (see CYCLOS_SESSION_CACHE_TTL), so we only call Cyclos
+        the first time a token is used. Returns the cached session state, which callers can complete and save back.
+        """
+        session_state = self._get_session_state()
+        if 'user_profile' not in session_state:
+            try:
+                session_state['user_profile'] = self.post(method='user/getCurrentUser', data=[])
+                session_state['user_id'] = session_state['user_profile']['result']['id']
+            except CyclosAPIException:
+                raise CyclosAPIException(detail='Unable to connect to Cyclos!')
+            except KeyError:
+                raise CyclosAPIException(detail='Unable to fetch Cyclos data! Maybe your credentials are invalid!?')
+            self._set_session_state(session_state)
+
+        self.user_profile = session_state['user_profile']
+        self.user_id = session_state['user_id']
+        return session_state
+
+    def get_current_user_group_id(self):
+        """
+        Return the id of the group of the current user, kept in the session state like the user profile.
+        """
+        session_state = self._init_current_user()
+        if 'group_id' not in session_state:
+            session_state['group_id'] = str(self.post(method='user/load', data=self.user_id)['result']['group']['id'])
+            self._set_session_state(session_state)
+        return session_state['group_id']
 
     def _init_gi_bdc(self):
         # get ID for login_bdc
@@ -83,7 +126,7 @@ class CyclosAPI(object):
 
     def login(self, auth_string):
         """Login function to get Cyclos token."""
-        r = requests.post('{}/login/login'.format(self.url),
+        r = self._request('post', '{}/login/login'.format(self.url),
                           headers=self._handle_auth_headers(auth_string=auth_string))
 
         json_response = r.json()
@@ -102,7 +145,7 @@ class CyclosAPI(object):
 
     def refresh_token(self):
         """Refresh Cyclos token."""
-        r = requests.post('{}/login/replaceSession'.format(self.url), headers=self._handle_auth_headers())
+        r = self._request('post', '{}/login/replaceSession'.format(self.url), headers=self._handle_auth_headers())
 
         json_response = r.json()
 
@@ -114,6 +157,7 @@ class CyclosAPI(object):
                 user_profile.cyclos_token = cyclos_token
                 user_profile.save()
 
+                self._invalidate_session_state()
                 self._handle_token(cyclos_token)
 
             except KeyError:
@@ -129,6 +173,16 @@ class CyclosAPI(object):
         if token:
             self._handle_token(token)
 
+        # The Cyclos id of a member never changes: it is kept in the cache, apart from the identities (see
+        # resolve_account_numbers()) which must always hold the account number.
+        key = _identity_cache_key('member_id', member_login)
+        identity_key = _identity_cache_key('login', member_login)
+        cached = cache.get_many([key, identity_key])
+        if cached.get(key):
+            return cached[key]
+        if cached.get(identity_key):
+            return cached[identity_key]['id']
+
         query_data = {
             'keywords': member_login,
             'userStatus': ['ACTIVE', 'BLOCKED', 'DISABLED']
@@ -137,14 +191,108 @@ class CyclosAPI(object):
             member_login_search = self.post(method='user/search', data=query_data)
             if member_login_search['result']['totalCount'] > 1:
                 raise CyclosAPIException(detail='More than one member found!')
-            member_cyclos_id = member_login_search['result']['pageItems'][0]['id']
+            member = member_login_search['result']['pageItems'][0]
+            member_cyclos_id = member['id']
         except CyclosAPIException:
             raise CyclosAPIException(detail='Unable to connect to Cyclos!')
-        except (KeyError, IndexError):
+        except IndexError:
+            raise CyclosAPIException(detail='Unable to fetch Cyclos data! Maybe your credentials are invalid!?')
+        except KeyError:
             raise CyclosAPIException(detail='Unable to fetch Cyclos data! Maybe your credentials are invalid!?')
 
+        cache.set(key, member_cyclos_id, settings.CYCLOS_IDENTITY_CACHE_TTL)
         return member_cyclos_id
 
+    def warm_up_member_ids(self, member_logins):
+        """
+        Resolve concurrently the Cyclos ids of the members that are not in the cache yet, so that the following calls
+        to get_member_id_from_login() don't have to search Cyclos. Errors are ignored here: they will be raised by
+        get_member_id_from_login().
+        """
+        member_logins = list(set(member_logins))
+        cached = cache.get_many([_identity_cache_key(kind, login)
+                                 for login in member_logins for kind in ('member_id', 'login')])
+        missing = [login for login in member_logins
+                   if _identity_cache_key('member_id', login) not in cached and
+                   _identity_cache_key('login', login) not in cached]
+
+        def resolve(member_login):
+            try:
+                self.get_member_id_from_login(member_login)
+            except CyclosAPIException:
+                pass
+
+        concurrent_map(resolve, missing)
+
+    def _search_account_number(self, account_number):
+        data = self.post(method='user/search', data={'keywords': account_number})
+        try:
+            item = data['result']['pageItems'][0]
+        except IndexError:
+            return None
+        user = self.post(method='user/load', data=item['id'])['result']
+        return {
+            'id': user['id'],
+            'display': item['display'],
+            'name': user['name'],
+            'username': user['username'],
+            'account_number': account_number,
+        }
+
+    def resolve_account_numbers(self, account_numbers):
+        """
+        Find the users who own the given account numbers.
+
+        Returns a dict: account number -> {'id', 'display', 'name', 'username', 'account_number'}, or None if there is
+        no such account. These identities are shared by all the API users through the Django cache (see
+        CYCLOS_IDENTITY_CACHE_TTL and invalidate_identity()). The account numbers that are not in the cache are resolved
+        concurrently.
+
+        Each identity is cached by account number and by login. An identity cached by account number is only used while
+        the identity cached by login is still there, with the same account number: invalidate_identity() only has to
+        drop the latter, even if the cache has evicted one of them.
+        """
+        account_numbers = list(set(account_numbers))
+        keys = {account_number: _identity_cache_key('account', account_number) for account_number in account_numbers}
+        cached = cache.get_many(list(keys.values()))
+        by_login = cache.get_many([_identity_cache_key('login', identity['username']) for identity in cached.values()])
+        for account_number, key in keys.items():
+            identity = cached.get(key)
+            if identity:
+                by_login_identity = by_login.get(_identity_cache_key('login', identity['username']))
+                if not by_login_identity or by_login_identity.get('account_number') != account_number:
+                    del cached[key]
+        missing = [account_number for account_number in account_numbers if not cached.get(keys[account_number])]
+
+        identities = {keys[account_number]: identity
+                      for account_number, identity in zip(missing,
+                                                          concurrent_map(self._search_account_number, missing))}
+        # The login of the member gives the same Cyclos id.
+        identities.update({_identity_cache_key('login', identity['username']): identity
+                           for identity in identities.values() if identity})
+        _cache_identities(identities)
+        cached.update(identities)
+
+        return {account_number: cached[keys[account_number]] or None for account_number in account_numbers}
+
+    def resolve_account_number(self, account_number):
+        """
+        Find the user who owns this account number (see resolve_account_numbers()), None if there is no such account.
+        """
+        return self.resolve_account_numbers([account_number])[account_number]
+
+    @staticmethod
+    def invalidate_identity(member_login):
+        """
+        Forget the cached identity of a member (by login and by account number), after their name may have changed.
+        """
+        key = _identity_cache_key('login', member_login)
+        identity = cache.get(key)
+        keys = [key]
+        if identity and identity.get('account_number'):
+            keys.append(_identity_cache_key('account', identity['account_number']))
+        cache.delete_many(keys)
+
     def get_bdc_id_from_operator_id(self, operator_id):
         """
         user/load for this ID to get field BDC ID
@@ -160,6 +308,137 @@ class CyclosAPI(object):
         except (KeyError, IndexError):
             raise CyclosAPIException(detail='Unable to fetch Cyclos data! Maybe your credentials are invalid!?')
 
+    def load_users(self, user_ids):
+        """
+        user/load for several users at once.
+
+        The ids are deduplicated and the users are loaded concurrently.
+        Returns a dict: user id -> user data (the 'result' part of the user/load response).
+        """
+        user_ids = list(set(user_ids))
+        results = concurrent_map(lambda user_id: self.post(method='user/load', data=[user_id])['result'], user_ids)
+        return dict(zip(user_ids, results))
+
+    def _iter_search_pages(self, method, data, page_size=1000):
+        """
+        Yield the 'result' part of each page of a paginated search (user/search, account/searchAccountHistory...).
+
+        While the caller is busy with a page, the next one is already being fetched in a background thread. If the
+        caller stops before the end, the page being fetched is simply discarded.
+        """
+        def search_page(current_page):
+            page_data = dict(data, pageSize=page_size, currentPage=current_page)
+            return self.post(method=method, data=page_data)['result']
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            current_page = 0
+            future = executor.submit(backend_timing.bind(search_page), current_page)
+            while future is not None:
+                page = future.result()
+                current_page += 1
+                if 'pageCount' in page:
+                    has_next_page = current_page < page['pageCount']
+                else:
+                    has_next_page = len(page['pageItems']) == page_size
+                future = executor.submit(backend_timing.bind(search_page), current_page) if has_next_page else None
+                yield page
+        finally:
+            if future is not None:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def iter_search(self, method, data, page_size=1000):
+        """
+        Iterate lazily over the results of a paginated search, page after page (maximum pageSize: 1000).
+
+        `data` is the search query, without pageSize and currentPage.
+        """
+        for page in self._iter_search_pages(method, data, page_size):
+            yield from page['pageItems']
+
+    def search_all(self, method, data, page_size=1000):
+        """
+        Same response as a post() of the search, but pageItems contains the results of all the pages.
+        """
+        pages = self._iter_search_pages(method, data, page_size)
+        result = dict(next(pages))
+        result['pageItems'] = list(result['pageItems'])
+        for page in pages:
+            result['pageItems'].extend(page['pageItems'])
+        return {'result': result}
+
+    def user_choices(self, items):
+        """
+        Convert user/search results to {'label': name, 'value': id, 'shortLabel': username}.
+
+        Users are loaded (concurrently) only if the search results don't include their name and username.
+        """
+        items = list(items)
+        loaded_users = self.load_users([item['id'] for item in items if 'name' not in item or 'username' not in item])
+        users = []
+        for item in items:
+            user = loaded_users.get(item['id'], item)
+            users.append({'label': user['name'], 'value': user['id'], 'shortLabel': user['username']})
+        return users
+
+    def get_group_users(self, groups, user_statuses=None, token=None):
+        """
+        List the users of the given groups, as {'label': name, 'value': id, 'shortLabel': username}.
+
+        The list is built from a user/search (all its pages), and shared by all the API users through the Django cache
+        for CYCLOS_DIRECTORY_CACHE_TTL seconds.
+        """
+        if token:
+            self._handle_token(token)
+
+        groups = sorted(str(group) for group in groups)
+        user_statuses = sorted(user_statuses) if user_statuses else []
+        key = _group_users_cache_key(groups)
+        directory = cache.get(key) or {}
+        statuses_key = ','.join(user_statuses)
+        if statuses_key in directory:
+            return directory[statuses_key]
+
+        query_data = {'groups': groups}
+        if user_statuses:
+            query_data['userStatus'] = user_statuses
+        users = self.user_choices(self.iter_search(method='user/search', data=query_data))
+
+        directory[statuses_key] = users
+        cache.set(key, directory, settings.CYCLOS_DIRECTORY_CACHE_TTL)
+        return users
+
+    @staticmethod
+    def invalidate_group_users(groups):
+        """
+        Forget the cached list of users of the given groups, after users have been added to or removed from them.
+        """
+        cache.delete(_group_users_cache_key(sorted(str(group) for group in groups)))
+
+    def _session_cache_key(self):
+        token = getattr(self, 'token', None)
+        if not token:
+            return None
+        # We don't want to store the token itself in the cache keys.
+        return 'cyclos_session_{}'.format(hashlib.sha256(token.encode('utf-8')).hexdigest())
+
+    def _get_session_state(self):
+        key = self._session_cache_key()
+        if key is None:
+            return {}
+        return cache.get(key) or {}
+
+    def _set_session_state(self, session_state):
+        key = self._session_cache_key()
+        if key is not None:
+            cache.set(key, session_state, settings.CYCLOS_SESSION_CACHE_TTL)
+
+    def _invalidate_session_state(self):
+        key = self._session_cache_key()
+        if key is not None:
+            cache.delete(key)
+
     def _handle_token(self, token):
         log.debug(token)
         self.token = token
@@ -180,6 +459,14 @@ class CyclosAPI(object):
 
         return headers
 
+    def _request(self, http_method, url, **kwargs):
+        """
+        Send an HTTP request to Cyclos, through the connection pool shared by all CyclosAPI instances.
+        """
+        session = get_session('cyclos', settings.CYCLOS_POOL_SIZE)
+        with backend_timing.timed('cyclos', backend_timing.endpoint_name(self.url, url)):
+            return session.request(http_method, url, timeout=settings.CYCLOS_TIMEOUT, **kwargs)
+
     def _handle_api_response(self, api_response):
         """ In some cases, we have to deal with errors in the response from the cyclos api !
         """
@@ -189,6 +476,7 @@ class CyclosAPI(object):
             try:
                 response_data = api_response.json()
                 if response_data['errorCode'] == 'LOGGED_OUT':
+                    self._invalidate_session_state()
                     raise CyclosAPILoggedOutException(response_data['errorCode'])
             except CyclosAPILoggedOutException:
                 raise
@@ -216,7 +504,7 @@ class CyclosAPI(object):
         for key, value in kwargs.items():
             query = "{}&{}={}".format(query, key, value)
 
-        r = requests.get(query, headers=self._handle_auth_headers())
+        r = self._request('get', query, headers=self._handle_auth_headers())
 
         return self._handle_api_response(r)
 
@@ -229,7 +517,7 @@ class CyclosAPI(object):
         else:
             query = '{}/{}'.format(self.url, method)
 
-        r = requests.post(query, json=data, headers=self._handle_auth_headers({}))
+        r = self._request('post', query, json=data, headers=self._handle_auth_headers({}))
 
         return self._handle_api_response(r)
 
@@ -242,7 +530,7 @@ class CyclosAPI(object):
         else:
             query = '{}/{}'.format(self.url, method)
 
-        r = requests.patch(query, json=data, headers=self._handle_auth_headers())
+        r = self._request('patch', query, json=data, headers=self._handle_auth_headers())
 
         return self._handle_api_response(r)
 
@@ -255,6 +543,6 @@ class CyclosAPI(object):
         else:
             query = '{}/{}'.format(self.url, method)
 
-        r = requests.delete(query, headers=self._handle_auth_headers())
+        r = self._request('delete', query, headers=self._handle_auth_headers())
 
         return self._handle_api_response(r)
@@ -5,6 +5,9 @@ from django.conf import settings
 from rest_framework.exceptions import APIException
 import requests
 
+import backend_timing
+from http_pool import get_session
+
 log = logging.getLogger()
 
 
@@ -42,6 +45,33 @@ class DolibarrAPI(object):
         log.info("response_data for {} - {}: {}".format(api_response.request.method, api_response.url, response_data))
         return response_data
 
+    def get_members_by_logins(self, logins, chunk_size=100):
+        """
+        Load several members at once, using a few 'login IN (...)' queries instead of one query per member.
+
+        Returns a dict: login -> member data. Logins that don't exist in Dolibarr are simply missing from the result.
+        """
+        logins = sorted(set(logins))
+        members = {}
+        for i in range(0, len(logins), chunk_size):
+            chunk = logins[i:i + chunk_size]
+            sqlfilters = "login IN ({})".format(','.join("'{}'".format(login) for login in chunk))
+            try:
+                results = self.get(model='members', sqlfilters=sqlfilters, limit='0')
+            except DolibarrAPIException:
+                # Dolibarr returns an error (404) when no member matches the query.
+                continue
+            members.update({member['login']: member for member in results})
+        return members
+
+    def _request(self, http_method, url, **kwargs):
+        """
+        Send an HTTP request to Dolibarr, through the connection pool shared by all DolibarrAPI instances.
+        """
+        session = get_session('dolibarr', settings.DOLIBARR_POOL_SIZE)
+        with backend_timing.timed('dolibarr', backend_timing.endpoint_name(self.url, url)):
+            return session.request(http_method, url, timeout=settings.DOLIBARR_TIMEOUT, **kwargs)
+
     def login(self, login=None, password=None, reset=None):
         """ Login function for Dolibarr API users.
         """
@@ -50,7 +80,7 @@ class DolibarrAPI(object):
         if reset:
             query = '{}&reset=1'.format(query)
 
-        r = requests.get(query, headers={'Content-Type': 'application/json'})
+        r = self._request('get', query, headers={'Content-Type': 'application/json'})
 
         json_response = r.json()
         if r.status_code == requests.codes.ok:
@@ -83,7 +113,7 @@ class DolibarrAPI(object):
         for key, value in kwargs.items():
             query = "{}&{}={}".format(query, key, value)
 
-        r = requests.get(query, headers={'Content-Type': 'application/json'})
+        r = self._request('get', query, headers={'Content-Type': 'application/json'})
 
         return self._handle_api_response(r)
 
@@ -96,7 +126,7 @@ class DolibarrAPI(object):
         else:
             query = '{}/{}?api_key={}'.format(self.url, model, self.api_key)
 
-        r = requests.post(query, json=data, headers={'Content-Type': 'application/json'})
+        r = self._request('post', query, json=data, headers={'Content-Type': 'application/json'})
 
         return self._handle_api_response(r)
 
@@ -109,7 +139,7 @@ class DolibarrAPI(object):
         else:
             query = '{}/{}?api_key={}'.format(self.url, model, self.api_key)
 
-        r = requests.put(query, json=data, headers={'Content-Type': 'application/json'})
+        r = self._request('put', query, json=data, headers={'Content-Type': 'application/json'})
 
         return self._handle_api_response(r)
 
@@ -122,7 +152,7 @@ class DolibarrAPI(object):
         else:
             query = '{}/{}?api_key={}'.format(self.url, model, self.api_key)
 
-        r = requests.patch(query, json=data, headers={'Content-Type': 'application/json'})
+        r = self._request('patch', query, json=data, headers={'Content-Type': 'application/json'})
 
         return self._handle_api_response(r)
 
@@ -135,6 +165,6 @@ class DolibarrAPI(object):
         else:
             query = '{}/{}?api_key={}'.format(self.url, model, self.api_key)
 
-        r = requests.delete(query, headers={'Content-Type': 'application/json'})
+        r = self._request('delete', query, headers={'Content-Type': 'application/json'})
 
         return self._handle_api_response(r)
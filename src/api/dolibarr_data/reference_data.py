@@ -0,0 +1,94 @@
+"""
+Cache for the reference data we get from Dolibarr (countries, towns, associations).
+
+This data almost never changes, so it is kept in the Django cache and shared by all the API users. Each kind of data
+has its own TTL (see DOLIBARR_REFERENCE_DATA_TTL). Once the TTL has expired, the cached data is still served for the
+same amount of time while it is refreshed in a background thread, so clients never wait for Dolibarr except the very
+first time.
+
+An ETag is computed for each piece of data, so that clients can use If-None-Match and get a 304 Not Modified.
+"""
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework import status
+from rest_framework.response import Response
+
+from service_sessions import anonymous_dolibarr
+
+log = logging.getLogger()
+
+
+def _cache_key(name, *args):
+    key = '{}_{}'.format(name, '_'.join(str(arg) for arg in args))
+    return 'dolibarr_reference_data_{}'.format(hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+
+def _etag(data):
+    return '"{}"'.format(hashlib.sha256(json.dumps(data, sort_keys=True).encode('utf-8')).hexdigest())
+
+
+def _store(key, ttl, data):
+    entry = {'data': data, 'etag': _etag(data), 'fresh_until': time.time() + ttl}
+    # The entry is kept twice as long as its TTL, so that it can be served while it is being refreshed.
+    cache.set(key, entry, 2 * ttl)
+    return entry
+
+
+def _refresh_in_background(key, ttl, fetch):
+    # Only one refresh at a time for a given key (cache.add() is atomic).
+    if not cache.add('{}_refreshing'.format(key), True, ttl):
+        return
+
+    def refresh():
+        try:
+            _store(key, ttl, fetch(anonymous_dolibarr()))
+        except Exception:
+            log.exception("Unable to refresh reference data {}".format(key))
+        finally:
+            cache.delete('{}_refreshing'.format(key))
+
+    threading.Thread(target=refresh, daemon=True).start()
+
+
+def get_reference_data(name, args, fetch, dolibarr=None):
+    """
+    Return the entry {'data': ..., 'etag': ...} for the given kind of data (`name`) and arguments.
+
+    `fetch` is a function which takes a DolibarrAPI instance and returns the data. `dolibarr` is used to fetch the data
+    if it is not in the cache; if it is not given, we log in as the anonymous user. Background refreshes are always
+    done as the anonymous user.
+    """
+    ttl = settings.DOLIBARR_REFERENCE_DATA_TTL[name]
+    key = _cache_key(name, *args)
+    entry = cache.get(key)
+    if entry is None:
+        return _store(key, ttl, fetch(dolibarr or anonymous_dolibarr()))
+    if entry['fresh_until'] < time.time():
+        _refresh_in_background(key, ttl, fetch)
+    return entry
+
+
+def reference_data_response(request, entry, data=None):
+    """
+    Build the response for a reference data entry, with its ETag.
+    Returns 304 Not Modified if the client already has this version of the data.
+
+    `data` can be given when the view filters the cached data: the ETag is then computed for the filtered data.
+    """
+    if data is None:
+        data, etag = entry['data'], entry['etag']
+    else:
+        etag = _etag(data)
+
+    if etag in [tag.strip() for tag in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]:
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        response = Response(data)
+    response['ETag'] = etag
+    return response
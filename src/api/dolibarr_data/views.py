@@ -11,6 +11,8 @@ from rest_framework.response import Response
 
 from dolibarr_api import DolibarrAPI, DolibarrAPIException
 from dolibarr_data import serializers
+from dolibarr_data.reference_data import get_reference_data, reference_data_response
+from service_sessions import anonymous_dolibarr
 
 log = logging.getLogger('console')
 
@@ -32,10 +34,8 @@ def login(request):
             validate_email(request.data['username'])
 
             # we detected that our "username" variable is an email, we try to connect to dolibarr with it
-            dolibarr_anonymous_token = dolibarr.login(login=settings.APPS_ANONYMOUS_LOGIN,
-                                                      password=settings.APPS_ANONYMOUS_PASSWORD)
-            user_results = dolibarr.get(model='members', sqlfilters="email='{}' and statut=1".format(request.data['username']),
-                                        api_key=dolibarr_anonymous_token)
+            user_results = anonymous_dolibarr().get(
+                model='members', sqlfilters="email='{}' and statut=1".format(request.data['username']))
             user_data = [item
                          for item in user_results
                          if item['email'] == request.data['username']][0]
@@ -132,27 +132,37 @@ def get_usergroups(request):
     return Response(dolibarr.get(model='users/{}/groups'.format(user_id)))
 
 
+def _get_dolibarr(request):
+    """
+    Dolibarr client for the current user, or None for anonymous users (the reference data cache then logs in as the
+    anonymous user, only if needed).
+    """
+    if request.user.is_authenticated:
+        return DolibarrAPI(api_key=request.user.profile.dolibarr_token)
+    return None
+
+
+def _fetch_associations(dolibarr):
+    associations = dolibarr.get(model='associations')
+    associations.sort(key=lambda a: a['nom'])
+    return associations
+
+
 @api_view(['GET'])
 @permission_classes((AllowAny, ))
 def associations(request):
     """
     List all associations, and if you want, you can filter them.
     """
-    if request.user.is_authenticated:
-        dolibarr = DolibarrAPI(api_key=request.user.profile.dolibarr_token)
-    else:
-        dolibarr = DolibarrAPI()
-        dolibarr.login(login=settings.APPS_ANONYMOUS_LOGIN,
-                       password=settings.APPS_ANONYMOUS_PASSWORD)
-    associations = dolibarr.get(model='associations')
-    associations.sort(key=lambda a: a['nom'])
+    entry = get_reference_data('associations', [], _fetch_associations, _get_dolibarr(request))
     approved = request.GET.get('approved', '')
     if approved:
         # We want to filter out the associations that doesn't have the required sponsorships
         associations = [asso
-                        for asso in associations
+                        for asso in entry['data']
                         if int(asso['nb_parrains']) >= settings.MINIMUM_PARRAINAGES_3_POURCENTS]
-    return Response(associations)
+        return reference_data_response(request, entry, associations)
+    return reference_data_response(request, entry)
 
 
 @api_view(['GET'])
@@ -165,27 +175,13 @@ def towns_by_zipcode(request):
     if not search:
         return Response({'error': 'Zipcode must not be empty'}, status=status.HTTP_400_BAD_REQUEST)
 
-    if request.user.is_authenticated:
-        dolibarr = DolibarrAPI(api_key=request.user.profile.dolibarr_token)
-    else:
-        dolibarr = DolibarrAPI()
-        dolibarr.login(login=settings.APPS_ANONYMOUS_LOGIN,
-                       password=settings.APPS_ANONYMOUS_PASSWORD)
-    return Response(dolibarr.get(model='setup/dictionary/towns', zipcode=search))
+    entry = get_reference_data('towns', [search],
+                               lambda dolibarr: dolibarr.get(model='setup/dictionary/towns', zipcode=search),
+                               _get_dolibarr(request))
+    return reference_data_response(request, entry)
 
 
-@api_view(['GET'])
-@permission_classes((AllowAny, ))
-def countries(request):
-    """
-    Get the list of countries.
-    """
-    if request.user.is_authenticated:
-        dolibarr = DolibarrAPI(api_key=request.user.profile.dolibarr_token)
-    else:
-        dolibarr = DolibarrAPI()
-        dolibarr.login(login=settings.APPS_ANONYMOUS_LOGIN,
-                       password=settings.APPS_ANONYMOUS_PASSWORD)
+def _fetch_countries(dolibarr):
     # On récupère la liste de tous les pays indiqués comme actifs dans
     # Dolibarr, on ne garde que l'identifiant et le nom de chaque pays,
     # et on trie la liste par ordre alphabétique, à l'exception de la
@@ -195,7 +191,17 @@ def countries(request):
     countries = [{'id': c['id'], 'label': c['label']} for c in countries if c['label'] != 'France']
     countries.sort(key=lambda c: c['label'])
     countries.insert(0, {'id': france_id, 'label': 'France'})
-    return Response(countries)
+    return countries
+
+
+@api_view(['GET'])
+@permission_classes((AllowAny, ))
+def countries(request):
+    """
+    Get the list of countries.
+    """
+    entry = get_reference_data('countries', [], _fetch_countries, _get_dolibarr(request))
+    return reference_data_response(request, entry)
 
 
 @api_view(['GET'])
@@ -31,10 +31,10 @@ def porteurs_eusko(request):
         return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
 
     # user/search for group = 'Porteurs'
-    porteurs_data = cyclos.post(method='user/search',
-                                data={'groups': [settings.CYCLOS_CONSTANTS['groups']['porteurs']]})
+    porteurs_data = cyclos.iter_search(method='user/search',
+                                       data={'groups': [settings.CYCLOS_CONSTANTS['groups']['porteurs']]})
     res = [{'label': item['display'], 'value': item['id']}
-           for item in porteurs_data['result']['pageItems']]
+           for item in porteurs_data]
 
     return Response(res)
 
@@ -50,12 +50,6 @@ def deposit_banks(request):
         return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
 
     # user/search for group = 'Banques de dépot'
-    banks_data = cyclos.post(method='user/search',
-                             data={'groups': [settings.CYCLOS_CONSTANTS['groups']['banques_de_depot']]})
-    banks_ids = [ item['id'] for item in banks_data['result']['pageItems'] ]
-    res = []
-    for bank_id in banks_ids:
-        cyclos_user = cyclos.post(method='user/load', data=[bank_id])['result']
-        res.append({'label': cyclos_user['name'], 'value': cyclos_user['id'], 'shortLabel': cyclos_user['username']})
+    res = cyclos.get_group_users(groups=[settings.CYCLOS_CONSTANTS['groups']['banques_de_depot']])
 
     return Response(res)
@@ -0,0 +1,108 @@
+"""
+Soldes des comptes Cyclos à une date passée.
+
+Le relevé de compte (cel.views.export_history_adherent et les relevés mensuels) a besoin du solde au début de la
+période, et la liste des paiements (cel.views.payments_available_for_adherents) du solde à la fin de la période. Cyclos
+calcule ces soldes (account/getAccountsSummary) en rejouant l'historique du compte, ce qui est coûteux.
+
+Le solde d'un compte à la fin d'une journée terminée ne change plus : on l'enregistre dans la table BalanceSnapshot au
+fur et à mesure des demandes, et on ne le redemande plus à Cyclos. Quand la copie locale de l'historique (voir
+gestioninterne/ledger.py) couvre la période qui suit le dernier solde enregistré, le solde est calculé localement, en
+ajoutant à ce solde les montants des lignes de l'historique. Les relevés mensuels enregistrent aussi le solde de fin de
+mois qu'ils ont calculé.
+
+Le solde de la journée en cours est toujours demandé à Cyclos.
+"""
+from datetime import timedelta
+from decimal import Decimal
+import json
+import logging
+
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+
+from gestioninterne.ledger import parse_cyclos_datetime
+from gestioninterne.models import AccountHistoryEntry, AccountHistorySync, BalanceSnapshot
+
+log = logging.getLogger()
+
+
+def _end_of_day(day):
+    return parse_cyclos_datetime((day + timedelta(days=1)).isoformat())
+
+
+def summary_with_balance(summary, balance):
+    """
+    Copie du résumé d'un compte avec un autre solde.
+    Les autres montants du statut (solde disponible, montant réservé, etc.) ne sont pas recalculés : on les retire.
+    """
+    return dict(summary, status={'accountId': summary['status']['accountId'], 'balance': str(balance)})
+
+
+def record_balances(owner, day, summaries):
+    """
+    Enregistre les soldes des comptes du titulaire à la fin de la journée `day`, si elle est terminée.
+    `summaries` est la liste renvoyée par account/getAccountsSummary pour le lendemain à zéro heure.
+    """
+    if not settings.BALANCE_SNAPSHOTS_ENABLED or day >= timezone.localdate():
+        return
+    # ignore_conflicts : une autre requête peut être en train d'enregistrer les mêmes soldes.
+    BalanceSnapshot.objects.bulk_create([
+        BalanceSnapshot(owner=str(owner), account=str(summary['status']['accountId']), date=day,
+                        balance=Decimal(str(summary['status']['balance'])), data=json.dumps(summary))
+        for summary in summaries
+    ], ignore_conflicts=True)
+
+
+def _from_ledger(owner, day):
+    """
+    Calcule les soldes à la fin de la journée à partir des derniers soldes enregistrés avant cette journée et de la
+    copie locale de l'historique, ou renvoie None si cette copie ne couvre pas toute la période.
+    """
+    if not settings.CYCLOS_LEDGER_ENABLED:
+        return None
+    previous = BalanceSnapshot.objects.filter(owner=str(owner), date__lt=day).order_by('-date').first()
+    if previous is None:
+        return None
+    snapshots = list(BalanceSnapshot.objects.filter(owner=str(owner), date=previous.date).order_by('pk'))
+    accounts = [snapshot.account for snapshot in snapshots]
+    begin = _end_of_day(previous.date)
+    end = _end_of_day(day)
+
+    # Les paiements enregistrés dans Cyclos pendant une synchronisation ne sont recopiés que par la suivante (voir
+    # CYCLOS_LEDGER_OVERLAP) : la copie doit aller au-delà de la fin de la journée.
+    synced_until = end + timedelta(seconds=settings.CYCLOS_LEDGER_OVERLAP)
+    synced = AccountHistorySync.objects.filter(account__in=accounts, synced_from__lte=begin,
+                                               synced_until__gte=synced_until)
+    if synced.count() < len(accounts):
+        return None
+
+    totals = dict(AccountHistoryEntry.objects.filter(account__in=accounts, date__gte=begin, date__lt=end)
+                  .values('account').annotate(total=Sum('amount')).values_list('account', 'total'))
+    return [summary_with_balance(json.loads(snapshot.data), snapshot.balance + (totals.get(snapshot.account) or 0))
+            for snapshot in snapshots]
+
+
+def accounts_summary(cyclos, owner, day):
+    """
+    Résumé des comptes du titulaire au jour `day` à zéro heure (donc à la fin de la veille), tel que renvoyé par
+    account/getAccountsSummary : pour chaque compte, son numéro, son titulaire et son statut (id et solde du compte).
+    """
+    previous_day = day - timedelta(days=1)
+    if not settings.BALANCE_SNAPSHOTS_ENABLED or previous_day >= timezone.localdate():
+        return cyclos.post(method='account/getAccountsSummary', data=[owner, day.isoformat()])['result']
+
+    summaries = [json.loads(data) for data in BalanceSnapshot.objects.filter(
+        owner=str(owner), date=previous_day).order_by('pk').values_list('data', flat=True)]
+    if summaries:
+        return summaries
+
+    summaries = _from_ledger(owner, previous_day)
+    if summaries is None:
+        summaries = cyclos.post(method='account/getAccountsSummary', data=[owner, day.isoformat()])['result']
+    else:
+        log.debug("accounts_summary: balances of {} on {} computed from the local account history".format(
+            owner, previous_day))
+    record_balances(owner, previous_day, summaries)
+    return summaries
@@ -1,24 +1,98 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import csv
-from datetime import datetime
+from datetime import datetime, timedelta
 import io
+from itertools import islice
 import logging
+from uuid import uuid4
 
 from django.conf import settings
-from django.db import IntegrityError
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection
 from django.db.models import Q
 from django.forms.models import model_to_dict
+from django.utils import timezone
 from django.utils.text import slugify
 from rest_framework import status
 from rest_framework.decorators import api_view, parser_classes
 from rest_framework.parsers import FileUploadParser
 from rest_framework.response import Response
 
+import backend_timing
 from cyclos_api import CyclosAPI, CyclosAPIException
 from gestioninterne import models, serializers
 
 log = logging.getLogger()
 
 
+# Nombre de lignes du fichier importées à la fois.
+IMPORT_BATCH_SIZE = 1000
+
+# Champs de Echeance remplis à partir du fichier, qui sont validés avant l'insertion en base.
+IMPORTED_FIELDS = ('ref', 'adherent_name', 'adherent_id', 'montant', 'date')
+
+
+def _echeance_from_row(row):
+    echeance = models.Echeance(
+        ref=row['reference'],
+        adherent_name=row['debiteur'],
+        adherent_id=row['code'],
+        montant=float(row['montant'].replace(',', '.').strip(' €').replace(' ', '')),
+        date=datetime.strptime(row['date-execution'], '%d/%m/%Y %H:%M:%S'),
+        operation_date=None)
+    # Les lignes sont insérées par lots : on vérifie ici ce qui ferait échouer l'insertion (longueur des champs,
+    # nombre de chiffres du montant...).
+    for name in IMPORTED_FIELDS:
+        field = models.Echeance._meta.get_field(name)
+        try:
+            field.clean(getattr(echeance, name), echeance)
+        except ValidationError as e:
+            raise ValueError('{}: {}'.format(name, ' '.join(e.messages)))
+    return echeance
+
+
+def _import_rows(rows, res):
+    """
+    Importe un lot de lignes du fichier et complète le résumé de l'import (res).
+    Les échéances dont la référence est déjà en base (ou déjà plus haut dans le fichier) sont ignorées.
+    """
+    echeances = OrderedDict()
+    for row in rows:
+        try:
+            echeance = _echeance_from_row(row)
+        except Exception as e:
+            echeance_dict = {
+                'ref': row.get('reference'),
+                'adherent_name': row.get('debiteur'),
+                'adherent_id': row.get('code'),
+                'montant': row.get('montant'),
+                'date': row.get('date-execution'),
+                'operation_date': '',
+                'error': str(e),
+            }
+            res['errors'].append(echeance_dict)
+            continue
+        if echeance.ref in echeances:
+            res['ignore'] += 1
+        else:
+            echeances[echeance.ref] = echeance
+
+    existing_refs = set(models.Echeance.objects.filter(ref__in=echeances.keys()).values_list('ref', flat=True))
+    res['ignore'] += len(existing_refs)
+    new_echeances = [echeance for ref, echeance in echeances.items() if ref not in existing_refs]
+    # ignore_conflicts : un autre import peut être en train d'enregistrer les mêmes échéances.
+    models.Echeance.objects.bulk_create(new_echeances, ignore_conflicts=True)
+
+    # bulk_create() ne renseigne pas les clés primaires avec tous les SGBD, on les relit.
+    ids = dict(models.Echeance.objects.filter(
+        ref__in=[echeance.ref for echeance in new_echeances]).values_list('ref', 'id'))
+    for echeance in new_echeances:
+        echeance.id = ids.get(echeance.ref)
+        res['ok'].append(model_to_dict(echeance))
+
+
 @api_view(['POST'])
 @parser_classes((FileUploadParser,))
 def import_csv(request, filename):
@@ -36,9 +110,10 @@ def import_csv(request, filename):
         - cyclos_error
     """
 
-    # DictReader needs a file-like object, I need to use StringIO to create one from the uploaded file
-    # The input file is encoded in Windows-1252
-    f = io.StringIO(request.data['file'].read().decode('cp1252'))
+    # The input file is encoded in Windows-1252: it is decoded as it is read, without loading it in memory.
+    upload = request.data['file']
+    upload.seek(0)
+    f = io.TextIOWrapper(upload.file, encoding='cp1252', newline='')
     reader = csv.DictReader(f, delimiter=';')
 
     # I don't like 'Sentences with Spaces And Random Caps' as key in my dicts, I slugify every key here
@@ -46,113 +121,253 @@ def import_csv(request, filename):
 
     res = {'errors': [], 'ignore': 0, 'ok': []}
 
-    for row in reader:
-        try:
-            echeance = models.Echeance(
-                ref=row['reference'],
-                adherent_name=row['debiteur'],
-                adherent_id=row['code'],
-                montant=float(row['montant'].replace(',', '.').strip(' €').replace(' ', '')),
-                date=datetime.strptime(row['date-execution'], '%d/%m/%Y %H:%M:%S'),
-                operation_date=None)
+    while True:
+        rows = list(islice(reader, IMPORT_BATCH_SIZE))
+        if not rows:
+            break
+        _import_rows(rows, res)
 
-            echeance.save()
+    return Response(res)
 
-            echeance_dict = model_to_dict(echeance)
-            res['ok'].append(echeance_dict)
 
-        except IntegrityError:
-            res['ignore'] += 1
-        except Exception as e:
-            echeance_dict = {
-                'ref': row['reference'],
-                'adherent_name': row['debiteur'],
-                'adherent_id': row['code'],
-                'montant': row['montant'],
-                'date': row['date-execution'],
-                'operation_date': '',
-                'error': e,
-            }
-            res['errors'].append(echeance_dict)
+# L'avancement de l'exécution est mis à jour toutes les PROGRESS_BATCH_SIZE échéances.
+PROGRESS_BATCH_SIZE = 100
 
-    return Response(res)
+# Une échéance réservée par une exécution qui ne l'a pas mise à jour depuis ce délai (le processus a été arrêté) peut
+# être reprise par une autre exécution.
+CLAIM_TIMEOUT = timedelta(hours=1)
 
 
-@api_view(['POST'])
-def perform(request):
-    """
-    perform
+def _progress_cache_key(execution_id):
+    return 'credits_comptes_prelevements_auto_perform_progress_{}'.format(execution_id)
+
+
+def _last_execution_cache_key(user):
+    return 'credits_comptes_prelevements_auto_last_execution_{}'.format(user.pk)
+
+
+def _failed(echeance, cyclos_euro_payment_id, error):
+    # L'échéance pourra être exécutée à nouveau.
+    models.Echeance.objects.filter(pk=echeance.pk).update(
+        cyclos_euro_payment_id=cyclos_euro_payment_id, cyclos_error=error[:500], execution_id='',
+        payment_started_at=None)
+    return cyclos_euro_payment_id, '', error
+
+
+def _uncertain(echeance, cyclos_euro_payment_id, error):
+    # On ne sait pas si Cyclos a fait le paiement : payment_started_at reste renseigné, l'échéance ne sera plus exécutée
+    # automatiquement.
+    error = 'Paiement peut-être fait, à vérifier dans Cyclos ({})'.format(error)
+    models.Echeance.objects.filter(pk=echeance.pk).update(
+        cyclos_euro_payment_id=cyclos_euro_payment_id, cyclos_error=error[:500], execution_id='')
+    return cyclos_euro_payment_id, '', error
+
+
+def _start_payment(echeance):
+    models.Echeance.objects.filter(pk=echeance.pk).update(payment_started_at=timezone.now())
+
+
+def _perform_echeance(cyclos, echeance):
     """
-    try:
-        cyclos = CyclosAPI(token=request.user.profile.cyclos_token)
-    except CyclosAPIException:
-        return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
+    Fait les 2 paiements d'une échéance dans Cyclos : le versement des euros sur le compte dédié, puis le change en
+    eusko sur le compte de l'adhérent.
 
-    serializer = serializers.GenericHistoryValidationSerializer(data=request.data)
-    serializer.is_valid(raise_exception=True)  # log.critical(serializer.errors)
+    Renvoie (cyclos_euro_payment_id, cyclos_payment_id, cyclos_error). Si le versement des euros a déjà été fait lors
+    d'une exécution précédente (cyclos_euro_payment_id est renseigné), il n'est pas refait.
 
-    for payment in serializer.data['selected_payments']:
-        try:
-            adherent_cyclos_id = cyclos.get_member_id_from_login(member_login=payment['adherent_id'])
+    Chaque paiement est enregistré en base dès que Cyclos l'a accepté : si le processus est arrêté, une nouvelle
+    exécution ne refait pas les paiements déjà faits. Avant d'envoyer un paiement à Cyclos, on enregistre
+    payment_started_at : si on ne sait pas ensuite si le paiement a été fait (pas de réponse de Cyclos, erreur en
+    enregistrant le paiement, processus arrêté), l'échéance n'est plus exécutée automatiquement (voir
+    _claim_echeances()), pour ne jamais payer 2 fois.
+    """
+    cyclos_euro_payment_id = echeance.cyclos_euro_payment_id
+    paying = False
+    try:
+        adherent_cyclos_id = cyclos.get_member_id_from_login(member_login=echeance.adherent_id)
 
-            # Determine whether or not our user is part of the appropriate group
-            group_constants_with_account = [str(settings.CYCLOS_CONSTANTS['groups']['adherents_prestataires']),
-                                            str(settings.CYCLOS_CONSTANTS['groups']['adherents_prestataires_avec_paiement_smartphone']),
-                                            str(settings.CYCLOS_CONSTANTS['groups']['adherents_utilisateurs'])]
+        # Determine whether or not our user is part of the appropriate group
+        group_constants_with_account = [str(settings.CYCLOS_CONSTANTS['groups']['adherents_prestataires']),
+                                        str(settings.CYCLOS_CONSTANTS['groups']['adherents_prestataires_avec_paiement_smartphone']),
+                                        str(settings.CYCLOS_CONSTANTS['groups']['adherents_utilisateurs'])]
 
-            # Fetching info for our current user (we look for his groups)
-            user_data = cyclos.post(method='user/load', data=[adherent_cyclos_id])
+        # Fetching info for our current user (we look for his groups)
+        user_data = cyclos.post(method='user/load', data=[adherent_cyclos_id])
 
-            if not user_data['result']['group']['id'] in group_constants_with_account:
-                error = "{} n'a pas de compte Eusko numérique...".format(payment['adherent_id'])
-                log.critical(error)
-                echeance = models.Echeance.objects.get(ref=payment['ref'])
-                echeance.cyclos_error = error
-                echeance.save()
-                continue
+        if not user_data['result']['group']['id'] in group_constants_with_account:
+            error = "{} n'a pas de compte Eusko numérique...".format(echeance.adherent_id)
+            log.critical(error)
+            return _failed(echeance, cyclos_euro_payment_id, error)
 
+        if not cyclos_euro_payment_id:
             # Payment in Euro
             change_numerique_euro = {
                 'type': str(settings.CYCLOS_CONSTANTS['payment_types']['change_numerique_en_ligne_versement_des_euro']),  # noqa
-                'amount': float(payment['montant']),
+                'amount': float(echeance.montant),
                 'currency': str(settings.CYCLOS_CONSTANTS['currencies']['euro']),
                 'from': 'SYSTEM',
                 'to': str(settings.CYCLOS_CONSTANTS['users']['compte_dedie_eusko_numerique']),
                 'customValues': [{
                     'field': str(settings.CYCLOS_CONSTANTS['transaction_custom_fields']['numero_de_transaction_banque']),  # noqa
-                    'stringValue': payment['ref']  # référence de l'échéance
+                    'stringValue': echeance.ref  # référence de l'échéance
                 }],
                 'description': 'Change par prélèvement automatique'
             }
-            cyclos.post(method='payment/perform', data=change_numerique_euro)
+            _start_payment(echeance)
+            paying = True
+            cyclos_euro_payment_id = cyclos.post(method='payment/perform', data=change_numerique_euro)['result']['id']
+            models.Echeance.objects.filter(pk=echeance.pk).update(cyclos_euro_payment_id=cyclos_euro_payment_id,
+                                                                  payment_started_at=None)
+            paying = False
+
+        # Payment in Eusko
+        change_prelevement_auto = {
+            'type': str(settings.CYCLOS_CONSTANTS['payment_types']['change_numerique_en_ligne_versement_des_eusko']),  # noqa
+            'amount': float(echeance.montant),
+            'currency': str(settings.CYCLOS_CONSTANTS['currencies']['eusko']),
+            'from': 'SYSTEM',
+            'to': adherent_cyclos_id,
+            'customValues': [{
+                'field': str(settings.CYCLOS_CONSTANTS['transaction_custom_fields']['numero_de_transaction_banque']),  # noqa
+                'stringValue': echeance.ref  # référence de l'échéance
+            }],
+            'description': 'Change par prélèvement automatique'
+        }
+        _start_payment(echeance)
+        paying = True
+        cyclos_payment_id = cyclos.post(method='payment/perform', data=change_prelevement_auto)['result']['id']
+    except CyclosAPIException as e:
+        # Cyclos a répondu par une erreur : le paiement en cours n'a pas été fait.
+        return _failed(echeance, cyclos_euro_payment_id, str(e))
+    except Exception as e:
+        if paying:
+            log.exception("Echéance {}".format(echeance.ref))
+            return _uncertain(echeance, cyclos_euro_payment_id, str(e))
+        return _failed(echeance, cyclos_euro_payment_id, str(e))
+
+    # En dehors du try : une échéance payée ne doit jamais être libérée pour être exécutée à nouveau. Si cette mise à
+    # jour échoue, payment_started_at reste renseigné.
+    models.Echeance.objects.filter(pk=echeance.pk).update(cyclos_payment_id=cyclos_payment_id, cyclos_error='',
+                                                          payment_started_at=None)
+    return cyclos_euro_payment_id, cyclos_payment_id, ''
+
+
+def _perform_echeance_in_thread(cyclos, echeance):
+    try:
+        return _perform_echeance(cyclos, echeance)
+    finally:
+        # Chaque thread a sa propre connexion à la base.
+        connection.close()
 
-            # Payment in Eusko
-            change_prelevement_auto = {
-                'type': str(settings.CYCLOS_CONSTANTS['payment_types']['change_numerique_en_ligne_versement_des_eusko']),  # noqa
-                'amount': float(payment['montant']),
-                'currency': str(settings.CYCLOS_CONSTANTS['currencies']['eusko']),
-                'from': 'SYSTEM',
-                'to': adherent_cyclos_id,
-                'customValues': [{
-                    'field': str(settings.CYCLOS_CONSTANTS['transaction_custom_fields']['numero_de_transaction_banque']),  # noqa
-                    'stringValue': payment['ref']  # référence de l'échéance
-                }],
-                'description': 'Change par prélèvement automatique'
-            }
-            change_prelevement_auto_id = cyclos.post(method='payment/perform', data=change_prelevement_auto)
 
-            echeance = models.Echeance.objects.get(ref=payment['ref'])
-            echeance.cyclos_payment_id = change_prelevement_auto_id['result']['id']
-            echeance.cyclos_error = ''
-            echeance.save()
-        except Exception as e:
-            echeance = models.Echeance.objects.get(ref=payment['ref'])
-            echeance.cyclos_error = str(e)
-            echeance.save()
+def _claim_echeances(refs, execution_id):
+    """
+    Réserve pour cette exécution les échéances qui n'ont pas encore été payées et qui ne sont pas en cours
+    d'exécution, et les renvoie. Une échéance ne peut donc être payée qu'une fois, même si elle est sélectionnée
+    plusieurs fois ou si 2 exécutions ont lieu en même temps.
+    Les échéances réservées par une exécution interrompue (voir CLAIM_TIMEOUT) sont reprises, sauf si elle avait
+    envoyé un paiement à Cyclos sans savoir s'il a été fait (payment_started_at) : ces échéances sont signalées en
+    erreur, pour être vérifiées dans Cyclos.
+    """
+    now = timezone.now()
+    claimable = models.Echeance.objects.filter(
+        Q(cyclos_payment_id__isnull=True) | Q(cyclos_payment_id__exact=''),
+        Q(execution_id='') | Q(claimed_at__isnull=True) | Q(claimed_at__lt=now - CLAIM_TIMEOUT),
+        ref__in=refs,
+    )
+    claimable.filter(Q(cyclos_error__isnull=True) | Q(cyclos_error=''), payment_started_at__isnull=False).update(
+        cyclos_error="Paiement peut-être fait lors d'une exécution interrompue, à vérifier dans Cyclos")
+    claimable.filter(payment_started_at__isnull=True).update(execution_id=execution_id, claimed_at=now)
+    return list(models.Echeance.objects.filter(execution_id=execution_id))
+
+
+def _set_progress(execution_id, total, done, errors):
+    cache.set(_progress_cache_key(execution_id), {
+        'execution_id': execution_id, 'total': total, 'done': done, 'errors': errors, 'running': done < total,
+    }, None)
+
+
+def _keep_claim(execution_id):
+    """
+    Indique que l'exécution est toujours en cours pour les échéances qu'elle n'a pas encore payées.
+    """
+    models.Echeance.objects.filter(
+        Q(cyclos_payment_id__isnull=True) | Q(cyclos_payment_id__exact=''),
+        execution_id=execution_id,
+    ).update(claimed_at=timezone.now())
+
+
+def perform_echeances(cyclos, refs, max_workers=None, execution_id=None):
+    """
+    Exécute les échéances données (par leurs références), en parallèle. Le résultat de chaque échéance est
+    enregistré en base dès qu'il est connu, et l'avancement est disponible via perform_progress.
+    Renvoie l'identifiant de l'exécution.
+    """
+    execution_id = execution_id or str(uuid4())
+    echeances = _claim_echeances(refs, execution_id)
+    total = len(echeances)
+    done = 0
+    errors = 0
+    _set_progress(execution_id, total, done, errors)
+
+    if max_workers is None:
+        max_workers = settings.API_MAX_WORKERS
+    perform_echeance = backend_timing.bind(_perform_echeance_in_thread)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [executor.submit(perform_echeance, cyclos, echeance) for echeance in echeances]
+        for future in as_completed(futures):
+            try:
+                if future.result()[2]:
+                    errors += 1
+            except Exception:
+                # L'échéance reste réservée par cette exécution, avec payment_started_at s'il faut la vérifier.
+                log.exception("perform_echeances {}".format(execution_id))
+                errors += 1
+            done += 1
+            if done % PROGRESS_BATCH_SIZE == 0:
+                _keep_claim(execution_id)
+                _set_progress(execution_id, total, done, errors)
+
+    _set_progress(execution_id, total, done, errors)
+    log.info("perform_echeances {}: {} échéances, {} erreurs".format(execution_id, total, errors))
+    return execution_id
+
+
+@api_view(['POST'])
+def perform(request):
+    """
+    perform
+    """
+    try:
+        cyclos = CyclosAPI(token=request.user.profile.cyclos_token)
+    except CyclosAPIException:
+        return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
+
+    serializer = serializers.GenericHistoryValidationSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)  # log.critical(serializer.errors)
+
+    # L'avancement de cette exécution est disponible via perform_progress, pendant qu'elle a lieu.
+    execution_id = str(uuid4())
+    cache.set(_last_execution_cache_key(request.user), execution_id, None)
+    perform_echeances(cyclos, [payment['ref'] for payment in serializer.data['selected_payments']],
+                      execution_id=execution_id)
 
     return Response(serializer.data['selected_payments'])
 
 
+@api_view(['GET'])
+def perform_progress(request):
+    """
+    Avancement d'une exécution des échéances (paramètre execution_id), par défaut de la dernière exécution lancée par
+    l'utilisateur.
+    """
+    execution_id = request.query_params.get('execution_id') or cache.get(_last_execution_cache_key(request.user))
+    progress = cache.get(_progress_cache_key(execution_id)) if execution_id else None
+    if progress is None:
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    return Response(progress)
+
+
 @api_view(['POST'])
 def delete(request):
     """
@@ -168,7 +383,7 @@ def delete(request):
 
 
 @api_view(['GET'])
-def list(request, mode):
+def list_echeances(request, mode):
     """
     List pending Echeances objects and Echeances objects in 'error' state.
     We know that a entry in our table is an error WHERE cyclos_error IS NOT NULL AND cyclos_error != "".
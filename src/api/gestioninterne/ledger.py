@@ -0,0 +1,253 @@
+"""
+Copie locale de l'historique des comptes Cyclos.
+
+Les rapports (export vers Odoo, calcul des 3%, montant des dons) portent souvent sur des périodes déjà passées, et
+retéléchargeaient à chaque fois tout l'historique des comptes concernés. On recopie donc les lignes de l'historique
+dans la table AccountHistoryEntry, compte par compte, et on ne demande à Cyclos que les lignes qui manquent pour la
+période demandée : pour chaque compte, AccountHistorySync mémorise la période déjà recopiée.
+
+Les statuts des paiements (rapprochement, etc.) changent avec le temps et ne sont pas mis à jour dans cette copie :
+les recherches qui filtrent sur les statuts doivent toujours être faites directement dans Cyclos.
+"""
+from datetime import datetime, timedelta
+from decimal import Decimal
+import json
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from gestioninterne.models import AccountHistoryCustomValue, AccountHistoryEntry, AccountHistorySync
+from misc import concurrent_map
+
+log = logging.getLogger()
+
+# Taille des lots pour les requêtes "IN (...)" et les insertions en base.
+BATCH_SIZE = 500
+
+
+def parse_cyclos_datetime(value):
+    """
+    Convertit une date envoyée à ou reçue de Cyclos (date seule ou date et heure, avec ou sans fuseau horaire) en
+    datetime avec fuseau horaire. Sans fuseau horaire, la date est considérée dans le fuseau horaire du serveur.
+    """
+    if isinstance(value, datetime):
+        result = value
+    else:
+        result = parse_datetime(value)
+        if result is None:
+            day = parse_date(value)
+            result = datetime(day.year, day.month, day.day)
+    if timezone.is_naive(result):
+        result = timezone.make_aware(result)
+    return result
+
+
+def fetch_account_history(cyclos, account, begin_date, end_date, direction=None, max_workers=None):
+    """
+    Télécharge depuis Cyclos l'historique d'un compte pour la période donnée, par ordre chronologique.
+
+    On récupère la 1ère page pour connaître le nombre de pages, puis toutes les autres pages en parallèle.
+    """
+    def search_history_page(current_page):
+        search_history_data = {
+            'account': account,
+            'period':
+            {
+                'begin': begin_date,
+                'end': end_date,
+            },
+            'orderBy': 'DATE_ASC',
+            'pageSize': 1000,  # maximum pageSize: 1000
+            'currentPage': current_page,
+        }
+        if direction:
+            search_history_data['direction'] = direction
+        return cyclos.post(method='account/searchAccountHistory', data=search_history_data)['result']
+
+    first_page = search_history_page(0)
+    account_history = list(first_page['pageItems'])
+    for page in concurrent_map(search_history_page, range(1, first_page['pageCount']), max_workers):
+        account_history.extend(page['pageItems'])
+    return account_history
+
+
+def _custom_value_to_string(custom_value):
+    if 'linkedEntityValue' in custom_value:
+        return str(custom_value['linkedEntityValue']['id'])
+    if 'enumeratedValues' in custom_value:
+        return ','.join(str(value.get('internalName', value.get('id'))) for value in custom_value['enumeratedValues'])
+    for key in ('stringValue', 'decimalValue', 'integerValue', 'dateValue', 'booleanValue'):
+        if key in custom_value:
+            return str(custom_value[key])
+    return ''
+
+
+def _store_entries(account, entries):
+    """
+    Enregistre les lignes d'historique qui ne sont pas encore dans la table, avec leurs champs personnalisés.
+    """
+    entry_ids = [str(entry['id']) for entry in entries]
+    existing_ids = set()
+    for i in range(0, len(entry_ids), BATCH_SIZE):
+        existing_ids.update(AccountHistoryEntry.objects.filter(
+            account=account, entry_id__in=entry_ids[i:i + BATCH_SIZE]).values_list('entry_id', flat=True))
+
+    new_entries = {str(entry['id']): entry for entry in entries if str(entry['id']) not in existing_ids}
+    if not new_entries:
+        return 0
+
+    # ignore_conflicts : une autre requête peut être en train d'enregistrer les mêmes lignes.
+    AccountHistoryEntry.objects.bulk_create([
+        AccountHistoryEntry(
+            account=account,
+            entry_id=entry_id,
+            transaction_id=str(entry.get('transactionId', '')),
+            type_id=str(entry['type']['id']),
+            date=parse_cyclos_datetime(entry['date']),
+            amount=Decimal(str(entry['amount'])),
+            data=json.dumps(entry))
+        for entry_id, entry in new_entries.items()
+    ], batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+    # bulk_create() ne renseigne pas les clés primaires avec tous les SGBD, on les relit.
+    new_ids = list(new_entries.keys())
+    pks = {}
+    for i in range(0, len(new_ids), BATCH_SIZE):
+        pks.update(AccountHistoryEntry.objects.filter(
+            account=account, entry_id__in=new_ids[i:i + BATCH_SIZE]).values_list('entry_id', 'pk'))
+    AccountHistoryCustomValue.objects.bulk_create([
+        AccountHistoryCustomValue(
+            entry_id=pks[entry_id],
+            field=custom_value['field']['internalName'],
+            value=_custom_value_to_string(custom_value)[:250])
+        for entry_id, entry in new_entries.items()
+        for custom_value in entry.get('customValues', [])
+        if 'internalName' in custom_value.get('field', {})
+    ], batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+    return len(new_entries)
+
+
+def sync_account_history(cyclos, account, begin_date, end_date, max_workers=None):
+    """
+    Complète la copie locale de l'historique du compte pour qu'elle couvre la période demandée.
+
+    Seules les périodes qui n'ont pas encore été recopiées sont téléchargées. Pour la fin de la période, on
+    retélécharge aussi les dernières lignes déjà recopiées (voir CYCLOS_LEDGER_OVERLAP), pour ne pas rater les
+    paiements enregistrés dans Cyclos pendant la synchronisation précédente.
+    """
+    account = str(account)
+    begin = parse_cyclos_datetime(begin_date)
+    # On ne peut pas recopier le futur : la fin de la période recopiée est au plus maintenant.
+    end = min(parse_cyclos_datetime(end_date), timezone.now())
+    if begin >= end:
+        return
+
+    periods = []
+    try:
+        state = AccountHistorySync.objects.get(account=account)
+    except AccountHistorySync.DoesNotExist:
+        state = AccountHistorySync(account=account, synced_from=begin, synced_until=end)
+        periods.append((begin, end))
+    else:
+        if begin < state.synced_from:
+            periods.append((begin, state.synced_from))
+        if end > state.synced_until:
+            overlap = timedelta(seconds=settings.CYCLOS_LEDGER_OVERLAP)
+            # On repart de la fin de la période déjà recopiée, même si la période demandée commence après, pour que
+            # la période recopiée reste continue.
+            periods.append((state.synced_until - overlap, end))
+        if not periods:
+            return
+        state.synced_from = min(begin, state.synced_from)
+        state.synced_until = max(end, state.synced_until)
+
+    for period_begin, period_end in periods:
+        entries = fetch_account_history(cyclos, account, period_begin.isoformat(), period_end.isoformat(),
+                                        max_workers=max_workers)
+        created = _store_entries(account, entries)
+        log.debug("sync_account_history: account {} from {} to {}: {} entries, {} new".format(
+            account, period_begin, period_end, len(entries), created))
+
+    try:
+        state.save()
+    except IntegrityError:
+        # Une autre requête a recopié en même temps le début de l'historique de ce compte : sa période sera complétée
+        # lors de la prochaine synchronisation.
+        pass
+
+
+def search_account_history(account, direction, begin_date, end_date, payment_types):
+    """
+    Recherche dans la copie locale les lignes de l'historique du compte pour la période et les types de paiement
+    donnés, en ignorant les paiements dont on sait déjà qu'ils ont fait l'objet d'une opposition.
+    Les lignes sont renvoyées telles qu'elles ont été reçues de Cyclos, par ordre chronologique.
+    """
+    entries = AccountHistoryEntry.objects.filter(
+        account=str(account),
+        type_id__in=payment_types,
+        date__gte=parse_cyclos_datetime(begin_date),
+        date__lte=parse_cyclos_datetime(end_date),
+    ).exclude(charged_back=True)
+    if direction == 'DEBIT':
+        entries = entries.filter(amount__lt=0)
+    elif direction == 'CREDIT':
+        entries = entries.filter(amount__gt=0)
+    return [json.loads(data) for data in entries.order_by('date', 'pk').values_list('data', flat=True)]
+
+
+def filter_charged_back(cyclos, entries, max_workers=None):
+    """
+    Retire de la liste les paiements qui ont fait l'objet d'une opposition de paiement.
+
+    Pour chaque paiement, on récupère les données de la transaction et on vérifie si la donnée 'chargedBackBy' est
+    présente dans le transfert associé. Ces requêtes sont faites en parallèle.
+
+    Note : Les transactions importées lors de la migration de Cyclos 3 à Cyclos 4 sont de type ImportedTransactionData
+    et n'ont pas de transfert associé. Elles ne peuvent pas être annulées. Les transactions enregistrées depuis (les
+    transactions "normales" en quelque sorte), sont de type PaymentData.
+
+    Quand la copie locale de l'historique est activée, les oppositions y sont mémorisées, car elles sont définitives :
+    on n'interroge Cyclos que pour les autres paiements. Un paiement sans opposition peut en avoir une plus tard, il
+    faut donc le vérifier à chaque fois.
+    """
+    known = set()
+    if settings.CYCLOS_LEDGER_ENABLED:
+        transaction_ids = list({str(entry['transactionId']) for entry in entries})
+        for i in range(0, len(transaction_ids), BATCH_SIZE):
+            known.update(AccountHistoryEntry.objects.filter(
+                transaction_id__in=transaction_ids[i:i + BATCH_SIZE], charged_back=True,
+            ).values_list('transaction_id', flat=True))
+
+    def get_transaction_data(entry):
+        return cyclos.get(method='transaction/getData/{}'.format(entry['transactionId']))['result']
+
+    to_check = [entry for entry in entries if str(entry['transactionId']) not in known]
+    charged_back = []
+    keep = {}
+    for entry, transaction_data in zip(to_check, concurrent_map(get_transaction_data, to_check, max_workers)):
+        transaction_id = str(entry['transactionId'])
+        if transaction_data['class'] == 'org.cyclos.model.banking.transactions.ImportedTransactionData':
+            keep[transaction_id] = True
+        elif transaction_data['class'] == 'org.cyclos.model.banking.transactions.PaymentData':
+            if 'chargedBackBy' in transaction_data['transfer'].keys():
+                charged_back.append(transaction_id)
+                keep[transaction_id] = False
+            else:
+                keep[transaction_id] = True
+        else:
+            keep[transaction_id] = False
+
+    if settings.CYCLOS_LEDGER_ENABLED:
+        for i in range(0, len(charged_back), BATCH_SIZE):
+            AccountHistoryEntry.objects.filter(
+                transaction_id__in=charged_back[i:i + BATCH_SIZE]).update(charged_back=True)
+
+    def is_kept(entry):
+        transaction_id = str(entry['transactionId'])
+        return transaction_id not in known and keep[transaction_id]
+
+    return [entry for entry in entries if is_kept(entry)]
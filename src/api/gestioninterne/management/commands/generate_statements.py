@@ -0,0 +1,49 @@
+from datetime import datetime
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from gestioninterne.models import StatementRun
+from gestioninterne.statements import run_statement_run, run_worker
+
+
+class Command(BaseCommand):
+    help = "Génère les relevés de compte mensuels des adhérents qui ont un compte Eusko numérique."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--month',
+                            help="Génère (ou termine de générer) les relevés de ce mois (AAAA-MM), puis s'arrête.")
+        parser.add_argument('--user',
+                            help="Utilisateur dont la session Cyclos est utilisée, avec --month (par défaut, "
+                                 "celui qui a demandé la génération).")
+        parser.add_argument('--worker', action='store_true',
+                            help="Exécute en boucle les générations demandées, et celle du mois précédent chaque "
+                                 "1er du mois si STATEMENTS_USER est renseigné.")
+        parser.add_argument('--poll-interval', type=int, default=60,
+                            help="Avec --worker, délai (en secondes) entre deux recherches de générations en attente.")
+
+    def handle(self, *args, **options):
+        if options['worker']:
+            run_worker(poll_interval=options['poll_interval'])
+            return
+
+        if not options['month']:
+            raise CommandError("--month ou --worker est obligatoire.")
+        try:
+            month = datetime.strptime(options['month'], '%Y-%m').date()
+        except ValueError:
+            raise CommandError("--month doit être au format AAAA-MM.")
+
+        run, created = StatementRun.objects.get_or_create(month=month)
+        if options['user']:
+            run.user = User.objects.get(username=options['user'])
+        if run.user is None:
+            raise CommandError("--user est obligatoire pour une nouvelle génération.")
+        run.statut = StatementRun.EN_COURS
+        run.started_at = timezone.now()
+        run.save()
+        run_statement_run(run)
+        run.refresh_from_db()
+        self.stdout.write("{}: {} relevés générés sur {}, {} erreurs".format(
+            options['month'], run.done, run.total, run.errors))
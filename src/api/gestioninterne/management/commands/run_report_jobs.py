@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from gestioninterne.report_jobs import run_worker
+
+
+class Command(BaseCommand):
+    help = "Exécute les rapports de la gestion interne demandés (calcul des 3%, export vers Odoo)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=int, default=5,
+                            help="Délai (en secondes) entre deux recherches de rapports en attente.")
+        parser.add_argument('--once', action='store_true',
+                            help="Exécute les rapports en attente puis s'arrête.")
+
+    def handle(self, *args, **options):
+        run_worker(poll_interval=options['poll_interval'], once=options['once'])
@@ -0,0 +1,54 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestioninterne', '0002_auto_20191124_1158'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountHistorySync',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account', models.CharField(max_length=30, unique=True)),
+                ('synced_from', models.DateTimeField()),
+                ('synced_until', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AccountHistoryEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account', models.CharField(max_length=30)),
+                ('entry_id', models.CharField(max_length=30)),
+                ('transaction_id', models.CharField(blank=True, max_length=30)),
+                ('type_id', models.CharField(max_length=30)),
+                ('date', models.DateTimeField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('data', models.TextField()),
+                ('charged_back', models.NullBooleanField()),
+            ],
+            options={
+                'unique_together': {('account', 'entry_id')},
+                'index_together': {('account', 'date'), ('account', 'type_id', 'date')},
+            },
+        ),
+        migrations.CreateModel(
+            name='AccountHistoryCustomValue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(max_length=50)),
+                ('value', models.CharField(max_length=250)),
+                ('entry', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='custom_values', to='gestioninterne.AccountHistoryEntry')),
+            ],
+            options={
+                'unique_together': {('entry', 'field')},
+                'index_together': {('field', 'value')},
+            },
+        ),
+    ]
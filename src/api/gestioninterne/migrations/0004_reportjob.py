@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:44
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('gestioninterne', '0003_account_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('report', models.CharField(choices=[('calculate_3_percent', 'Calcul des 3%'), ('export_vers_odoo', 'Export vers Odoo')], max_length=50)),
+                ('begin', models.DateField()),
+                ('end', models.DateField()),
+                ('statut', models.CharField(choices=[('ATT', 'En attente'), ('ENC', 'En cours'), ('TER', 'Terminé'), ('ERR', 'Erreur')], default='ATT', max_length=3)),
+                ('progress', models.PositiveSmallIntegerField(default=0)),
+                ('progress_message', models.CharField(blank=True, max_length=250)),
+                ('result', models.TextField(blank=True)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(null=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'index_together': {('report', 'begin', 'end', 'statut'), ('statut', 'created_at')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestioninterne', '0004_reportjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='echeance',
+            name='cyclos_euro_payment_id',
+            field=models.CharField(blank=True, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='echeance',
+            name='execution_id',
+            field=models.CharField(blank=True, db_index=True, max_length=36),
+        ),
+    ]
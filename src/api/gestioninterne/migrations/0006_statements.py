@@ -0,0 +1,52 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:05
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('gestioninterne', '0005_echeance_execution'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatementRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(unique=True)),
+                ('statut', models.CharField(choices=[('ATT', 'En attente'), ('ENC', 'En cours'), ('TER', 'Terminé'), ('ERR', 'Erreur')], default='ATT', max_length=3)),
+                ('total', models.PositiveIntegerField(default=0)),
+                ('done', models.PositiveIntegerField(default=0)),
+                ('errors', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(null=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('user', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Statement',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cyclos_id', models.CharField(max_length=30)),
+                ('login', models.CharField(max_length=50)),
+                ('name', models.CharField(blank=True, max_length=250)),
+                ('statut', models.CharField(choices=[('ATT', 'En attente'), ('ENC', 'En cours'), ('TER', 'Terminé'), ('ERR', 'Erreur')], default='ATT', max_length=3)),
+                ('account_number', models.CharField(blank=True, max_length=30)),
+                ('initial_balance', models.DecimalField(decimal_places=2, max_digits=12, null=True)),
+                ('final_balance', models.DecimalField(decimal_places=2, max_digits=12, null=True)),
+                ('lines', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('run', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='statements', to='gestioninterne.StatementRun')),
+            ],
+            options={
+                'unique_together': {('run', 'cyclos_id')},
+                'index_together': {('run', 'statut')},
+            },
+        ),
+    ]
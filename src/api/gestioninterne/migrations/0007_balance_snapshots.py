@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestioninterne', '0006_statements'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('owner', models.CharField(max_length=30)),
+                ('account', models.CharField(max_length=30)),
+                ('date', models.DateField()),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('data', models.TextField()),
+            ],
+            options={
+                'unique_together': {('account', 'date')},
+                'index_together': {('owner', 'date')},
+            },
+        ),
+    ]
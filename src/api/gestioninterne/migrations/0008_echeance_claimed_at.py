@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestioninterne', '0007_balance_snapshots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='echeance',
+            name='claimed_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gestioninterne', '0008_echeance_claimed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='echeance',
+            name='payment_started_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.db import models
 
 
@@ -21,3 +22,188 @@ class Echeance(models.Model):
     operation_date = models.DateField(null=True)
     cyclos_payment_id = models.CharField(max_length=50, blank=True)
     cyclos_error = models.CharField(max_length=500, blank=True)
+    # Paiement des euros sur le compte dédié, fait avant le paiement en eusko (cyclos_payment_id).
+    cyclos_euro_payment_id = models.CharField(max_length=50, blank=True)
+    # Identifiant de l'exécution qui a réservé cette échéance (voir credits_comptes_prelevements_auto.perform).
+    execution_id = models.CharField(max_length=36, blank=True, db_index=True)
+    # Date de la réservation par cette exécution, mise à jour pendant l'exécution.
+    claimed_at = models.DateTimeField(null=True)
+    # Date d'envoi d'un paiement à Cyclos, tant qu'on ne sait pas s'il a été fait. Une échéance dans cet état n'est plus
+    # jamais exécutée automatiquement : il faut vérifier dans Cyclos si le paiement a été fait, puis renseigner
+    # cyclos_payment_id ou vider ce champ.
+    payment_started_at = models.DateTimeField(null=True)
+
+
+class AccountHistoryEntry(models.Model):
+    """
+    Copie locale d'une ligne de l'historique d'un compte Cyclos (voir gestioninterne/ledger.py).
+
+    La ligne complète, telle que renvoyée par account/searchAccountHistory, est enregistrée au format JSON dans
+    `data`. Les champs utilisés pour les recherches sont recopiés dans des colonnes indexées.
+    `charged_back` vaut True si le paiement a fait l'objet d'une opposition (c'est définitif). Sinon, il faut
+    interroger Cyclos : une opposition peut avoir lieu après la vérification précédente.
+    """
+
+    account = models.CharField(max_length=30)
+    entry_id = models.CharField(max_length=30)
+    transaction_id = models.CharField(max_length=30, blank=True)
+    type_id = models.CharField(max_length=30)
+    date = models.DateTimeField()
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    data = models.TextField()
+    charged_back = models.NullBooleanField()
+
+    class Meta:
+        unique_together = ('account', 'entry_id')
+        index_together = [
+            ('account', 'type_id', 'date'),
+            ('account', 'date'),
+        ]
+
+
+class AccountHistoryCustomValue(models.Model):
+    """
+    Valeur d'un champ personnalisé d'une ligne de l'historique, pour pouvoir faire des recherches sur ces valeurs.
+    Pour les champs qui pointent vers une autre entité (un utilisateur par exemple), on enregistre l'id de l'entité.
+    """
+
+    entry = models.ForeignKey(AccountHistoryEntry, related_name='custom_values', on_delete=models.CASCADE)
+    field = models.CharField(max_length=50)
+    value = models.CharField(max_length=250)
+
+    class Meta:
+        unique_together = ('entry', 'field')
+        index_together = [
+            ('field', 'value'),
+        ]
+
+
+class AccountHistorySync(models.Model):
+    """
+    Période pour laquelle l'historique d'un compte Cyclos a été recopié dans AccountHistoryEntry.
+    """
+
+    account = models.CharField(max_length=30, unique=True)
+    synced_from = models.DateTimeField()
+    synced_until = models.DateTimeField()
+
+
+class ReportJob(models.Model):
+    """
+    Calcul d'un rapport de la gestion interne pour une période donnée, exécuté en tâche de fond par la commande
+    run_report_jobs (voir gestioninterne/report_jobs.py).
+
+    Le résultat (JSON ou CSV selon le rapport) est enregistré dans `result` et sert aussi de cache : pour une période
+    close, un rapport déjà calculé n'est pas recalculé.
+    """
+
+    CALCULATE_3_PERCENT = 'calculate_3_percent'
+    EXPORT_VERS_ODOO = 'export_vers_odoo'
+    REPORTS = (
+        (CALCULATE_3_PERCENT, 'Calcul des 3%'),
+        (EXPORT_VERS_ODOO, 'Export vers Odoo'),
+    )
+    report = models.CharField(max_length=50, choices=REPORTS)
+    begin = models.DateField()
+    end = models.DateField()
+    EN_ATTENTE = 'ATT'
+    EN_COURS = 'ENC'
+    TERMINE = 'TER'
+    ERREUR = 'ERR'
+    STATUTS = (
+        (EN_ATTENTE, 'En attente'),
+        (EN_COURS, 'En cours'),
+        (TERMINE, 'Terminé'),
+        (ERREUR, 'Erreur'),
+    )
+    statut = models.CharField(max_length=3, choices=STATUTS, default=EN_ATTENTE)
+    progress = models.PositiveSmallIntegerField(default=0)
+    progress_message = models.CharField(max_length=250, blank=True)
+    result = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    class Meta:
+        index_together = [
+            ('report', 'begin', 'end', 'statut'),
+            ('statut', 'created_at'),
+        ]
+
+
+class StatementRun(models.Model):
+    """
+    Génération des relevés de compte (PDF et CSV) d'un mois pour tous les adhérents qui ont un compte Eusko numérique,
+    exécutée en tâche de fond par la commande generate_statements (voir gestioninterne/statements.py).
+
+    Un relevé (Statement) est créé pour chaque adhérent au début de la génération : si elle est interrompue, elle
+    reprend là où elle s'était arrêtée.
+    """
+
+    month = models.DateField(unique=True)  # premier jour du mois
+    EN_ATTENTE = 'ATT'
+    EN_COURS = 'ENC'
+    TERMINE = 'TER'
+    ERREUR = 'ERR'
+    STATUTS = (
+        (EN_ATTENTE, 'En attente'),
+        (EN_COURS, 'En cours'),
+        (TERMINE, 'Terminé'),
+        (ERREUR, 'Erreur'),
+    )
+    statut = models.CharField(max_length=3, choices=STATUTS, default=EN_ATTENTE)
+    total = models.PositiveIntegerField(default=0)
+    done = models.PositiveIntegerField(default=0)
+    errors = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+
+class Statement(models.Model):
+    """
+    Relevé de compte d'un adhérent pour le mois d'une StatementRun. Les fichiers sont enregistrés dans
+    MEDIA_ROOT/statements/<AAAA-MM>/<login>.pdf et .csv.
+    """
+
+    run = models.ForeignKey(StatementRun, related_name='statements', on_delete=models.CASCADE)
+    cyclos_id = models.CharField(max_length=30)
+    login = models.CharField(max_length=50)
+    name = models.CharField(max_length=250, blank=True)
+    statut = models.CharField(max_length=3, choices=StatementRun.STATUTS, default=StatementRun.EN_ATTENTE)
+    account_number = models.CharField(max_length=30, blank=True)
+    initial_balance = models.DecimalField(max_digits=12, decimal_places=2, null=True)
+    final_balance = models.DecimalField(max_digits=12, decimal_places=2, null=True)
+    lines = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        unique_together = ('run', 'cyclos_id')
+        index_together = [
+            ('run', 'statut'),
+        ]
+
+
+class BalanceSnapshot(models.Model):
+    """
+    Solde d'un compte Cyclos à la fin d'une journée terminée (voir gestioninterne/balances.py). Ce solde ne peut plus
+    changer : il est gardé indéfiniment.
+    Le résumé du compte, tel que renvoyé par account/getAccountsSummary pour le lendemain à zéro heure, est enregistré
+    au format JSON dans `data`.
+    """
+
+    owner = models.CharField(max_length=30)  # id Cyclos du titulaire du compte
+    account = models.CharField(max_length=30)
+    date = models.DateField()
+    balance = models.DecimalField(max_digits=12, decimal_places=2)
+    data = models.TextField()
+
+    class Meta:
+        unique_together = ('account', 'date')
+        index_together = [
+            ('owner', 'date'),
+        ]
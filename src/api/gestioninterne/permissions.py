@@ -0,0 +1,27 @@
+"""
+Permissions des vues de la gestion interne.
+"""
+from django.conf import settings
+from rest_framework.permissions import BasePermission
+
+from cyclos_api import CyclosAPI, CyclosAPIException, CyclosAPILoggedOutException
+
+
+class IsGestionInterne(BasePermission):
+    """
+    Réservé aux utilisateurs du groupe Cyclos "Gestion interne".
+
+    Les vues qui font leur travail avec l'utilisateur de service de la gestion interne (rapports longs, relevés
+    mensuels, voir service_sessions.py) ne profitent plus des permissions de l'utilisateur dans Cyclos : elles vérifient
+    donc son groupe avec sa propre session.
+    """
+
+    def has_permission(self, request, view):
+        if not request.user or not request.user.is_authenticated:
+            return False
+        try:
+            cyclos = CyclosAPI(token=request.user.profile.cyclos_token, mode='gi')
+            group_id = cyclos.get_current_user_group_id()
+        except (CyclosAPIException, CyclosAPILoggedOutException):
+            return False
+        return group_id == str(settings.CYCLOS_CONSTANTS['groups']['gestion_interne'])
@@ -0,0 +1,170 @@
+"""
+Exécution en tâche de fond des rapports longs de la gestion interne (calcul des 3%, export vers Odoo).
+
+Sur de longues périodes, ces rapports prennent trop de temps pour être calculés pendant une requête HTTP. On
+enregistre donc une demande de rapport (ReportJob), qui est exécutée par la commande run_report_jobs. Le client
+suit l'avancement du calcul, puis télécharge le résultat.
+"""
+from datetime import date
+import json
+import logging
+import time
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
+
+from gestioninterne import serializers
+from gestioninterne.models import ReportJob
+from gestioninterne.permissions import IsGestionInterne
+from gestioninterne.views import ExportVersOdooCSVStreamingRenderer, _calculate_3_percent, _export_vers_odoo_rows
+from service_sessions import gi_cyclos, gi_dolibarr
+
+log = logging.getLogger()
+
+
+def _run_calculate_3_percent(dolibarr, cyclos, begin, end, progress):
+    return json.dumps(_calculate_3_percent(dolibarr, cyclos, begin, end, progress), cls=DjangoJSONEncoder)
+
+
+def _run_export_vers_odoo(dolibarr, cyclos, begin, end, progress):
+    rows = _export_vers_odoo_rows(cyclos, begin, end, progress)
+    return b''.join(ExportVersOdooCSVStreamingRenderer().render(rows)).decode('utf-8')
+
+
+# Pour chaque rapport : la fonction qui le calcule et renvoie le résultat sous forme de texte.
+REPORTS = {
+    ReportJob.CALCULATE_3_PERCENT: _run_calculate_3_percent,
+    ReportJob.EXPORT_VERS_ODOO: _run_export_vers_odoo,
+}
+
+
+def submit_job(user, report, begin, end):
+    """
+    Enregistre une demande de rapport et renvoie (job, created).
+
+    Si la période est close (elle se termine avant aujourd'hui) et que le rapport a déjà été calculé après la fin de la
+    période, le résultat ne peut plus changer : on renvoie ce rapport. De même, si le même rapport est déjà en attente
+    ou en cours de calcul, on renvoie celui-ci plutôt que d'en créer un nouveau.
+    """
+    jobs = ReportJob.objects.filter(report=report, begin=begin, end=end)
+    if end < date.today():
+        cached_job = jobs.filter(statut=ReportJob.TERMINE, finished_at__date__gt=end).order_by('-finished_at').first()
+        if cached_job:
+            return cached_job, False
+    pending_job = jobs.filter(statut__in=[ReportJob.EN_ATTENTE, ReportJob.EN_COURS]).order_by('created_at').first()
+    if pending_job:
+        return pending_job, False
+    return ReportJob.objects.create(user=user, report=report, begin=begin, end=end), True
+
+
+def claim_next_job():
+    """
+    Prend le plus ancien rapport en attente et le passe à l'état "en cours".
+    L'UPDATE conditionnel garantit qu'un même rapport n'est pris que par un seul worker.
+    """
+    while True:
+        job = ReportJob.objects.filter(statut=ReportJob.EN_ATTENTE).order_by('created_at').first()
+        if job is None:
+            return None
+        claimed = ReportJob.objects.filter(pk=job.pk, statut=ReportJob.EN_ATTENTE).update(
+            statut=ReportJob.EN_COURS, started_at=timezone.now())
+        if claimed:
+            job.refresh_from_db()
+            return job
+
+
+def run_job(job):
+    """
+    Calcule le rapport avec les sessions Dolibarr et Cyclos de l'utilisateur de service de la gestion interne
+    (GI_SERVICE_LOGIN, voir service_sessions.py).
+
+    Les jetons de l'utilisateur qui a demandé le rapport ont souvent expiré quand le worker le prend : job.user ne sert
+    qu'à savoir qui a demandé le rapport. Seuls les utilisateurs de la gestion interne peuvent demander un rapport
+    (voir submit()).
+    """
+    def progress(percent, message):
+        log.debug("ReportJob {}: {}% {}".format(job.pk, percent, message))
+        ReportJob.objects.filter(pk=job.pk).update(progress=percent, progress_message=message)
+
+    log.info("ReportJob {}: {} from {} to {}".format(job.pk, job.report, job.begin, job.end))
+    try:
+        dolibarr = gi_dolibarr()
+        cyclos = gi_cyclos()
+        result = REPORTS[job.report](dolibarr, cyclos, job.begin, job.end, progress)
+    except Exception as e:
+        log.exception("ReportJob {} failed".format(job.pk))
+        ReportJob.objects.filter(pk=job.pk).update(
+            statut=ReportJob.ERREUR, error=str(e), finished_at=timezone.now())
+    else:
+        ReportJob.objects.filter(pk=job.pk).update(
+            statut=ReportJob.TERMINE, progress=100, progress_message='', result=result, finished_at=timezone.now())
+
+
+def run_worker(poll_interval=5, once=False):
+    """
+    Boucle du worker : exécute les rapports en attente les uns après les autres.
+    """
+    while True:
+        job = claim_next_job()
+        if job is not None:
+            run_job(job)
+        elif once:
+            return
+        else:
+            time.sleep(poll_interval)
+
+
+@api_view(['POST'])
+@permission_classes((IsGestionInterne, ))
+def submit(request):
+    """
+    Demande le calcul d'un rapport.
+    """
+    serializer = serializers.ReportJobSubmitSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)  # log.critical(serializer.errors)
+
+    job, created = submit_job(request.user, serializer.validated_data['report'],
+                              serializer.validated_data['begin'], serializer.validated_data['end'])
+    return Response(serializers.ReportJobSerializer(job).data,
+                    status=status.HTTP_202_ACCEPTED if created else status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes((IsGestionInterne, ))
+def detail(request, pk):
+    """
+    Etat et avancement d'un rapport.
+    """
+    try:
+        job = ReportJob.objects.get(pk=pk)
+    except ReportJob.DoesNotExist:
+        return Response({'error': 'Report job not found!'}, status=status.HTTP_404_NOT_FOUND)
+
+    return Response(serializers.ReportJobSerializer(job).data)
+
+
+@api_view(['GET'])
+@permission_classes((IsGestionInterne, ))
+def result(request, pk):
+    """
+    Résultat d'un rapport terminé : du JSON pour le calcul des 3%, un fichier CSV pour l'export vers Odoo.
+    """
+    try:
+        job = ReportJob.objects.get(pk=pk)
+    except ReportJob.DoesNotExist:
+        return Response({'error': 'Report job not found!'}, status=status.HTTP_404_NOT_FOUND)
+
+    if job.statut != ReportJob.TERMINE:
+        return Response({'error': 'Report job is not finished!'}, status=status.HTTP_400_BAD_REQUEST)
+
+    if job.report == ReportJob.EXPORT_VERS_ODOO:
+        response = HttpResponse(job.result, content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="export_vers_odoo_{}_{}.csv"'.format(
+            job.begin, job.end)
+        return response
+
+    return Response(json.loads(job.result))
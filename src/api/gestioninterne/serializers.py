@@ -1,5 +1,9 @@
+from datetime import date
+
 from rest_framework import serializers
 
+from gestioninterne import models
+
 
 class SortieCoffreSerializer(serializers.Serializer):
 
@@ -56,6 +60,7 @@ class Calculate3PercentSerializer(serializers.Serializer):
 class ExportVersOdooSerializer(serializers.Serializer):
     begin = serializers.DateField(format=None)
     end = serializers.DateField(format=None)
+    stream = serializers.BooleanField(required=False, default=False)
 
 
 class ChangeParVirementSerializer(serializers.Serializer):
@@ -76,3 +81,35 @@ class ResiliationSerializer(serializers.Serializer):
     member_login = serializers.CharField()
     termination_reason = serializers.CharField()
     cessation_of_activity = serializers.BooleanField(required=False)
+
+
+class ReportJobSubmitSerializer(serializers.Serializer):
+    report = serializers.ChoiceField(choices=models.ReportJob.REPORTS)
+    begin = serializers.DateField(format=None)
+    end = serializers.DateField(format=None)
+
+
+class StatementRunSubmitSerializer(serializers.Serializer):
+    month = serializers.DateField(input_formats=['%Y-%m'])
+
+    def validate_month(self, value):
+        if value >= date.today().replace(day=1):
+            raise serializers.ValidationError("Ce mois n'est pas terminé.")
+        return value
+
+
+class StatementRunSerializer(serializers.ModelSerializer):
+    month = serializers.DateField(format='%Y-%m')
+
+    class Meta:
+        model = models.StatementRun
+        fields = ['id', 'month', 'statut', 'total', 'done', 'errors', 'error', 'created_at', 'started_at',
+                  'finished_at']
+
+
+class ReportJobSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = models.ReportJob
+        fields = ['id', 'report', 'begin', 'end', 'statut', 'progress', 'progress_message', 'error', 'created_at',
+                  'started_at', 'finished_at']
@@ -0,0 +1,351 @@
+"""
+Génération en masse des relevés de compte mensuels (PDF et CSV) des adhérents qui ont un compte Eusko numérique.
+
+Jusqu'ici, un relevé n'était généré qu'à la demande (cel.views.export_history_adherent), adhérent par adhérent. Une
+génération (StatementRun) produit les relevés d'un mois pour tous les adhérents, dans MEDIA_ROOT/statements/<AAAA-MM>/ :
+<login>.pdf, <login>.csv et manifest.json, qui décrit les relevés générés et les erreurs.
+
+Les adhérents sont traités par lots : les historiques des comptes d'un lot sont téléchargés en parallèle, puis les
+PDF sont générés en parallèle (autant à la fois que de displays Xvfb, voir pdf_rendering.py). L'état de chaque
+relevé est enregistré (Statement) : une génération interrompue reprend avec les relevés qui ne sont pas terminés.
+
+La commande generate_statements --worker exécute les générations demandées par la gestion interne et, si
+STATEMENTS_USER est renseigné, demande chaque 1er du mois la génération des relevés du mois précédent.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from decimal import Decimal
+import json
+import logging
+import os
+import time
+
+import arrow
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.response import Response
+from rest_framework_csv.renderers import CSVRenderer
+
+from gestioninterne import serializers
+from gestioninterne.balances import accounts_summary, record_balances, summary_with_balance
+from gestioninterne.ledger import fetch_account_history
+from gestioninterne.models import Statement, StatementRun
+from gestioninterne.permissions import IsGestionInterne
+from misc import concurrent_map, write_atomically
+from pdf_rendering import render_pdf
+from service_sessions import gi_cyclos
+
+log = logging.getLogger()
+
+CSV_HEADER = ['Date', 'Libellé', 'Débit', 'Crédit', 'Solde']
+
+# Nombre d'adhérents traités à la fois.
+BATCH_SIZE = 50
+
+
+def iter_statement_lines(account_history, begin_date, initial_balance):
+    """
+    Génère les lignes d'un relevé au fur et à mesure, à partir de l'historique du compte par ordre chronologique
+    (une liste ou un itérateur, comme CyclosAPI.iter_search()) :
+    - une première ligne avec le solde initial du compte,
+    - puis pour chaque ligne de l'historique, une copie de la ligne avec le solde (cumul des lignes précédentes), la
+      date au format JJ/MM/AAAA (on n'affiche pas l'heure dans l'historique) et "Vers : xxx" ou "De : xxx" ajouté à la
+      description, sauf lorsque l'autre compte est un compte système.
+    """
+    yield {
+        'date': arrow.get(begin_date).format('DD/MM/YYYY'),
+        'description': 'Solde initial',
+        'amount': 0,
+        'balance': initial_balance,
+    }
+
+    balance = initial_balance
+    for entry in account_history:
+        balance = float(balance) + float(entry['amount'])
+        description = entry['description']
+        if entry['relatedAccount']['type']['nature'] != 'SYSTEM':
+            description = "{}\r\n{} : {}".format(description, 'Vers' if float(entry['amount']) < 0 else 'De',
+                                                 entry['relatedAccount']['owner']['display'])
+        yield dict(entry, balance=balance, date=arrow.get(entry['date']).format('DD/MM/YYYY'), description=description)
+
+
+def statement_lines(account_history, begin_date, initial_balance):
+    """
+    Lignes d'un relevé (voir iter_statement_lines()), sous forme de liste.
+    """
+    return list(iter_statement_lines(account_history, begin_date, initial_balance))
+
+
+def statement_context(account_summary, lines, login, begin, end):
+    """
+    Contexte du template summary/summary.html (begin et end sont les dates de début et de fin incluses).
+    """
+    return {
+        'account_number': account_summary['number'],
+        'name': account_summary['owner']['display'],
+        'account_history': lines,
+        'account_login': login,
+        'period': {
+            'begin': arrow.get(begin).format('DD MMMM YYYY', locale='fr'),
+            'end': arrow.get(end).format('DD MMMM YYYY', locale='fr'),
+        },
+    }
+
+
+def csv_row(line):
+    """
+    Ligne du relevé au format CSV (voir CSV_HEADER).
+    """
+    return {'Date': line['date'],
+            'Libellé': line['description'],
+            'Crédit': "{0:.2f}".format(float(line['amount'])).replace('.', ',')
+                      if float(line['amount']) > float() else '',
+            'Débit': "{0:.2f}".format(float(line['amount'])).replace('.', ',')
+                     if float(line['amount']) < float() else '',
+            'Solde': "{0:.2f}".format(float(line['balance'])).replace('.', ',')}
+
+
+def csv_rows(lines):
+    return [csv_row(line) for line in lines]
+
+
+def month_directory(month):
+    return os.path.join(settings.MEDIA_ROOT, 'statements', month.strftime('%Y-%m'))
+
+
+def _next_month(month):
+    return (month + timedelta(days=31)).replace(day=1)
+
+
+def _create_statements(cyclos, run):
+    """
+    Crée un relevé à générer pour chaque adhérent qui a un compte Eusko numérique (sauf si c'est déjà fait).
+    """
+    if run.statements.exists():
+        return
+    groups = [str(settings.CYCLOS_CONSTANTS['groups'][group])
+              for group in ('adherents_prestataires', 'adherents_prestataires_avec_paiement_smartphone',
+                            'adherents_utilisateurs')]
+    users = cyclos.user_choices(cyclos.iter_search(method='user/search', data={'groups': groups}))
+    Statement.objects.bulk_create([
+        Statement(run=run, cyclos_id=str(user['value']), login=user['shortLabel'], name=user['label'])
+        for user in users
+    ], batch_size=500, ignore_conflicts=True)
+
+
+def _prepare(cyclos, statement, month):
+    """
+    Télécharge le solde initial et l'historique du compte de l'adhérent pour le mois, et renvoie les lignes et le
+    contexte du relevé (ou None en cas d'erreur, qui est alors enregistrée dans le relevé).
+    """
+    # Pour Cyclos, une date signifie le jour indiqué à zéro heure : la fin de la période est le 1er du mois suivant.
+    begin_date = month.isoformat()
+    end_date = _next_month(month).isoformat()
+    try:
+        account_summary = accounts_summary(cyclos, statement.cyclos_id, month)[0]
+        initial_balance = account_summary['status']['balance']
+        # Les comptes d'un lot sont déjà téléchargés en parallèle : les pages d'un compte sont lues l'une après
+        # l'autre.
+        account_history = fetch_account_history(cyclos, account_summary['status']['accountId'], begin_date, end_date,
+                                                max_workers=1)
+    except Exception as e:
+        log.exception("Statement {} ({})".format(statement.login, month))
+        statement.statut = StatementRun.ERREUR
+        statement.error = str(e)
+        return None
+
+    lines = statement_lines(account_history, begin_date, initial_balance)
+    statement.account_number = account_summary['number']
+    statement.initial_balance = Decimal(str(initial_balance))
+    statement.final_balance = Decimal(str(lines[-1]['balance'])).quantize(Decimal('0.01'))
+    statement.lines = len(lines) - 1
+    # Le solde de fin de mois servira de solde initial pour le relevé du mois suivant.
+    last_day = _next_month(month) - timedelta(days=1)
+    record_balances(statement.cyclos_id, last_day, [summary_with_balance(account_summary, statement.final_balance)])
+    return lines, statement_context(account_summary, lines, statement.login, month, last_day)
+
+
+def _write_files(statement, directory, prepared):
+    if prepared is None:
+        return
+    lines, context = prepared
+    try:
+        write_atomically(os.path.join(directory, '{}.pdf'.format(statement.login)),
+                         render_pdf('summary/summary.html', context))
+        write_atomically(os.path.join(directory, '{}.csv'.format(statement.login)),
+                         CSVRenderer().render(csv_rows(lines), renderer_context={'header': CSV_HEADER}))
+    except Exception as e:
+        log.exception("Statement {} ({})".format(statement.login, statement.run.month))
+        statement.statut = StatementRun.ERREUR
+        statement.error = str(e)
+    else:
+        statement.statut = StatementRun.TERMINE
+        statement.error = ''
+
+
+def write_manifest(run):
+    """
+    Ecrit manifest.json : les relevés générés et les erreurs.
+    """
+    statements = run.statements.order_by('login')
+    manifest = {
+        'month': run.month.strftime('%Y-%m'),
+        'generated_at': timezone.now().isoformat(),
+        'statements': [
+            {'login': statement.login, 'name': statement.name, 'account_number': statement.account_number,
+             'initial_balance': str(statement.initial_balance), 'final_balance': str(statement.final_balance),
+             'lines': statement.lines, 'pdf': '{}.pdf'.format(statement.login), 'csv': '{}.csv'.format(statement.login)}
+            for statement in statements.filter(statut=StatementRun.TERMINE)
+        ],
+        'errors': [{'login': statement.login, 'error': statement.error}
+                   for statement in statements.filter(statut=StatementRun.ERREUR)],
+    }
+    write_atomically(os.path.join(month_directory(run.month), 'manifest.json'),
+                     json.dumps(manifest, indent=2).encode('utf-8'))
+    return manifest
+
+
+def _update_counters(run):
+    run.total = run.statements.count()
+    run.done = run.statements.filter(statut=StatementRun.TERMINE).count()
+    run.errors = run.statements.filter(statut=StatementRun.ERREUR).count()
+    StatementRun.objects.filter(pk=run.pk).update(total=run.total, done=run.done, errors=run.errors)
+
+
+def generate_statements(cyclos, run):
+    """
+    Génère les relevés de la StatementRun qui ne sont pas encore terminés (ceux en erreur sont refaits), puis écrit
+    le manifeste.
+    """
+    _create_statements(cyclos, run)
+    _update_counters(run)
+    directory = month_directory(run.month)
+    pending = list(run.statements.exclude(statut=StatementRun.TERMINE).select_related('run').order_by('pk'))
+    log.info("generate_statements {}: {} statements to generate out of {}".format(
+        run.month.strftime('%Y-%m'), len(pending), run.total))
+
+    with ThreadPoolExecutor(max_workers=max(1, settings.PDF_RENDERING_DISPLAYS)) as executor:
+        for i in range(0, len(pending), BATCH_SIZE):
+            batch = pending[i:i + BATCH_SIZE]
+            prepared = concurrent_map(lambda statement: _prepare(cyclos, statement, run.month), batch)
+            list(executor.map(_write_files, batch, [directory] * len(batch), prepared))
+            Statement.objects.bulk_update(batch, ['statut', 'account_number', 'initial_balance', 'final_balance',
+                                                  'lines', 'error'])
+            _update_counters(run)
+
+    return write_manifest(run)
+
+
+def schedule_previous_month(user):
+    """
+    Demande la génération des relevés du mois précédent, si ce n'est pas déjà fait.
+    """
+    month = (date.today().replace(day=1) - timedelta(days=1)).replace(day=1)
+    return StatementRun.objects.get_or_create(month=month, defaults={'user': user})
+
+
+def claim_next_run():
+    """
+    Prend la plus ancienne génération en attente et la passe à l'état "en cours".
+    L'UPDATE conditionnel garantit qu'une même génération n'est prise que par un seul worker.
+    """
+    while True:
+        run = StatementRun.objects.filter(statut=StatementRun.EN_ATTENTE).order_by('created_at').first()
+        if run is None:
+            return None
+        claimed = StatementRun.objects.filter(pk=run.pk, statut=StatementRun.EN_ATTENTE).update(
+            statut=StatementRun.EN_COURS, started_at=timezone.now())
+        if claimed:
+            run.refresh_from_db()
+            return run
+
+
+def run_statement_run(run):
+    """
+    Exécute la génération avec la session Cyclos de l'utilisateur de service de la gestion interne (GI_SERVICE_LOGIN,
+    voir service_sessions.py) : la session de l'utilisateur qui l'a demandée a souvent expiré quand le worker la prend.
+    Seuls les utilisateurs de la gestion interne peuvent demander une génération (voir submit()).
+    """
+    try:
+        cyclos = gi_cyclos()
+        generate_statements(cyclos, run)
+    except Exception as e:
+        log.exception("StatementRun {} failed".format(run.month))
+        StatementRun.objects.filter(pk=run.pk).update(
+            statut=StatementRun.ERREUR, error=str(e), finished_at=timezone.now())
+    else:
+        StatementRun.objects.filter(pk=run.pk).update(
+            statut=StatementRun.TERMINE, error='', finished_at=timezone.now())
+
+
+def run_worker(poll_interval=60, once=False):
+    """
+    Boucle du worker : demande les relevés du mois précédent (si STATEMENTS_USER est renseigné) et exécute les
+    générations en attente.
+    """
+    statements_user = User.objects.get(username=settings.STATEMENTS_USER) if settings.STATEMENTS_USER else None
+    while True:
+        if statements_user is not None:
+            schedule_previous_month(statements_user)
+        run = claim_next_run()
+        if run is not None:
+            run_statement_run(run)
+        elif once:
+            return
+        else:
+            time.sleep(poll_interval)
+
+
+@api_view(['POST'])
+@permission_classes((IsGestionInterne, ))
+def submit(request):
+    """
+    Demande la génération des relevés d'un mois. Une génération en erreur, ou terminée avec des relevés en erreur,
+    reprend là où elle s'était arrêtée.
+    """
+    serializer = serializers.StatementRunSubmitSerializer(data=request.data)
+    serializer.is_valid(raise_exception=True)  # log.critical(serializer.errors)
+
+    run, created = StatementRun.objects.get_or_create(month=serializer.validated_data['month'],
+                                                      defaults={'user': request.user})
+    if run.statut == StatementRun.ERREUR or (run.statut == StatementRun.TERMINE and run.errors):
+        StatementRun.objects.filter(pk=run.pk).update(statut=StatementRun.EN_ATTENTE, user=request.user, error='')
+        run.refresh_from_db()
+        created = True
+    return Response(serializers.StatementRunSerializer(run).data,
+                    status=status.HTTP_202_ACCEPTED if created else status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@permission_classes((IsGestionInterne, ))
+def detail(request, pk):
+    """
+    Etat et avancement d'une génération.
+    """
+    try:
+        run = StatementRun.objects.get(pk=pk)
+    except StatementRun.DoesNotExist:
+        return Response({'error': 'Statement run not found!'}, status=status.HTTP_404_NOT_FOUND)
+
+    return Response(serializers.StatementRunSerializer(run).data)
+
+
+@api_view(['GET'])
+@permission_classes((IsGestionInterne, ))
+def manifest(request, pk):
+    """
+    Manifeste d'une génération terminée.
+    """
+    try:
+        run = StatementRun.objects.get(pk=pk)
+    except StatementRun.DoesNotExist:
+        return Response({'error': 'Statement run not found!'}, status=status.HTTP_404_NOT_FOUND)
+
+    if run.statut != StatementRun.TERMINE:
+        return Response({'error': 'Statement run is not finished!'}, status=status.HTTP_400_BAD_REQUEST)
+
+    with open(os.path.join(month_directory(run.month), 'manifest.json')) as manifest_file:
+        return Response(json.load(manifest_file))
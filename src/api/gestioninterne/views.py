@@ -4,17 +4,18 @@ import logging
 
 import arrow
 from django.conf import settings
+from django.http import StreamingHttpResponse
 import requests
 from requests.auth import HTTPBasicAuth
 from rest_framework import status
 from rest_framework.decorators import api_view, permission_classes, renderer_classes
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
-from rest_framework_csv.renderers import CSVRenderer
+from rest_framework_csv.renderers import CSVRenderer, CSVStreamingRenderer
 
 from cyclos_api import CyclosAPI, CyclosAPIException
 from dolibarr_api import DolibarrAPI, DolibarrAPIException
-from gestioninterne import serializers
+from gestioninterne import ledger, serializers
 from misc import sendmail_euskalmoneta
 
 log = logging.getLogger()
@@ -73,14 +74,12 @@ def payments_available_for_entree_coffre(request):
         'statuses': [
             str(settings.CYCLOS_CONSTANTS['transfer_statuses']['a_rapprocher']),
         ],
-        'pageSize': 1000,  # maximum pageSize: 1000
-        'currentPage': 0,
     }
-    query_data = cyclos.post(method='account/searchAccountHistory', data=entree_coffre_query)
-    if query_data['result']['totalCount'] == 0:
+    query_data = list(cyclos.iter_search(method='account/searchAccountHistory', data=entree_coffre_query))
+    if not query_data:
         return Response(status=status.HTTP_204_NO_CONTENT)
     else:
-        return Response(query_data['result']['pageItems'])
+        return Response(query_data)
 
 
 @api_view(['POST'])
@@ -214,18 +213,16 @@ def payments_available_for_entrees_euro(request):
         'statuses': [
             str(settings.CYCLOS_CONSTANTS['transfer_statuses']['a_rapprocher']),
         ],
-        'pageSize': 1000,  # maximum pageSize: 1000
-        'currentPage': 0,
     }
 
-    query_data = cyclos.post(method='account/searchAccountHistory', data=query)
-    if query_data['result']['totalCount'] == 0:
+    query_data = list(cyclos.iter_search(method='account/searchAccountHistory', data=query))
+    if not query_data:
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     # Il faut filtrer et ne garder que les paiements de type remise_d_euro_en_caisse
     filtered_data = [
         item
-        for item in query_data['result']['pageItems']
+        for item in query_data
         if item['type']['id'] == str(settings.CYCLOS_CONSTANTS['payment_types']['remise_d_euro_en_caisse'])
     ]
     return Response(filtered_data)
@@ -249,18 +246,16 @@ def payments_available_for_entrees_eusko(request):
         'statuses': [
             str(settings.CYCLOS_CONSTANTS['transfer_statuses']['a_rapprocher']),
         ],
-        'pageSize': 1000,  # maximum pageSize: 1000
-        'currentPage': 0,
     }
 
-    query_data = cyclos.post(method='account/searchAccountHistory', data=query)
-    if query_data['result']['totalCount'] == 0:
+    query_data = list(cyclos.iter_search(method='account/searchAccountHistory', data=query))
+    if not query_data:
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     # Il faut filtrer et ne garder que les paiements de type sortie_caisse_eusko_bdc
     filtered_data = [
         item
-        for item in query_data['result']['pageItems']
+        for item in query_data
         if item['type']['id'] == str(settings.CYCLOS_CONSTANTS['payment_types']['sortie_caisse_eusko_bdc'])
     ]
     return Response(filtered_data)
@@ -321,8 +316,6 @@ def payments_available_for_banques(request):
     bank_history_query = {
         'account': bank_account_id,  # ID du compte
         'orderBy': 'DATE_DESC',
-        'pageSize': 1000,  # maximum pageSize: 1000
-        'currentPage': 0,
     }
 
     if request.query_params['mode'] == 'virement':
@@ -339,12 +332,10 @@ def payments_available_for_banques(request):
         return Response({'error': 'The mode you provided is not supported by this endpoint!'},
                         status=status.HTTP_400_BAD_REQUEST)
 
-    bank_history_data = cyclos.post(method='account/searchAccountHistory', data=bank_history_query)
-    if bank_history_data['result']['totalCount'] == 0:
+    data = list(cyclos.iter_search(method='account/searchAccountHistory', data=bank_history_query))
+    if not data:
         return Response(status=status.HTTP_204_NO_CONTENT)
 
-    data = bank_history_data['result']['pageItems']
-
     # Dans le cas des virements, on ne garde que les paiements rapprochés.
     if request.query_params['mode'] == 'virement':
         data = [
@@ -458,15 +449,13 @@ def payments_available_depots_retraits(request):
         'statuses': [
             str(settings.CYCLOS_CONSTANTS['transfer_statuses']['virements_a_faire']),
         ],
-        'pageSize': 1000,  # maximum pageSize: 1000
-        'currentPage': 0,
     }
-    depots_data = cyclos.post(method='account/searchAccountHistory', data=depots_query)
+    depots_data = cyclos.iter_search(method='account/searchAccountHistory', data=depots_query)
 
     # Il faut filtrer et ne garder que les opérations de type depot_de_billets
     depots_filtered_data = [
         item
-        for item in depots_data['result']['pageItems']
+        for item in depots_data
         if item['type']['id'] == str(settings.CYCLOS_CONSTANTS['payment_types']['depot_de_billets'])
     ]
     res.extend(depots_filtered_data)
@@ -479,15 +468,13 @@ def payments_available_depots_retraits(request):
         'statuses': [
             str(settings.CYCLOS_CONSTANTS['transfer_statuses']['virements_a_faire']),
         ],
-        'pageSize': 1000,  # maximum pageSize: 1000
-        'currentPage': 0,
     }
-    retraits_data = cyclos.post(method='account/searchAccountHistory', data=retraits_query)
+    retraits_data = cyclos.iter_search(method='account/searchAccountHistory', data=retraits_query)
 
     # Il faut filtrer et ne garder que les opérations de type retrait_de_billets
     retraits_filtered_data = [
         item
-        for item in retraits_data['result']['pageItems']
+        for item in retraits_data
         if item['type']['id'] == str(settings.CYCLOS_CONSTANTS['payment_types']['retrait_de_billets'])
     ]
     res.extend(retraits_filtered_data)
@@ -562,15 +549,13 @@ def payments_available_for_reconversions(request):
         'statuses': [
             str(settings.CYCLOS_CONSTANTS['transfer_statuses']['virements_a_faire']),
         ],
-        'pageSize': 1000,  # maximum pageSize: 1000
-        'currentPage': 0,
     }
-    query_billets_data = cyclos.post(method='account/searchAccountHistory', data=query_billets)
+    query_billets_data = cyclos.iter_search(method='account/searchAccountHistory', data=query_billets)
 
     # Il faut filtrer et ne garder que les paiements de type reconversion_billets_versement_des_eusko
     filtered_billets_data = [
         item
-        for item in query_billets_data['result']['pageItems']
+        for item in query_billets_data
         if item['type']['id'] ==
         str(settings.CYCLOS_CONSTANTS['payment_types']['reconversion_billets_versement_des_eusko'])
     ]
@@ -584,15 +569,13 @@ def payments_available_for_reconversions(request):
         'statuses': [
             str(settings.CYCLOS_CONSTANTS['transfer_statuses']['virements_a_faire']),
         ],
-        'pageSize': 1000,  # maximum pageSize: 1000
-        'currentPage': 0,
     }
-    query_numeriques_data = cyclos.post(method='account/searchAccountHistory', data=query_numeriques)
+    query_numeriques_data = cyclos.iter_search(method='account/searchAccountHistory', data=query_numeriques)
 
     # Il faut filtrer et ne garder que les paiements de type reconversion_numerique
     filtered_numeriques_data = [
         item
-        for item in query_numeriques_data['result']['pageItems']
+        for item in query_numeriques_data
         if item['type']['id'] == str(settings.CYCLOS_CONSTANTS['payment_types']['reconversion_numerique'])
     ]
     res.extend(filtered_numeriques_data)
@@ -702,6 +685,28 @@ def calculate_3_percent(request):
     log.debug("begin_date = %s", begin_date)
     log.debug("end_date = %s", end_date)
 
+    # Connexion à Dolibarr et Cyclos.
+    try:
+        dolibarr = DolibarrAPI(api_key=request.user.profile.dolibarr_token)
+    except DolibarrAPIException:
+        return Response({'error': 'Unable to connect to Dolibarr!'}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        cyclos = CyclosAPI(token=request.user.profile.cyclos_token)
+    except CyclosAPIException:
+        return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
+
+    return Response(_calculate_3_percent(dolibarr, cyclos, begin_date, end_date))
+
+
+def _calculate_3_percent(dolibarr, cyclos, begin_date, end_date, progress=None):
+    """
+    Calcule le montant des dons 3% de chaque association pour la
+    période donnée.
+    Si progress est donnée, elle est appelée au fur et à mesure du
+    calcul avec un pourcentage d'avancement et un message.
+    """
+    progress = progress or _no_progress
+
     # Pour les recherches dans les historiques de compte de Cyclos, on
     # prend le lendemain de la date de fin demandée car Cyclos utilise
     # des DateTime et si l'heure n'est pas précisée, c'est minuit (heure
@@ -717,16 +722,6 @@ def calculate_3_percent(request):
     log.debug("search_begin_date = %s", search_begin_date)
     log.debug("search_end_date = %s", search_end_date)
 
-    # Connexion à Dolibarr et Cyclos.
-    try:
-        dolibarr = DolibarrAPI(api_key=request.user.profile.dolibarr_token)
-    except DolibarrAPIException:
-        return Response({'error': 'Unable to connect to Dolibarr!'}, status=status.HTTP_400_BAD_REQUEST)
-    try:
-        cyclos = CyclosAPI(token=request.user.profile.cyclos_token)
-    except CyclosAPIException:
-        return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
-
     # On récupère la liste de tous les changes d'€ en eusko pour la
     # période demandée et on détermine à chaque fois qui est l'adhérent
     # qui a fait le change.
@@ -741,6 +736,7 @@ def calculate_3_percent(request):
     # est le Compte de débit eusko numérique, le compte destinataire est
     # le compte de l'adhérent.
     changes = []
+    progress(0, "Recherche des changes billets et numériques en BDC")
     # 1) et 2) On récupère tous les débits du Compte de débit € pour la
     # période puis on filtre le résultat pour ne garder que les 2 types
     # de paiements "change billets" et "change numérique en BDC".
@@ -755,18 +751,20 @@ def calculate_3_percent(request):
             str(settings.CYCLOS_CONSTANTS['payment_types']['change_numerique_en_bdc_versement_des_euro']),
         ]
     )
+    # On mémorise l'id Cyclos de l'adhérent pour chaque change, les
+    # adhérents seront chargés tous ensemble une fois tous les changes
+    # récupérés.
     for payment in payments:
         for value in payment['customValues']:
             if value['field']['internalName'] == 'adherent':
-                cyclos_user_id = value['linkedEntityValue']['user']['id']
-                cyclos_user = cyclos.post(method='user/load', data=[cyclos_user_id])['result']
                 changes.append(
                     {'amount' : abs(float(payment['amount'])),
-                     'member_id' : cyclos_user['username']}
+                     'cyclos_user_id' : value['linkedEntityValue']['user']['id']}
                 )
     # 3) On récupère tous les débits du Compte de débit eusko numérique
     # pour la période puis on filtre le résultat pour ne garder que les
     # paiements de type "change numérique en ligne".
+    progress(30, "Recherche des changes numériques en ligne")
     payments = _search_account_history(
         cyclos=cyclos,
         account=settings.CYCLOS_CONSTANTS['system_accounts']['compte_de_debit_eusko_numerique'],
@@ -778,16 +776,26 @@ def calculate_3_percent(request):
         ]
     )
     for payment in payments:
-        cyclos_user_id = payment['relatedAccount']['owner']['id']
-        cyclos_user = cyclos.post(method='user/load', data=[cyclos_user_id])['result']
         changes.append(
             {'amount' : abs(float(payment['amount'])),
-             'member_id' : cyclos_user['username']}
+             'cyclos_user_id' : payment['relatedAccount']['owner']['id']}
         )
 
+    # On charge en une seule fois (requêtes en parallèle) tous les
+    # adhérents qui ont fait du change, pour avoir leur numéro d'adhérent.
+    progress(60, "Chargement des adhérents")
+    cyclos_users = cyclos.load_users([change['cyclos_user_id'] for change in changes])
+    for change in changes:
+        change['member_id'] = cyclos_users[change['cyclos_user_id']]['username']
+
+    # On récupère aussi tous ces adhérents dans Dolibarr, avec quelques
+    # requêtes "login IN (...)" plutôt qu'une requête par adhérent.
+    dolibarr_members = dolibarr.get_members_by_logins([change['member_id'] for change in changes])
+
     # On récupère la liste de toutes les associations
     # et on construit un dictionnaire qui va donner la correspondance :
     #     id de l'asso dans Dolibarr -> numéro d'adhérent
+    progress(90, "Calcul des dons")
     results = dolibarr.get(model='associations')
     dolibarr_id_2_member_id = {item['id'] : item['code_client']
                               for item in results}
@@ -831,8 +839,8 @@ def calculate_3_percent(request):
             # association il parraine en 1er choix.
             # Si c'est une asso 3%, c'est elle qui reçoit les dons.
             try:
-                member_data = dolibarr.get(model='members', sqlfilters="login='{}'".format(member_id))[0]
-            except DolibarrAPIException:
+                member_data = dolibarr_members[member_id]
+            except KeyError:
                 # Si on ne parvient pas à récupérer l'adhérent-e dans Dolibarr,
                 # on ignore l'erreur et on considère simplement qu'on n'a
                 # aucune information sur cet adhérent-e. Du coup c'est
@@ -905,13 +913,17 @@ def calculate_3_percent(request):
         'montant_total_dons': round(montant_total_dons, 2),
     }
     log.debug("response_data = %s", response_data)
-    return Response(response_data)
+    return response_data
 
 
 class ExportVersOdooCSVRenderer(CSVRenderer):
     header = ['journal_id', 'date', 'ref', 'line_ids/account_id', 'line_ids/name', 'line_ids/debit', 'line_ids/credit']
 
 
+class ExportVersOdooCSVStreamingRenderer(CSVStreamingRenderer):
+    header = ExportVersOdooCSVRenderer.header
+
+
 @api_view(['GET'])
 @renderer_classes((ExportVersOdooCSVRenderer,))
 def export_vers_odoo(request):
@@ -928,15 +940,6 @@ def export_vers_odoo(request):
     des eusko".
     """
 
-    # Pseudo-constantes pour les noms des journaux et les comptes dans Odoo.
-    JOURNAL_OPERATIONS_DIVERSES = 'Opérations diverses'
-    COMPTE_EUSKO_BILLETS_EN_CIRCULATION = '463300'
-    COMPTE_FACTURATION_EUSKO_BILLETS = '463309'
-    COMPTE_EUSKO_NUMERIQUES_EN_CIRCULATION = '463400'
-    COMPTE_FACTURATION_EUSKO_NUMERIQUES = '463409'
-    COMPTE_FACTURATION_COTISATIONS = '463500'
-    COMPTE_COTISATIONS_PARTICULIERS = '756100'
-
     # On valide et on récupère les paramètres de la requête.
     serializer = serializers.ExportVersOdooSerializer(data=request.query_params)
     serializer.is_valid(raise_exception=True)  # log.critical(serializer.errors)
@@ -944,10 +947,6 @@ def export_vers_odoo(request):
     begin_date = serializer.data['begin']
     end_date = serializer.data['end']
 
-    # Voir le commentaire du même code ci-dessus dans calculate_3_percent.
-    search_begin_date = begin_date.isoformat()
-    search_end_date = (end_date + timedelta(days=1)).isoformat()
-
     # Connexion à Dolibarr et Cyclos.
     try:
         dolibarr = DolibarrAPI(api_key=request.user.profile.dolibarr_token)
@@ -958,6 +957,48 @@ def export_vers_odoo(request):
     except CyclosAPIException:
         return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
 
+    # Les lignes du fichier CSV sont produites au fur et à mesure du
+    # traitement des opérations, par un générateur.
+    rows = _export_vers_odoo_rows(cyclos, begin_date, end_date)
+
+    if serializer.data['stream']:
+        # En mode streaming, chaque ligne est envoyée dès qu'elle est
+        # produite : le téléchargement commence tout de suite et le
+        # fichier n'est jamais entièrement en mémoire. Par contre, si
+        # une erreur se produit en cours de route, le fichier sera
+        # incomplet (la réponse a déjà commencé).
+        response = StreamingHttpResponse(ExportVersOdooCSVStreamingRenderer().render(rows),
+                                         content_type='text/csv; charset=utf-8')
+        response['Content-Disposition'] = 'attachment; filename="export_vers_odoo_{}_{}.csv"'.format(
+            begin_date, end_date)
+        return response
+
+    return Response(list(rows))
+
+
+def _export_vers_odoo_rows(cyclos, begin_date, end_date, progress=None):
+    """
+    Génère les lignes du fichier CSV de export_vers_odoo, section par
+    section (gains, pertes, banques, reconversions, changes, dépôts et
+    retraits).
+    Si progress est donnée, elle est appelée au début de chaque section
+    avec un pourcentage d'avancement et un message.
+    """
+    progress = progress or _no_progress
+
+    # Voir le commentaire du même code dans _calculate_3_percent.
+    search_begin_date = begin_date.isoformat()
+    search_end_date = (end_date + timedelta(days=1)).isoformat()
+
+    # Pseudo-constantes pour les noms des journaux et les comptes dans Odoo.
+    JOURNAL_OPERATIONS_DIVERSES = 'Opérations diverses'
+    COMPTE_EUSKO_BILLETS_EN_CIRCULATION = '463300'
+    COMPTE_FACTURATION_EUSKO_BILLETS = '463309'
+    COMPTE_EUSKO_NUMERIQUES_EN_CIRCULATION = '463400'
+    COMPTE_FACTURATION_EUSKO_NUMERIQUES = '463409'
+    COMPTE_FACTURATION_COTISATIONS = '463500'
+    COMPTE_COTISATIONS_PARTICULIERS = '756100'
+
     # On traite successivement tous les types d'opérations de Cyclos qui
     # doivent être enregistrées en comptabilité. Pour chaque opération,
     # une pièce comptable au format CSV va être créée. Chaque pièce
@@ -974,9 +1015,9 @@ def export_vers_odoo(request):
     # cotisations en eusko car c'est toujours le même compte qui est
     # débité alors qu'en faisant la recherche des crédits, il faudrait
     # passer en revue tous les bureaux de change).
-    csv_content = []
 
     # Gains de billets d'eusko.
+    progress(0, "Gains de billets d'eusko")
     payments = _search_account_history(
         cyclos=cyclos,
         account=settings.CYCLOS_CONSTANTS['system_accounts']['compte_des_billets_en_circulation'],
@@ -989,12 +1030,14 @@ def export_vers_odoo(request):
     )
     for payment in payments:
         amount = abs(float(payment['amount']))
-        _add_account_entry(csv_content, JOURNAL_OPERATIONS_DIVERSES,
-                           payment['date'], payment['description'],
-                           [{ 'account_id': COMPTE_EUSKO_BILLETS_EN_CIRCULATION, 'debit': amount },
-                            { 'account_id': COMPTE_FACTURATION_EUSKO_BILLETS, 'credit': amount }])
+        yield from _account_entry_rows(
+            JOURNAL_OPERATIONS_DIVERSES,
+            payment['date'], payment['description'],
+            [{ 'account_id': COMPTE_EUSKO_BILLETS_EN_CIRCULATION, 'debit': amount },
+             { 'account_id': COMPTE_FACTURATION_EUSKO_BILLETS, 'credit': amount }])
 
     # Pertes de billets d'eusko.
+    progress(10, "Pertes de billets d'eusko")
     payments = _search_account_history(
         cyclos=cyclos,
         account=settings.CYCLOS_CONSTANTS['system_accounts']['compte_des_billets_en_circulation'],
@@ -1006,12 +1049,14 @@ def export_vers_odoo(request):
         ]
     )
     for payment in payments:
-        _add_account_entry(csv_content, JOURNAL_OPERATIONS_DIVERSES,
-                           payment['date'], payment['description'],
-                           [{ 'account_id': COMPTE_FACTURATION_EUSKO_BILLETS, 'debit': payment['amount'] },
-                            { 'account_id': COMPTE_EUSKO_BILLETS_EN_CIRCULATION, 'credit': payment['amount'] }])
+        yield from _account_entry_rows(
+            JOURNAL_OPERATIONS_DIVERSES,
+            payment['date'], payment['description'],
+            [{ 'account_id': COMPTE_FACTURATION_EUSKO_BILLETS, 'debit': payment['amount'] },
+             { 'account_id': COMPTE_EUSKO_BILLETS_EN_CIRCULATION, 'credit': payment['amount'] }])
 
     # Opérations concernant les banques de dépôt.
+    progress(20, "Opérations concernant les banques de dépôt")
     for banque in ('CAMPG', 'LBPO',) :
         # On commence par récupérer l'identifiant du compte de la banque.
         bank_user_data = cyclos.post(method='user/search', data={'keywords': banque})['result']['pageItems'][0]
@@ -1043,24 +1088,28 @@ def export_vers_odoo(request):
                     montant_changes_numerique = float(value['decimalValue'])
             # On génère une pièce comptable par "facture".
             if montant_cotisations > float():
-                _add_account_entry(csv_content, JOURNAL_OPERATIONS_DIVERSES,
-                                   payment['date'], payment['description'],
-                                   [{ 'account_id': COMPTE_FACTURATION_COTISATIONS, 'debit': montant_cotisations },
-                                    { 'account_id': COMPTE_COTISATIONS_PARTICULIERS, 'credit': montant_cotisations }])
+                yield from _account_entry_rows(
+                    JOURNAL_OPERATIONS_DIVERSES,
+                    payment['date'], payment['description'],
+                    [{ 'account_id': COMPTE_FACTURATION_COTISATIONS, 'debit': montant_cotisations },
+                     { 'account_id': COMPTE_COTISATIONS_PARTICULIERS, 'credit': montant_cotisations }])
             if montant_changes_billet > float():
-                _add_account_entry(csv_content, JOURNAL_OPERATIONS_DIVERSES,
-                                   payment['date'], payment['description'],
-                                   [{ 'account_id': COMPTE_FACTURATION_EUSKO_BILLETS, 'debit': montant_changes_billet },
-                                    { 'account_id': COMPTE_EUSKO_BILLETS_EN_CIRCULATION, 'credit': montant_changes_billet }])
+                yield from _account_entry_rows(
+                    JOURNAL_OPERATIONS_DIVERSES,
+                    payment['date'], payment['description'],
+                    [{ 'account_id': COMPTE_FACTURATION_EUSKO_BILLETS, 'debit': montant_changes_billet },
+                     { 'account_id': COMPTE_EUSKO_BILLETS_EN_CIRCULATION, 'credit': montant_changes_billet }])
             if montant_changes_numerique > float():
-                _add_account_entry(csv_content, JOURNAL_OPERATIONS_DIVERSES,
-                                   payment['date'], payment['description'],
-                                   [{ 'account_id': COMPTE_FACTURATION_EUSKO_NUMERIQUES, 'debit': montant_changes_numerique },
-                                    { 'account_id': COMPTE_EUSKO_NUMERIQUES_EN_CIRCULATION, 'credit': montant_changes_numerique }])
+                yield from _account_entry_rows(
+                    JOURNAL_OPERATIONS_DIVERSES,
+                    payment['date'], payment['description'],
+                    [{ 'account_id': COMPTE_FACTURATION_EUSKO_NUMERIQUES, 'debit': montant_changes_numerique },
+                     { 'account_id': COMPTE_EUSKO_NUMERIQUES_EN_CIRCULATION, 'credit': montant_changes_numerique }])
 
     # Reconversions d’eusko en €.
     # On se base sur les virements de remboursement faits depuis les
     # comptes dédiés.
+    progress(50, "Reconversions d'eusko en €")
     payments = _search_account_history(
         cyclos=cyclos,
         account=settings.CYCLOS_CONSTANTS['system_accounts']['compte_de_debit_euro'],
@@ -1079,10 +1128,11 @@ def export_vers_odoo(request):
         elif payment['relatedAccount']['owner']['id'] == str(settings.CYCLOS_CONSTANTS['users']['compte_dedie_eusko_numerique']):
             compte_eusko_en_circulation = COMPTE_EUSKO_NUMERIQUES_EN_CIRCULATION
             compte_facturation = COMPTE_FACTURATION_EUSKO_NUMERIQUES
-        _add_account_entry(csv_content, JOURNAL_OPERATIONS_DIVERSES,
-                           payment['date'], payment['description'],
-                           [{ 'account_id': compte_eusko_en_circulation, 'debit': amount },
-                            { 'account_id': compte_facturation, 'credit': amount }])
+        yield from _account_entry_rows(
+            JOURNAL_OPERATIONS_DIVERSES,
+            payment['date'], payment['description'],
+            [{ 'account_id': compte_eusko_en_circulation, 'debit': amount },
+             { 'account_id': compte_facturation, 'credit': amount }])
 
     # Change d’eusko numérique par virement ou prélèvement.
     # Pour ne pas avoir tous les changes de manière individuelle, afin
@@ -1090,6 +1140,7 @@ def export_vers_odoo(request):
     # paiements par date et selon leur description (de manière à
     # regrouper les changes par virement d'un côté et ceux par
     # prélèvement de l'autre).
+    progress(65, "Changes d'eusko numériques par virement ou prélèvement")
     payments = _search_account_history(
         cyclos=cyclos,
         account=settings.CYCLOS_CONSTANTS['system_accounts']['compte_de_debit_eusko_numerique'],
@@ -1113,13 +1164,15 @@ def export_vers_odoo(request):
     for key, amount in grouped_payments.items():
         date = key[:len('YYYY-MM-DD')]
         description = key[len('YYYY-MM-DD#'):]
-        _add_account_entry(csv_content, JOURNAL_OPERATIONS_DIVERSES,
-                           date, description,
-                           [{ 'account_id': COMPTE_FACTURATION_EUSKO_NUMERIQUES, 'debit': amount },
-                            { 'account_id': COMPTE_EUSKO_NUMERIQUES_EN_CIRCULATION, 'credit': amount }])
+        yield from _account_entry_rows(
+            JOURNAL_OPERATIONS_DIVERSES,
+            date, description,
+            [{ 'account_id': COMPTE_FACTURATION_EUSKO_NUMERIQUES, 'debit': amount },
+             { 'account_id': COMPTE_EUSKO_NUMERIQUES_EN_CIRCULATION, 'credit': amount }])
 
     # Dépôts et retraits.
     # On se base sur les virements de régularisation entre comptes dédiés.
+    progress(80, "Dépôts et retraits")
     # 1) Si retraits > dépôts, virement du Compte dédié numérique vers le Compte dédié billet.
     account_query = [str(settings.CYCLOS_CONSTANTS['users']['compte_dedie_eusko_numerique']), None]
     account_data = cyclos.post(method='account/getAccountsSummary', data=account_query)['result'][0]
@@ -1136,12 +1189,13 @@ def export_vers_odoo(request):
     )
     for payment in payments:
         amount = abs(float(payment['amount']))
-        _add_account_entry(csv_content, JOURNAL_OPERATIONS_DIVERSES,
-                           payment['date'], payment['description'],
-                           [{ 'account_id': COMPTE_EUSKO_NUMERIQUES_EN_CIRCULATION, 'debit': amount },
-                            { 'account_id': COMPTE_FACTURATION_EUSKO_NUMERIQUES, 'credit': amount },
-                            { 'account_id': COMPTE_FACTURATION_EUSKO_BILLETS, 'debit': amount },
-                            { 'account_id': COMPTE_EUSKO_BILLETS_EN_CIRCULATION, 'credit': amount }])
+        yield from _account_entry_rows(
+            JOURNAL_OPERATIONS_DIVERSES,
+            payment['date'], payment['description'],
+            [{ 'account_id': COMPTE_EUSKO_NUMERIQUES_EN_CIRCULATION, 'debit': amount },
+             { 'account_id': COMPTE_FACTURATION_EUSKO_NUMERIQUES, 'credit': amount },
+             { 'account_id': COMPTE_FACTURATION_EUSKO_BILLETS, 'debit': amount },
+             { 'account_id': COMPTE_EUSKO_BILLETS_EN_CIRCULATION, 'credit': amount }])
     # 2) Si dépôts > retraits, virement du Compte dédié billet vers le Compte dédié numérique.
     account_query = [str(settings.CYCLOS_CONSTANTS['users']['compte_dedie_eusko_billet']), None]
     account_data = cyclos.post(method='account/getAccountsSummary', data=account_query)['result'][0]
@@ -1158,88 +1212,64 @@ def export_vers_odoo(request):
     )
     for payment in payments:
         amount = abs(float(payment['amount']))
-        _add_account_entry(csv_content, JOURNAL_OPERATIONS_DIVERSES,
-                           payment['date'], payment['description'],
-                           [{ 'account_id': COMPTE_EUSKO_BILLETS_EN_CIRCULATION, 'debit': amount },
-                            { 'account_id': COMPTE_FACTURATION_EUSKO_BILLETS, 'credit': amount },
-                            { 'account_id': COMPTE_FACTURATION_EUSKO_NUMERIQUES, 'debit': amount },
-                            { 'account_id': COMPTE_EUSKO_NUMERIQUES_EN_CIRCULATION, 'credit': amount }])
+        yield from _account_entry_rows(
+            JOURNAL_OPERATIONS_DIVERSES,
+            payment['date'], payment['description'],
+            [{ 'account_id': COMPTE_EUSKO_BILLETS_EN_CIRCULATION, 'debit': amount },
+             { 'account_id': COMPTE_FACTURATION_EUSKO_BILLETS, 'credit': amount },
+             { 'account_id': COMPTE_FACTURATION_EUSKO_NUMERIQUES, 'debit': amount },
+             { 'account_id': COMPTE_EUSKO_NUMERIQUES_EN_CIRCULATION, 'credit': amount }])
 
-    return Response(csv_content)
+
+def _no_progress(percent, message):
+    """
+    Progress callback used when the progress of a report is not needed.
+    """
+    pass
 
 
-def _search_account_history(cyclos, account, direction, begin_date, end_date, payment_types=[]):
+def _search_account_history(cyclos, account, direction, begin_date, end_date, payment_types=[], max_workers=None):
     """
     Search an account history for payments of the given types, ignoring
     the chargedbacked (cancelled) ones.
+
+    The history is read from the local copy of the Cyclos account
+    history, which is first completed with the entries missing for the
+    given period (see gestioninterne/ledger.py), unless the
+    CYCLOS_LEDGER_ENABLED setting is off.
+    Requests to Cyclos are done in parallel, max_workers limits the
+    number of concurrent requests (by default, the API_MAX_WORKERS
+    setting).
     """
-    current_page = 0
-    account_history = []
-    while True:
-        search_history_data = {
-            'account': account,
-            'direction': direction,
-            'period':
-            {
-                'begin': begin_date,
-                'end': end_date,
-            },
-            'orderBy': 'DATE_ASC',
-            'pageSize': 1000,  # maximum pageSize: 1000
-            'currentPage': current_page,
-        }
-        search_history_res = cyclos.post(method='account/searchAccountHistory', data=search_history_data)
-        account_history.extend(search_history_res['result']['pageItems'])
-        page_count = search_history_res['result']['pageCount']
-        if page_count == 0 or current_page + 1 == page_count:
-            break
-        else:
-           current_page += 1
-    filtered_history = []
-    for entry in account_history:
-        # On filtre d'abord par type de paiement et ensuite on regarde
-        # si le paiement a fait l'objet d'une opposition de paiement
-        # (dans cet ordre car pour voir s'il y a une oppostion de
-        # paiement, il faut faire une requête au serveur).
-        # On récupère les données de la transaction et on vérifie si la
-        # donnée 'chargedBackBy' est présente dans le transfert associé.
-        #
-        # Note : Les transactions importées lors de la migration de
-        # Cyclos 3 à Cyclos 4 sont de type ImportedTransactionData et
-        # n'ont pas de transfert associé. Elles ne peuvent pas être
-        # annulées. Les transactions enregistrées depuis (les
-        # transactions "normales" en quelque sorte), sont de type
-        # PaymentData.
-        if entry['type']['id'] in payment_types:
-            get_data_res = cyclos.get(method='transaction/getData/{}'.format(entry['transactionId']))
-            transaction_data = get_data_res['result']
-            if (transaction_data['class'] ==
-                    'org.cyclos.model.banking.transactions.ImportedTransactionData'
-                    or (transaction_data['class'] ==
-                    'org.cyclos.model.banking.transactions.PaymentData'
-                    and'chargedBackBy' not in transaction_data['transfer'].keys())):
-                filtered_history.append(entry)
-    return filtered_history
-
-
-def _add_account_entry(csv_content, journal_id, date, description, lines):
+    # On filtre d'abord par type de paiement et ensuite on regarde
+    # si le paiement a fait l'objet d'une opposition de paiement
+    # (dans cet ordre car pour voir s'il y a une oppostion de
+    # paiement, il faut faire une requête au serveur).
+    if settings.CYCLOS_LEDGER_ENABLED:
+        ledger.sync_account_history(cyclos, account, begin_date, end_date, max_workers)
+        candidates = ledger.search_account_history(account, direction, begin_date, end_date, payment_types)
+    else:
+        account_history = ledger.fetch_account_history(cyclos, account, begin_date, end_date, direction, max_workers)
+        candidates = [entry for entry in account_history if entry['type']['id'] in payment_types]
+    return ledger.filter_charged_back(cyclos, candidates, max_workers)
+
+
+def _account_entry_rows(journal_id, date, description, lines):
     """
-    Add an account entry to the given list, in order to generate a CSV
+    Generate the rows of an account entry, in order to generate a CSV
     file that will be imported in Odoo.
     The account entry is created in the given journal and with the given
     lines. A line is a dictionary:
     { 'account_id': xxx, 'debit' or 'credit': xxx }
     """
     for counter, line in enumerate(lines):
-        csv_content.extend([
-            {'journal_id': journal_id if counter == 0 else '',
-             'date': arrow.get(date).format('YYYY-MM-DD') if counter == 0 else '',
-             'ref': description if counter == 0 else '',
-             'line_ids/account_id': line['account_id'],
-             'line_ids/name': description,
-             'line_ids/debit': line['debit'] if 'debit' in line else '',
-             'line_ids/credit': line['credit'] if 'credit' in line else ''}
-        ])
+        yield {'journal_id': journal_id if counter == 0 else '',
+               'date': arrow.get(date).format('YYYY-MM-DD') if counter == 0 else '',
+               'ref': description if counter == 0 else '',
+               'line_ids/account_id': line['account_id'],
+               'line_ids/name': description,
+               'line_ids/debit': line['debit'] if 'debit' in line else '',
+               'line_ids/credit': line['credit'] if 'credit' in line else ''}
 
 
 @api_view(['POST'])
@@ -1266,6 +1296,7 @@ def execute_changes_par_virement(request):
     except CyclosAPIException:
         return Response({'error': 'Unable to connect to Cyclos!'}, status=status.HTTP_400_BAD_REQUEST)
 
+    cyclos.warm_up_member_ids([change['member_login'] for change in changes])
     for change in changes:
         try:
             # On récupère les données de l'adhérent.
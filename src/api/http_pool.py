@@ -0,0 +1,33 @@
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(name, pool_size):
+    """
+    Return the process-wide HTTP session used for the backend called `name`.
+
+    The session keeps its connections alive and reuses them between calls, up to `pool_size` connections per host,
+    so that we don't open a new TCP connection for every API call.
+    """
+    try:
+        return _sessions[name]
+    except KeyError:
+        pass
+
+    with _sessions_lock:
+        if name not in _sessions:
+            log.debug("Creating HTTP session for {} (pool size: {})".format(name, pool_size))
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, pool_block=True)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[name] = session
+        return _sessions[name]
@@ -0,0 +1,208 @@
+"""
+Index local des adhérents Dolibarr, pour les recherches par nom, email ou numéro d'adhérent.
+
+Les front-ends BDC et GI font une recherche à chaque frappe (autocomplétion), et chaque recherche par nom était un
+LIKE '%nom%' dans Dolibarr. On recopie donc les adhérents dans la table MemberIndex, avec les trigrammes des mots de
+leurs noms (MemberTrigram). La commande sync_member_index met l'index à jour : elle ne demande à Dolibarr que les
+adhérents modifiés depuis la synchronisation précédente. Les adhérents créés ou modifiés par l'API sont mis à jour tout
+de suite.
+
+Tant que l'index est vide (la commande n'a jamais été exécutée), les recherches sont faites dans Dolibarr. Ensuite,
+une recherche qui ne trouve personne dans l'index est refaite dans Dolibarr, pour les adhérents créés ou modifiés
+directement dans Dolibarr depuis la dernière synchronisation. Les adhérents modifiés directement dans Dolibarr sont
+donc vus avec un retard d'au plus l'intervalle de synchronisation (--interval), et les adhérents supprimés dans
+Dolibarr restent dans l'index jusqu'à la synchronisation complète suivante (--full-interval).
+
+L'index renvoie les fiches complètes des adhérents, sans passer par les droits Dolibarr de l'utilisateur : il n'est
+utilisé que pour les utilisateurs des front-ends BDC et GI (voir may_use_index()), les autres cherchent dans Dolibarr.
+"""
+from datetime import datetime, timedelta
+import json
+import logging
+import unicodedata
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from cyclos_api import CyclosAPI, CyclosAPIException, CyclosAPILoggedOutException
+from dolibarr_api import DolibarrAPIException
+from members.models import MemberIndex, MemberTrigram
+
+log = logging.getLogger()
+
+# Nombre d'adhérents demandés à Dolibarr par requête lors de la synchronisation.
+PAGE_SIZE = 500
+
+# Nombre maximum de résultats d'une recherche par nom (c'est aussi la limite par défaut de l'API Dolibarr).
+SEARCH_LIMIT = 100
+
+# Groupes Cyclos des utilisateurs qui peuvent chercher dans l'index : ils ont accès à tous les adhérents dans Dolibarr.
+INDEX_GROUPS = ('gestion_interne', 'operateurs_bdc')
+
+
+def normalize(text):
+    """
+    Met le texte en minuscules et retire les accents.
+    """
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def trigrams(text):
+    """
+    Trigrammes des mots du texte (les mots de moins de 3 lettres n'en ont pas).
+    """
+    return {word[i:i + 3] for word in text.split() for i in range(len(word) - 2)}
+
+
+def _search_text(member):
+    return ' '.join(normalize(member[field]) for field in ('firstname', 'lastname', 'societe') if member.get(field))
+
+
+def _modified_at(member):
+    # 'datem' est la date de dernière modification de l'adhérent (timestamp).
+    try:
+        return datetime.fromtimestamp(int(member['datem']), tz=timezone.utc)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def is_ready():
+    return MemberIndex.objects.exists()
+
+
+def may_use_index(user):
+    """
+    Indique si l'utilisateur peut chercher dans l'index : seuls les utilisateurs des groupes INDEX_GROUPS y ont accès.
+    Le groupe Cyclos de l'utilisateur est gardé avec sa session Cyclos (voir CyclosAPI.get_current_user_group_id()).
+    """
+    if not user or not user.is_authenticated:
+        return False
+    try:
+        group_id = CyclosAPI(token=user.profile.cyclos_token).get_current_user_group_id()
+    except (CyclosAPIException, CyclosAPILoggedOutException):
+        return False
+    return group_id in [str(settings.CYCLOS_CONSTANTS['groups'][group]) for group in INDEX_GROUPS]
+
+
+@transaction.atomic
+def index_member(member):
+    """
+    Ajoute ou met à jour un adhérent (tel que renvoyé par l'API Dolibarr) dans l'index.
+    """
+    search_text = _search_text(member)
+    entry, created = MemberIndex.objects.update_or_create(
+        member_id=int(member['id']),
+        defaults={
+            'login': member.get('login') or '',
+            'email': member.get('email') or '',
+            'statut': str(member.get('statut')),
+            'lastname': member.get('lastname') or '',
+            'search_text': search_text,
+            'data': json.dumps(member),
+            'modified_at': _modified_at(member),
+        })
+    if not created:
+        MemberTrigram.objects.filter(member=entry).delete()
+        # Le nom de l'adhérent a pu changer : on oublie son identité Cyclos (voir CyclosAPI.resolve_account_numbers()).
+        if entry.login:
+            CyclosAPI.invalidate_identity(entry.login)
+    MemberTrigram.objects.bulk_create([MemberTrigram(member=entry, trigram=trigram)
+                                       for trigram in trigrams(search_text)])
+    return entry
+
+
+def refresh_member(dolibarr, member_id, api_key=None):
+    """
+    Relit un adhérent dans Dolibarr et le met à jour dans l'index, après une création ou une modification par l'API.
+    Une erreur ici ne doit pas faire échouer la requête : l'adhérent sera mis à jour par la prochaine synchronisation.
+    """
+    try:
+        index_member(dolibarr.get(model='members', id=member_id, api_key=api_key))
+    except Exception:
+        log.exception("Unable to refresh member {} in the member index".format(member_id))
+
+
+def sync_member_index(dolibarr, full=False):
+    """
+    Recopie dans l'index les adhérents modifiés dans Dolibarr depuis la dernière synchronisation (tous les adhérents
+    si full=True ou si l'index est vide), et renvoie le nombre d'adhérents recopiés.
+
+    On repart de la date de modification la plus récente de l'index, moins MEMBER_INDEX_OVERLAP secondes pour ne pas
+    rater les adhérents modifiés pendant la synchronisation précédente. Lors d'une synchronisation complète, les
+    adhérents qui n'existent plus dans Dolibarr sont retirés de l'index.
+    """
+    sqlfilters = None
+    if not full:
+        last_modified_at = MemberIndex.objects.aggregate(last=Max('modified_at'))['last']
+        if last_modified_at:
+            since = timezone.localtime(last_modified_at - timedelta(seconds=settings.MEMBER_INDEX_OVERLAP))
+            sqlfilters = "tms >= '{}'".format(since.strftime('%Y-%m-%d %H:%M:%S'))
+
+    seen = set()
+    complete = False
+    page = 0
+    while True:
+        query = {'limit': PAGE_SIZE, 'page': page, 'sortfield': 't.rowid', 'sortorder': 'ASC'}
+        if sqlfilters:
+            query['sqlfilters'] = sqlfilters
+        try:
+            members = dolibarr.get(model='members', **query)
+        except DolibarrAPIException:
+            # Dolibarr answers 404 when there are no more members.
+            break
+        for member in members:
+            index_member(member)
+            seen.add(int(member['id']))
+        if len(members) < PAGE_SIZE:
+            complete = True
+            break
+        page += 1
+
+    if full and complete:
+        removed = set(MemberIndex.objects.values_list('member_id', flat=True)) - seen
+        if removed:
+            MemberIndex.objects.filter(member_id__in=removed).delete()
+    log.info("sync_member_index: {} members".format(len(seen)))
+    return len(seen)
+
+
+def _members(entries):
+    return [json.loads(data) for data in entries.values_list('data', flat=True)]
+
+
+def search_by_login(login):
+    return _members(MemberIndex.objects.filter(login=login).order_by('member_id'))
+
+
+def search_by_email(email):
+    """
+    Adhérents actifs qui ont cet email.
+    """
+    return _members(MemberIndex.objects.filter(email=email, statut='1').order_by('member_id'))
+
+
+def search_by_name(name):
+    """
+    Adhérents actifs dont le prénom, le nom ou la raison sociale contient le texte recherché (sans tenir compte des
+    majuscules ni des accents). Les adhérents dont un mot commence par le texte recherché sont renvoyés en premier.
+    """
+    text = normalize(name).strip()
+    entries = MemberIndex.objects.filter(statut='1', search_text__contains=text)
+    text_trigrams = trigrams(text)
+    if text_trigrams:
+        # On ne garde que les adhérents qui ont tous les trigrammes du texte recherché.
+        member_ids = MemberTrigram.objects.filter(trigram__in=text_trigrams).values('member').annotate(
+            matches=Count('trigram')).filter(matches=len(text_trigrams)).values('member')
+        entries = entries.filter(pk__in=member_ids)
+
+    first_word = text.split()[0] if text else ''
+    candidates = list(entries.values_list('search_text', 'lastname', 'member_id'))
+    candidates.sort(key=lambda candidate: (
+        not any(word.startswith(first_word) for word in candidate[0].split()), normalize(candidate[1]), candidate[2]))
+    # Les fiches ne sont lues que pour les adhérents renvoyés.
+    member_ids = [candidate[2] for candidate in candidates[:SEARCH_LIMIT]]
+    data = dict(MemberIndex.objects.filter(member_id__in=member_ids).values_list('member_id', 'data'))
+    return [json.loads(data[member_id]) for member_id in member_ids]
@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from members.directory import sync_member_index
+from service_sessions import anonymous_dolibarr
+
+
+class Command(BaseCommand):
+    help = "Met à jour l'index local des adhérents à partir de Dolibarr."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help="Recopie tous les adhérents (et retire de l'index ceux qui n'existent plus).")
+        parser.add_argument('--interval', type=int, default=0,
+                            help="Si indiqué, synchronise en boucle, avec ce délai (en secondes) entre deux "
+                                 "synchronisations.")
+        parser.add_argument('--full-interval', type=int, default=0,
+                            help="Avec --interval, fait une synchronisation complète au démarrage puis avec ce délai "
+                                 "(en secondes), pour retirer de l'index les adhérents supprimés dans Dolibarr.")
+
+    def handle(self, *args, **options):
+        full = options['full'] or bool(options['full_interval'])
+        last_full = None
+        while True:
+            if full:
+                last_full = time.monotonic()
+            sync_member_index(anonymous_dolibarr(), full=full)
+            if not options['interval']:
+                return
+            time.sleep(options['interval'])
+            full = bool(options['full_interval']) and time.monotonic() - last_full >= options['full_interval']
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MemberIndex',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('member_id', models.IntegerField(unique=True)),
+                ('login', models.CharField(db_index=True, max_length=50)),
+                ('email', models.CharField(blank=True, db_index=True, max_length=250)),
+                ('statut', models.CharField(max_length=5)),
+                ('lastname', models.CharField(blank=True, max_length=250)),
+                ('search_text', models.CharField(blank=True, max_length=750)),
+                ('data', models.TextField()),
+                ('modified_at', models.DateTimeField(null=True)),
+                ('synced_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='MemberTrigram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(db_index=True, max_length=3)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trigrams', to='members.MemberIndex')),
+            ],
+            options={
+                'unique_together': {('member', 'trigram')},
+            },
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.db import models
+
+
+class MemberIndex(models.Model):
+    """
+    Copie locale d'un adhérent Dolibarr, pour les recherches (voir members/directory.py).
+
+    L'adhérent complet, tel que renvoyé par l'API Dolibarr, est enregistré au format JSON dans `data`. Les champs
+    utilisés pour les recherches sont recopiés dans des colonnes indexées. `search_text` contient le prénom, le nom et
+    la raison sociale, en minuscules et sans accents.
+    """
+
+    member_id = models.IntegerField(unique=True)
+    login = models.CharField(max_length=50, db_index=True)
+    email = models.CharField(max_length=250, db_index=True, blank=True)
+    statut = models.CharField(max_length=5)
+    lastname = models.CharField(max_length=250, blank=True)
+    search_text = models.CharField(max_length=750, blank=True)
+    data = models.TextField()
+    modified_at = models.DateTimeField(null=True)
+    synced_at = models.DateTimeField(auto_now=True)
+
+
+class MemberTrigram(models.Model):
+    """
+    Trigrammes des mots de MemberIndex.search_text : une recherche par nom ne lit que les adhérents qui ont tous les
+    trigrammes du texte recherché.
+    """
+
+    member = models.ForeignKey(MemberIndex, related_name='trigrams', on_delete=models.CASCADE)
+    trigram = models.CharField(max_length=3, db_index=True)
+
+    class Meta:
+        unique_together = ('member', 'trigram')
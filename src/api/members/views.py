@@ -13,11 +13,13 @@ from rest_framework.response import Response
 
 from base_api import BaseAPIView
 from cyclos_api import CyclosAPI, CyclosAPIException
-from dolibarr_api import DolibarrAPI, DolibarrAPIException
+from dolibarr_api import DolibarrAPIException
 from members.serializers import MemberSerializer, MembersSubscriptionsSerializer, MemberPartialSerializer
+from members import directory
 from members.misc import Member, Subscription
 from misc import sendmail_euskalmoneta
-from pagination import CustomPagination
+from pagination import DolibarrPagination
+from service_sessions import anonymous_dolibarr
 
 log = logging.getLogger()
 
@@ -50,6 +52,7 @@ class MembersAPIView(BaseAPIView):
         # Dolibarr: Register member
         response_obj = self.dolibarr.post(model=self.model, data=data, api_key=request.user.profile.dolibarr_token)
         log.info(response_obj)
+        directory.refresh_member(self.dolibarr, response_obj)
 
         # Cyclos: Register member
         create_user_data = {
@@ -73,14 +76,19 @@ class MembersAPIView(BaseAPIView):
         # être authentifié, afin d'éviter la fuite d'information sur les
         # adhérents.
         if token and not request.user.is_authenticated:
-            dolibarr = DolibarrAPI()
-            dolibarr_token = dolibarr.login(login=settings.APPS_ANONYMOUS_LOGIN,
-                                            password=settings.APPS_ANONYMOUS_PASSWORD)
+            self.dolibarr = anonymous_dolibarr()
+            dolibarr_token = self.dolibarr.api_key
         else:
             dolibarr_token = request.user.profile.dolibarr_token
+        use_index = (login or name or email) and directory.is_ready() and directory.may_use_index(request.user)
 
         if login and valid_login:
             # We want to search in members by login (N° Adhérent)
+            # On cherche d'abord dans l'index local des adhérents, puis dans Dolibarr (l'adhérent vient peut-être
+            # d'être créé et n'est pas encore dans l'index).
+            response = directory.search_by_login(login) if use_index else []
+            if response:
+                return Response(response)
             try:
                 response = self.dolibarr.get(model='members', sqlfilters="login='{}'".format(login), api_key=dolibarr_token)
             except DolibarrAPIException:
@@ -93,6 +101,11 @@ class MembersAPIView(BaseAPIView):
 
         elif name and len(name) >= 3:
             # We want to search in members by name (firstname, lastname or societe)
+            # On cherche d'abord dans l'index local des adhérents, puis dans Dolibarr si on n'y trouve personne
+            # (l'adhérent a peut-être été créé ou modifié depuis la dernière synchronisation de l'index).
+            response = directory.search_by_name(name) if use_index else []
+            if response:
+                return Response(response)
             try:
                 sqlfilters = "(firstname like '%25{name}%25' or lastname like '%25{name}%25' or societe like '%25{name}%25') and statut=1".format(name=name)
                 response = self.dolibarr.get(model='members', sqlfilters=sqlfilters, api_key=dolibarr_token)
@@ -107,7 +120,9 @@ class MembersAPIView(BaseAPIView):
         elif email:
             try:
                 validate_email(email)
-                user_results = self.dolibarr.get(model='members', sqlfilters="email='{}' and statut=1".format(email), api_key=dolibarr_token)
+                user_results = directory.search_by_email(email) if use_index else []
+                if not user_results:
+                    user_results = self.dolibarr.get(model='members', sqlfilters="email='{}' and statut=1".format(email), api_key=dolibarr_token)
                 user_data = [item
                              for item in user_results
                              if item['email'] == email][0]
@@ -123,9 +138,9 @@ class MembersAPIView(BaseAPIView):
             return Response(response)
 
         else:
-            objects = self.dolibarr.get(model='members', sqlfilters="statut=1", api_key=dolibarr_token)
-            paginator = CustomPagination()
-            result_page = paginator.paginate_queryset(objects, request)
+            paginator = DolibarrPagination()
+            result_page = paginator.paginate_dolibarr(self.dolibarr, request, model='members', sqlfilters="statut=1",
+                                                      api_key=dolibarr_token)
 
             serializer = MemberSerializer(result_page, many=True)
             return paginator.get_paginated_response(serializer.data)
@@ -178,8 +193,10 @@ class MembersAPIView(BaseAPIView):
             return Response({'error': 'Oops! Something is wrong in your request data: {}'.format(serializer.errors)},
                             status=status.HTTP_400_BAD_REQUEST)
 
-        return Response(self.dolibarr.put(model='members/{}'.format(pk), data=data,
-                                            api_key=request.user.profile.dolibarr_token))
+        response = self.dolibarr.put(model='members/{}'.format(pk), data=data,
+                                     api_key=request.user.profile.dolibarr_token)
+        directory.refresh_member(self.dolibarr, pk)
+        return Response(response)
 
 
 class MembersSubscriptionsAPIView(BaseAPIView):
@@ -1,4 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
 import logging
+import os
+import tempfile
 
 from django.conf import settings
 from django.core import mail
@@ -7,6 +10,9 @@ from smtplib import SMTPException
 from django.template.loader import render_to_string
 from django.utils.html import strip_tags
 
+import backend_timing
+from outbox.mailer import enqueue
+
 log = logging.getLogger()
 
 
@@ -14,12 +20,53 @@ class EuskalMonetaAPIException(Exception):
     pass
 
 
+def concurrent_map(func, items, max_workers=None):
+    """
+    Apply func to each item using a pool of threads, and return the results in the same order as the items.
+
+    This is meant for I/O-bound calls to the APIs (Cyclos, Dolibarr). The first exception raised by func is
+    propagated to the caller. The calls made by func are counted for the current request (see backend_timing).
+    """
+    items = list(items)
+    if not items:
+        return []
+    if max_workers is None:
+        max_workers = settings.API_MAX_WORKERS
+    max_workers = min(max_workers, len(items))
+    if max_workers <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(backend_timing.bind(func), items))
+
+
+def write_atomically(path, content):
+    """
+    Write content (bytes) to the file at path, creating its directory if needed.
+
+    The content is written to a temporary file which is then renamed, so that readers never see an incomplete file.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
 def sendmail_euskalmoneta(subject, body, to_email=None, from_email=None):
     if to_email is None:
         to_email = settings.EMAIL_NOTIFICATION_GESTION
     if from_email is None:
         from_email = settings.EMAIL_HOST_USER
 
+    if settings.OUTBOX_ENABLED:
+        enqueue(subject, body, to_email=to_email, from_email=from_email)
+        return
+
     log.debug("sendmail:\nFrom: {}\nTo: {}\nSubject: {}\n{}".format(
         from_email, to_email, subject, body))
     with mail.get_connection() as connection:
@@ -32,10 +79,14 @@ def sendmailHTML_euskalmoneta(subject, html_message, to_email=None, from_email=N
     if from_email is None:
         from_email = settings.EMAIL_HOST_USER
 
+    plain_message = strip_tags(html_message)
+    if settings.OUTBOX_ENABLED:
+        enqueue(subject, plain_message, to_email=to_email, from_email=from_email, html_message=html_message)
+        return
+
     log.debug("sendmail:\nFrom: {}\nTo: {}\nSubject: {}".format(
         from_email, to_email, subject))
 
-    plain_message = strip_tags(html_message)
     try:
         mail.send_mail(subject, plain_message, from_email, [to_email], html_message=html_message)
     except SMTPException as e:
@@ -0,0 +1,152 @@
+"""
+Envoi des emails en tâche de fond.
+
+Les vues (création de mandat, virements, ouverture de compte, etc.) envoyaient leurs emails pendant la requête, en
+ouvrant une connexion SMTP par email. Quand OUTBOX_ENABLED est activé, misc.sendmail_euskalmoneta() et
+misc.sendmailHTML_euskalmoneta() enregistrent l'email dans la table OutgoingEmail (voir enqueue()), et la commande
+send_outbox les envoie par lots, en utilisant une seule connexion SMTP par lot. Cette commande doit alors tourner,
+sinon les emails ne partent jamais : OUTBOX_ENABLED est donc désactivé par défaut.
+
+Un email dont l'envoi a échoué est renvoyé plus tard, avec un délai qui double à chaque tentative. Après
+OUTBOX_MAX_ATTEMPTS tentatives, il passe à l'état "erreur" ; pour un email HTML, on prévient alors la gestion, comme le
+faisait sendmailHTML_euskalmoneta().
+"""
+from datetime import timedelta
+import logging
+import time
+import uuid
+
+from django.conf import settings
+from django.core import mail
+from django.utils import timezone
+from django.utils.html import strip_tags
+
+from outbox.models import OutgoingEmail
+
+log = logging.getLogger()
+
+# Un lot qui n'est pas terminé au bout de ce délai (le worker a été arrêté) peut être repris par un autre worker.
+CLAIM_TIMEOUT = timedelta(minutes=10)
+
+
+def enqueue(subject, body, to_email, from_email, html_message=''):
+    """
+    Enregistre un email, qui sera envoyé par la commande send_outbox.
+    """
+    # str() pour traduire maintenant les textes traduits "lazy", dans la langue activée par la vue.
+    return OutgoingEmail.objects.create(subject=str(subject), body=str(body), html_message=str(html_message),
+                                        to_email=to_email, from_email=from_email, next_attempt_at=timezone.now())
+
+
+def claim_batch(batch_size):
+    """
+    Prend au plus batch_size emails à envoyer, et les renvoie.
+    L'UPDATE conditionnel garantit qu'un même email n'est pris que par un seul worker.
+    """
+    now = timezone.now()
+    due = OutgoingEmail.objects.filter(statut=OutgoingEmail.EN_ATTENTE, next_attempt_at__lte=now)
+    ids = list(due.order_by('next_attempt_at', 'pk').values_list('pk', flat=True)[:batch_size])
+    if not ids:
+        return []
+    claim_id = str(uuid.uuid4())
+    due.filter(pk__in=ids).update(claim_id=claim_id, next_attempt_at=now + CLAIM_TIMEOUT)
+    return list(OutgoingEmail.objects.filter(claim_id=claim_id).order_by('pk'))
+
+
+def _message(email, connection):
+    if email.html_message:
+        message = mail.EmailMultiAlternatives(email.subject, email.body, email.from_email, [email.to_email],
+                                              connection=connection)
+        message.attach_alternative(email.html_message, 'text/html')
+        return message
+    return mail.EmailMessage(email.subject, email.body, email.from_email, [email.to_email], connection=connection)
+
+
+def _close(connection):
+    try:
+        connection.close()
+    except Exception:
+        pass
+
+
+def _sent(email):
+    OutgoingEmail.objects.filter(pk=email.pk).update(
+        statut=OutgoingEmail.ENVOYE, attempts=email.attempts + 1, error='', sent_at=timezone.now())
+
+
+def _failed(email, error):
+    attempts = email.attempts + 1
+    if attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+        log.error("OutgoingEmail {} to {} not sent after {} attempts: {}".format(
+            email.pk, email.to_email, attempts, error))
+        OutgoingEmail.objects.filter(pk=email.pk).update(statut=OutgoingEmail.ERREUR, attempts=attempts, error=error)
+        if email.html_message and email.to_email != settings.EMAIL_NOTIFICATION_GESTION:
+            enqueue('Erreur envoi mail : ' + email.from_email, strip_tags(email.html_message),
+                    to_email=settings.EMAIL_NOTIFICATION_GESTION, from_email=settings.EMAIL_HOST_USER)
+    else:
+        delay = settings.OUTBOX_RETRY_DELAY * 2 ** (attempts - 1)
+        log.warning("OutgoingEmail {} to {} not sent, new attempt in {}s: {}".format(
+            email.pk, email.to_email, delay, error))
+        OutgoingEmail.objects.filter(pk=email.pk).update(
+            attempts=attempts, error=error, next_attempt_at=timezone.now() + timedelta(seconds=delay))
+
+
+def send_batch(emails):
+    """
+    Envoie les emails avec une seule connexion SMTP, et renvoie le nombre d'emails envoyés.
+    Après une erreur, la connexion est rouverte pour les emails suivants.
+    """
+    sent = 0
+    connection = mail.get_connection()
+    try:
+        connection.open()
+    except Exception as e:
+        for email in emails:
+            _failed(email, str(e))
+        return sent
+
+    try:
+        for email in emails:
+            log.debug("sendmail:\nFrom: {}\nTo: {}\nSubject: {}".format(
+                email.from_email, email.to_email, email.subject))
+            try:
+                _message(email, connection).send()
+            except Exception as e:
+                _failed(email, str(e))
+                _close(connection)
+                try:
+                    connection.open()
+                except Exception:
+                    # La connexion sera ouverte par le prochain send().
+                    pass
+            else:
+                _sent(email)
+                sent += 1
+    finally:
+        _close(connection)
+    return sent
+
+
+def send_pending():
+    """
+    Envoie tous les emails en attente, par lots de OUTBOX_BATCH_SIZE, et renvoie le nombre d'emails envoyés.
+    """
+    sent = 0
+    while True:
+        emails = claim_batch(settings.OUTBOX_BATCH_SIZE)
+        if not emails:
+            return sent
+        sent += send_batch(emails)
+
+
+def run_sender(poll_interval=5, once=False):
+    """
+    Boucle du worker : envoie les emails en attente.
+    """
+    while True:
+        sent = send_pending()
+        if sent:
+            log.info("send_outbox: {} emails sent".format(sent))
+        if once:
+            return
+        time.sleep(poll_interval)
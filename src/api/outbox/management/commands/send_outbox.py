@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from outbox.mailer import run_sender
+
+
+class Command(BaseCommand):
+    help = "Envoie les emails en attente."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--poll-interval', type=int, default=5,
+                            help="Délai (en secondes) entre deux recherches d'emails en attente.")
+        parser.add_argument('--once', action='store_true',
+                            help="Envoie les emails en attente puis s'arrête.")
+
+    def handle(self, *args, **options):
+        run_sender(poll_interval=options['poll_interval'], once=options['once'])
@@ -0,0 +1,35 @@
+# Generated by Django 2.2.28 on 2026-10-18 16:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutgoingEmail',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('statut', models.CharField(choices=[('ATT', 'En attente'), ('ENV', 'Envoyé'), ('ERR', 'Erreur')], default='ATT', max_length=3)),
+                ('subject', models.CharField(max_length=500)),
+                ('body', models.TextField()),
+                ('html_message', models.TextField(blank=True)),
+                ('from_email', models.CharField(max_length=250)),
+                ('to_email', models.CharField(max_length=250)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('error', models.TextField(blank=True)),
+                ('claim_id', models.CharField(blank=True, max_length=36)),
+                ('next_attempt_at', models.DateTimeField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('sent_at', models.DateTimeField(null=True)),
+            ],
+            options={
+                'index_together': {('statut', 'next_attempt_at')},
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+from django.db import models
+
+
+class OutgoingEmail(models.Model):
+    """
+    Email en attente d'envoi (voir outbox/mailer.py).
+
+    Les vues enregistrent les emails dans cette table au lieu de les envoyer pendant la requête. La commande send_outbox
+    les envoie par lots, et renvoie plus tard ceux dont l'envoi a échoué.
+    """
+
+    EN_ATTENTE = 'ATT'
+    ENVOYE = 'ENV'
+    ERREUR = 'ERR'
+    STATUTS = (
+        (EN_ATTENTE, 'En attente'),
+        (ENVOYE, 'Envoyé'),
+        (ERREUR, 'Erreur'),
+    )
+    statut = models.CharField(max_length=3, choices=STATUTS, default=EN_ATTENTE)
+    subject = models.CharField(max_length=500)
+    body = models.TextField()
+    html_message = models.TextField(blank=True)
+    from_email = models.CharField(max_length=250)
+    to_email = models.CharField(max_length=250)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    # Identifiant du lot qui a pris cet email, et date à partir de laquelle il peut être (re)pris.
+    claim_id = models.CharField(max_length=36, blank=True)
+    next_attempt_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True)
+
+    class Meta:
+        index_together = [
+            ('statut', 'next_attempt_at'),
+        ]
@@ -1,10 +1,17 @@
 from collections import OrderedDict
+import hashlib
+import json
 import logging
 
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
 from rest_framework.utils.urls import replace_query_param
 
+from dolibarr_api import DolibarrAPIException
+
 log = logging.getLogger(__name__)
 
 
@@ -29,3 +36,105 @@ class CustomPagination(PageNumberPagination):
             return None
         page_number = self.page.previous_page_number()
         return replace_query_param('', self.page_query_param, page_number)
+
+
+class BackendPagination(CustomPagination):
+    """
+    Pagination done by the backend (Dolibarr or Cyclos) instead of slicing the full list in Python.
+
+    The page and page_size query parameters are translated into the pagination parameters of the backend, so we only
+    fetch the requested page. The response has the same format as CustomPagination.
+    """
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def _read_page_params(self, request):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        try:
+            self.page_number = int(request.query_params.get(self.page_query_param, 1))
+        except ValueError:
+            raise NotFound(self.invalid_page_message.format(page_number=request.query_params[self.page_query_param],
+                                                            message='That page number is not an integer'))
+        if self.page_number < 1:
+            raise NotFound(self.invalid_page_message.format(page_number=self.page_number,
+                                                            message='That page number is less than 1'))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.count),
+            ('previous', self.get_previous_link()),
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return self._page_link(self.page_number + 1)
+
+    def get_previous_link(self):
+        if self.page_number <= 1:
+            return None
+        return self._page_link(self.page_number - 1)
+
+    def _page_link(self, page_number):
+        link = replace_query_param('', self.page_query_param, page_number)
+        if self.page_size_query_param in self.request.query_params:
+            link = replace_query_param(link, self.page_size_query_param, self.page_size)
+        return link
+
+
+class DolibarrPagination(BackendPagination):
+    """
+    Pagination with the limit and page parameters of the Dolibarr API. Dolibarr starts a page at the offset
+    limit * page, so limit is always the page size.
+
+    Dolibarr doesn't tell how many objects match the query, and counting them would mean fetching them all. When the
+    page is full, a single object is asked for just after it (limit=1, so that page is the offset) to know if there is a
+    next page. The total is only known once the last page has been fetched: it is then cached for
+    DOLIBARR_COUNT_CACHE_TTL seconds, per caller, and returned with the other pages of the same listing as long as it is
+    consistent with them. Otherwise, count is None.
+    """
+
+    def _fetch(self, limit, page):
+        try:
+            return self.dolibarr.get(model=self.model, limit=limit, page=page, **self.kwargs)
+        except DolibarrAPIException:
+            # Dolibarr answers 404 when there are no objects on this page.
+            return []
+
+    def _exists(self, offset):
+        return bool(self._fetch(limit=1, page=offset))
+
+    def _cache_key(self):
+        # The API key is part of the key: the objects a caller can see depend on its rights in Dolibarr.
+        query = json.dumps([self.model, self.kwargs], sort_keys=True)
+        return 'dolibarr_count_{}'.format(hashlib.sha256(query.encode('utf-8')).hexdigest())
+
+    def paginate_dolibarr(self, dolibarr, request, model, **kwargs):
+        self._read_page_params(request)
+        self.dolibarr = dolibarr
+        self.model = model
+        self.kwargs = kwargs
+
+        offset = (self.page_number - 1) * self.page_size
+        objects = self._fetch(limit=self.page_size, page=self.page_number - 1)
+        if len(objects) == self.page_size:
+            self.has_next = self._exists(offset + self.page_size)
+        else:
+            self.has_next = False
+
+        if objects and not self.has_next:
+            # The last page: the total is known.
+            self.count = offset + len(objects)
+            cache.set(self._cache_key(), self.count, settings.DOLIBARR_COUNT_CACHE_TTL)
+        elif self.page_number == 1 and not objects:
+            self.count = 0
+            cache.set(self._cache_key(), self.count, settings.DOLIBARR_COUNT_CACHE_TTL)
+        else:
+            cached = cache.get(self._cache_key())
+            # A page after the last one only tells that there are at most `offset` objects.
+            consistent = cached is not None and (cached > offset + len(objects) if objects else cached <= offset)
+            self.count = cached if consistent else None
+        return objects
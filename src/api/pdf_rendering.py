@@ -0,0 +1,146 @@
+"""
+PDF rendering with wkhtmltopdf, using a pool of long-lived virtual X displays.
+
+wkhtmltopdf needs an X server. It used to be run through `xvfb-run`, which starts a new Xvfb server for every PDF.
+Instead, each process starts PDF_RENDERING_DISPLAYS Xvfb servers the first time it renders a PDF and keeps them: a
+render takes a free display, runs wkhtmltopdf on it and gives it back. The number of displays is also the maximum
+number of PDFs rendered at the same time by a process. The other renders wait for a free display, for at most
+PDF_RENDERING_QUEUE_TIMEOUT seconds, after which PDFRenderingBusy is raised.
+
+If PDF_RENDERING_DISPLAYS is 0, each PDF is rendered with WKHTMLTOPDF_CMD (`xvfb-run wkhtmltopdf`), as before.
+"""
+import atexit
+import logging
+import os
+import queue
+import shlex
+import subprocess
+import threading
+import time
+
+from django.conf import settings
+from django.template.loader import get_template
+from wkhtmltopdf.utils import RenderedFile
+
+import backend_timing
+
+log = logging.getLogger()
+
+
+class PDFRenderingBusy(Exception):
+    pass
+
+
+class Display(object):
+    """
+    A Xvfb server. Xvfb chooses a free display number itself (-displayfd), so several processes can have their own
+    displays on the same host.
+    """
+
+    def __init__(self):
+        read_fd, write_fd = os.pipe()
+        try:
+            self.process = subprocess.Popen(
+                [settings.PDF_RENDERING_XVFB, '-displayfd', str(write_fd), '-screen', '0', '1024x768x24',
+                 '-nolisten', 'tcp'],
+                pass_fds=(write_fd,), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        finally:
+            os.close(write_fd)
+        with os.fdopen(read_fd) as displayfd:
+            number = displayfd.readline().strip()
+        if not number:
+            self.process.kill()
+            raise RuntimeError("Xvfb did not start")
+        self.name = ':{}'.format(number)
+        log.debug("Started Xvfb on display {}".format(self.name))
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def stop(self):
+        if self.is_alive():
+            self.process.terminate()
+
+
+class DisplayPool(object):
+
+    def __init__(self, size):
+        self.size = size
+        self.displays = []
+        self.free = queue.Queue()
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            if self.displays:
+                return
+            for _ in range(self.size):
+                display = Display()
+                self.displays.append(display)
+                self.free.put(display)
+            atexit.register(self.stop)
+
+    def acquire(self, timeout):
+        if not self.displays:
+            self._start()
+        try:
+            display = self.free.get(timeout=timeout)
+        except queue.Empty:
+            raise PDFRenderingBusy()
+        if not display.is_alive():
+            log.warning("Xvfb on display {} has stopped, starting a new one".format(display.name))
+            try:
+                new_display = Display()
+            except Exception:
+                self.free.put(display)
+                raise
+            with self.lock:
+                self.displays[self.displays.index(display)] = new_display
+            display = new_display
+        return display
+
+    def release(self, display):
+        self.free.put(display)
+
+    def stop(self):
+        for display in self.displays:
+            display.stop()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = DisplayPool(settings.PDF_RENDERING_DISPLAYS)
+        return _pool
+
+
+def _wkhtmltopdf(args, display=None):
+    env = dict(os.environ, DISPLAY=display.name) if display else None
+    return subprocess.run(args + ['--quiet', '--encoding', 'utf8', '-'], env=env, check=True,
+                          stdout=subprocess.PIPE, timeout=settings.PDF_RENDERING_TIMEOUT).stdout
+
+
+def render_pdf(template_name, context, request=None):
+    """
+    Render the template with the context, and return the content of the PDF.
+    """
+    rendered_file = RenderedFile(template=get_template(template_name), context=context, request=request)
+
+    if not settings.PDF_RENDERING_DISPLAYS:
+        with backend_timing.timed('wkhtmltopdf', template_name):
+            return _wkhtmltopdf(shlex.split(settings.WKHTMLTOPDF_CMD) + [rendered_file.filename])
+
+    pool = _get_pool()
+    start = time.monotonic()
+    display = pool.acquire(settings.PDF_RENDERING_QUEUE_TIMEOUT)
+    backend_timing.record('wkhtmltopdf', 'queue', time.monotonic() - start)
+    try:
+        with backend_timing.timed('wkhtmltopdf', template_name):
+            return _wkhtmltopdf([settings.PDF_RENDERING_WKHTMLTOPDF, rendered_file.filename], display)
+    finally:
+        pool.release(display)
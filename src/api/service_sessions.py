@@ -0,0 +1,162 @@
+"""
+Long-lived sessions of the service users for Dolibarr and Cyclos: the anonymous user (APPS_ANONYMOUS_LOGIN), used
+when no real user is authenticated, and the GI service user (GI_SERVICE_LOGIN), used by the GI background workers
+(reports, statements), which need the permissions of the "Gestion interne" group.
+
+Instead of logging in again as the anonymous user for every request, the tokens are kept in the Django cache and
+shared by all the requests (and by all the worker processes when the cache backend is shared). When Dolibarr rejects
+the key (401) or Cyclos says the session is LOGGED_OUT (whatever the HTTP status: Cyclos also sends it with a 500), a
+new token is obtained and the call is retried once. This is what renews the sessions that the backends expire before
+SERVICE_SESSIONS_TTL.
+"""
+from base64 import b64encode
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+import requests
+
+from cyclos_api import CyclosAPI
+from dolibarr_api import DolibarrAPI
+
+log = logging.getLogger(__name__)
+
+ANONYMOUS = 'anonymous'
+GI = 'gi'
+
+# Settings holding the login and password of each service user.
+ACCOUNTS = {
+    ANONYMOUS: ('APPS_ANONYMOUS_LOGIN', 'APPS_ANONYMOUS_PASSWORD'),
+    GI: ('GI_SERVICE_LOGIN', 'GI_SERVICE_PASSWORD'),
+}
+
+DOLIBARR_CACHE_KEY = 'service_session_dolibarr'
+CYCLOS_CACHE_KEY = 'service_session_cyclos'
+
+
+def _cache_key(base_key, account):
+    return base_key if account == ANONYMOUS else '{}_{}'.format(base_key, account)
+
+
+def _credentials(account):
+    login_setting, password_setting = ACCOUNTS[account]
+    login = getattr(settings, login_setting)
+    if not login:
+        raise ImproperlyConfigured('{} is not set'.format(login_setting))
+    return login, getattr(settings, password_setting)
+
+
+def _login_dolibarr(account):
+    login, password = _credentials(account)
+    # No reset: we don't want to invalidate the key that other requests are using.
+    return DolibarrAPI().login(login=login, password=password)
+
+
+def _login_cyclos(account):
+    login, password = _credentials(account)
+    return CyclosAPI(mode='login').login(
+        auth_string=b64encode(bytes('{}:{}'.format(login, password), 'utf-8')).decode('ascii'))
+
+
+def _dolibarr_token(account, stale_token=None):
+    return _get_token(_cache_key(DOLIBARR_CACHE_KEY, account), lambda: _login_dolibarr(account), stale_token)
+
+
+def _cyclos_token(account, stale_token=None):
+    return _get_token(_cache_key(CYCLOS_CACHE_KEY, account), lambda: _login_cyclos(account), stale_token)
+
+
+def _get_token(cache_key, login, stale_token=None):
+    """
+    Return the shared token stored under cache_key, logging in if there is none (or if it is stale_token, which has
+    just been rejected by the backend).
+
+    Only one request logs in at a time: the others wait (a few seconds at most) for the new token.
+    """
+    token = cache.get(cache_key)
+    if token and token != stale_token:
+        return token
+
+    lock_key = '{}_lock'.format(cache_key)
+    locked = cache.add(lock_key, True, 30)
+    if not locked:
+        for _ in range(50):
+            time.sleep(0.1)
+            token = cache.get(cache_key)
+            if token and token != stale_token:
+                return token
+    try:
+        log.debug("Service session login ({})".format(cache_key))
+        token = login()
+        cache.set(cache_key, token, settings.SERVICE_SESSIONS_TTL)
+    finally:
+        if locked:
+            cache.delete(lock_key)
+    return token
+
+
+class ServiceDolibarrAPI(DolibarrAPI):
+    """
+    DolibarrAPI using the shared session of a service user (`account`), renewed automatically.
+    """
+
+    def _request(self, http_method, url, **kwargs):
+        r = super(ServiceDolibarrAPI, self)._request(http_method, url, **kwargs)
+        stale_key = getattr(self, 'api_key', None)
+        if r.status_code == requests.codes.unauthorized and stale_key and 'api_key={}'.format(stale_key) in url:
+            api_key = self._handle_api_key(_dolibarr_token(self.account, stale_token=stale_key))
+            url = url.replace('api_key={}'.format(stale_key), 'api_key={}'.format(api_key))
+            r = super(ServiceDolibarrAPI, self)._request(http_method, url, **kwargs)
+        return r
+
+
+class ServiceCyclosAPI(CyclosAPI):
+    """
+    CyclosAPI using the shared session of a service user (`account`), renewed automatically.
+    """
+
+    def _request(self, http_method, url, **kwargs):
+        r = super(ServiceCyclosAPI, self)._request(http_method, url, **kwargs)
+        headers = kwargs.get('headers') or {}
+        stale_token = headers.get('Session-Token')
+        if r.status_code != requests.codes.ok and stale_token and self._is_logged_out(r):
+            headers['Session-Token'] = self._handle_token(_cyclos_token(self.account, stale_token=stale_token))
+            r = super(ServiceCyclosAPI, self)._request(http_method, url, **kwargs)
+        return r
+
+    @staticmethod
+    def _is_logged_out(response):
+        try:
+            return response.json()['errorCode'] == 'LOGGED_OUT'
+        except (ValueError, KeyError, TypeError):
+            return False
+
+
+def anonymous_dolibarr():
+    """
+    Return a DolibarrAPI instance logged in as the anonymous user.
+    """
+    return ServiceDolibarrAPI(account=ANONYMOUS, api_key=_dolibarr_token(ANONYMOUS))
+
+
+def anonymous_cyclos():
+    """
+    Return a CyclosAPI instance logged in as the anonymous user (its token is in the `token` attribute).
+    """
+    return ServiceCyclosAPI(account=ANONYMOUS, mode='login', token=_cyclos_token(ANONYMOUS))
+
+
+def gi_dolibarr():
+    """
+    Return a DolibarrAPI instance logged in as the GI service user.
+    """
+    return ServiceDolibarrAPI(account=GI, api_key=_dolibarr_token(GI))
+
+
+def gi_cyclos():
+    """
+    Return a CyclosAPI instance logged in as the GI service user.
+    """
+    return ServiceCyclosAPI(account=GI, mode='login', token=_cyclos_token(GI))
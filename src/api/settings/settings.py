@@ -65,6 +65,7 @@ INSTALLED_APPS = [
     'euskalmoneta_data',
 
     'gestioninterne',
+    'outbox',
 
     'corsheaders',
     'wkhtmltopdf',
@@ -81,6 +82,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'backend_timing.BackendTimingMiddleware',
     'corsheaders.middleware.CorsMiddleware',
 
     'django.middleware.security.SecurityMiddleware',
@@ -139,6 +141,18 @@ else:
     }
 
 
+# Cache
+# https://docs.djangoproject.com/en/2.2/topics/cache/
+# By default each process has its own in-memory cache. Set CACHE_BACKEND and CACHE_LOCATION (e.g. the
+# DatabaseCache backend and its table name) to share the cache between processes.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    }
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
@@ -201,6 +215,14 @@ if EMAIL_HOST:
 else:
     EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# When OUTBOX_ENABLED is true, the emails sent by the API are stored in the OutgoingEmail table and sent by the
+# send_outbox command (see outbox/mailer.py), which must then be running. By default, they are sent during the request.
+# OUTBOX_RETRY_DELAY (in seconds) is the delay before the first new attempt, doubled at each attempt.
+OUTBOX_ENABLED = os.getenv('OUTBOX_ENABLED', 'false').lower() in ('true', 'yes', '1')
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 50))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 6))
+OUTBOX_RETRY_DELAY = int(os.getenv('OUTBOX_RETRY_DELAY', 60))
+
 # Public URLs
 API_PUBLIC_URL = os.environ.get('API_PUBLIC_URL')
 DOLIBARR_PUBLIC_URL = os.environ.get('DOLIBARR_PUBLIC_URL')
@@ -212,6 +234,72 @@ CEL_PUBLIC_URL = os.environ.get('CEL_PUBLIC_URL')
 DOLIBARR_URL = 'http://dolibarr-app/api/index.php'
 CYCLOS_URL = 'http://cyclos-app:8080/eusko/web-rpc'
 
+# HTTP connection pools used to talk to the APIs (one pool per backend and per process).
+# The timeouts are (connect timeout, read timeout), in seconds.
+CYCLOS_POOL_SIZE = int(os.getenv('CYCLOS_POOL_SIZE', 20))
+CYCLOS_TIMEOUT = (float(os.getenv('CYCLOS_CONNECT_TIMEOUT', 5)), float(os.getenv('CYCLOS_READ_TIMEOUT', 120)))
+DOLIBARR_POOL_SIZE = int(os.getenv('DOLIBARR_POOL_SIZE', 10))
+DOLIBARR_TIMEOUT = (float(os.getenv('DOLIBARR_CONNECT_TIMEOUT', 5)), float(os.getenv('DOLIBARR_READ_TIMEOUT', 60)))
+
+# Maximum number of API calls made in parallel when we need to fetch many objects at once (see misc.concurrent_map).
+# It should stay below the pool sizes above.
+API_MAX_WORKERS = int(os.getenv('API_MAX_WORKERS', 8))
+
+# Local copy of the Cyclos account history, used by the reports (see gestioninterne/ledger.py).
+# CYCLOS_LEDGER_OVERLAP (in seconds) is how far back the entries already copied are fetched again, to complete the copy.
+CYCLOS_LEDGER_ENABLED = os.getenv('CYCLOS_LEDGER_ENABLED', 'true').lower() in ('true', 'yes', '1')
+CYCLOS_LEDGER_OVERLAP = int(os.getenv('CYCLOS_LEDGER_OVERLAP', 3600))
+
+# Local store of the end-of-day balances of the Cyclos accounts, for the days which are over (see
+# gestioninterne/balances.py). The balances of the current day are always asked to Cyclos.
+BALANCE_SNAPSHOTS_ENABLED = os.getenv('BALANCE_SNAPSHOTS_ENABLED', 'true').lower() in ('true', 'yes', '1')
+
+# When synchronizing the local member index (see members/directory.py), the members modified up to this number of
+# seconds before the last synchronized modification are fetched again.
+MEMBER_INDEX_OVERLAP = int(os.getenv('MEMBER_INDEX_OVERLAP', 3600))
+
+# Server-Timing header and log line with the calls made to Cyclos, Dolibarr and wkhtmltopdf for each request (see
+# backend_timing.py). A warning is logged when a request calls the same backend method more than
+# BACKEND_TIMING_MAX_CALLS times.
+BACKEND_TIMING_ENABLED = os.getenv('BACKEND_TIMING_ENABLED', 'true').lower() in ('true', 'yes', '1')
+BACKEND_TIMING_MAX_CALLS = int(os.getenv('BACKEND_TIMING_MAX_CALLS', 20))
+
+# How long (in seconds) we keep the Cyclos session state (current user profile, BDC ID) for a given token.
+CYCLOS_SESSION_CACHE_TTL = int(os.getenv('CYCLOS_SESSION_CACHE_TTL', 300))
+
+# How long (in seconds) we keep an API token, with its user and profile, in the cache. The cached entries of a user
+# are reloaded as soon as the user or its profile is saved.
+TOKEN_AUTH_CACHE_TTL = int(os.getenv('TOKEN_AUTH_CACHE_TTL', 30))
+
+# A warning is logged when a login (Dolibarr and Cyclos authentication) takes longer than this number of seconds.
+LOGIN_LATENCY_BUDGET = float(os.getenv('LOGIN_LATENCY_BUDGET', 1.0))
+
+# How long (in seconds) we reuse the Dolibarr and Cyclos sessions of the service users (APPS_ANONYMOUS_LOGIN and
+# GI_SERVICE_LOGIN). If a session expires before, a new one is opened automatically.
+SERVICE_SESSIONS_TTL = int(os.getenv('SERVICE_SESSIONS_TTL', 3600))
+
+# How long (in seconds) we keep the Cyclos identity of a member (login, Cyclos id, account number, name).
+# The identity is dropped when the member is updated (see members/directory.py). Accounts or logins that were not
+# found are not kept. The member index is updated by another process (sync_member_index): its invalidations only
+# reach the API through a shared cache (see CACHES), otherwise the identities are kept for 5 minutes only.
+CYCLOS_IDENTITY_CACHE_TTL = int(os.getenv(
+    'CYCLOS_IDENTITY_CACHE_TTL',
+    300 if CACHES['default']['BACKEND'] == 'django.core.cache.backends.locmem.LocMemCache' else 86400))
+
+# How long (in seconds) we keep the lists of users of a Cyclos group (bureaux de change, banques de dépôt).
+CYCLOS_DIRECTORY_CACHE_TTL = int(os.getenv('CYCLOS_DIRECTORY_CACHE_TTL', 60))
+
+# How long (in seconds) the reference data from Dolibarr is considered fresh (see dolibarr_data/reference_data.py).
+DOLIBARR_REFERENCE_DATA_TTL = {
+    'countries': int(os.getenv('DOLIBARR_COUNTRIES_TTL', 24 * 3600)),
+    'towns': int(os.getenv('DOLIBARR_TOWNS_TTL', 24 * 3600)),
+    'associations': int(os.getenv('DOLIBARR_ASSOCIATIONS_TTL', 600)),
+}
+
+# How long (in seconds) we keep the number of objects of a Dolibarr listing (see pagination.DolibarrPagination).
+# The number is known once a caller has fetched the last page of the listing.
+DOLIBARR_COUNT_CACHE_TTL = int(os.getenv('DOLIBARR_COUNT_CACHE_TTL', 300))
+
 # Euskal Moneta internal settings
 DATE_COTISATION_ANTICIPEE = '01/11'  # 1er Novembre
 if DEBUG:
@@ -307,7 +395,7 @@ REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': DEFAULT_RENDERER_CLASSES,
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication'
+        'auth_token.authentication.CachedTokenAuthentication'
     ],
     'DEFAULT_PERMISSION_CLASSES': ['rest_framework.permissions.IsAuthenticated'],
     'DEFAULT_PAGINATION_CLASS': 'pagination.CustomPagination',
@@ -318,7 +406,26 @@ REST_FRAMEWORK = {
 WKHTMLTOPDF_DEBUG = True
 WKHTMLTOPDF_CMD = 'xvfb-run /usr/bin/wkhtmltopdf'
 
+# PDF rendering (see pdf_rendering.py): number of Xvfb displays kept by each process, which is also the maximum number
+# of PDFs rendered at the same time by a process (0 to use WKHTMLTOPDF_CMD instead), how long (in seconds) a render
+# waits for a free display, and how long wkhtmltopdf may run.
+PDF_RENDERING_DISPLAYS = int(os.getenv('PDF_RENDERING_DISPLAYS', 2))
+PDF_RENDERING_QUEUE_TIMEOUT = int(os.getenv('PDF_RENDERING_QUEUE_TIMEOUT', 30))
+PDF_RENDERING_TIMEOUT = int(os.getenv('PDF_RENDERING_TIMEOUT', 60))
+PDF_RENDERING_XVFB = 'Xvfb'
+PDF_RENDERING_WKHTMLTOPDF = '/usr/bin/wkhtmltopdf'
+
+# Username of the GI user recorded as the requester of the monthly statements of all the members, generated on the 1st
+# of each month (see gestioninterne/statements.py). If empty, statements are only generated when requested from the GI.
+# The statements are generated with the Cyclos session of GI_SERVICE_LOGIN.
+STATEMENTS_USER = os.getenv('STATEMENTS_USER', '')
+
 APPS_ANONYMOUS_LOGIN = 'anonyme'
 APPS_ANONYMOUS_PASSWORD = 'anonyme'
 
+# Dolibarr and Cyclos user of the "Gestion interne" group used by the GI background workers (run_report_jobs,
+# generate_statements --worker), which run long after the sessions of the users who asked for the work have expired.
+GI_SERVICE_LOGIN = os.getenv('GI_SERVICE_LOGIN', '')
+GI_SERVICE_PASSWORD = os.getenv('GI_SERVICE_PASSWORD', '')
+
 JWT_SECRET = 'secret'
@@ -0,0 +1,100 @@
+"""
+Fixtures et faux backends partagés par les tests.
+"""
+from django.contrib.auth.models import User
+from django.core.cache import cache
+import pytest
+
+from cyclos_api import CyclosAPI
+from dolibarr_api import DolibarrAPIException
+
+GROUPS = {'gestion_interne': 1, 'operateurs_bdc': 2, 'adherents_utilisateurs': 3}
+
+
+class FakeCyclos:
+    """
+    Répond à chaque méthode de l'API Cyclos avec la fonction donnée (méthode -> fonction), et garde les appels.
+    Pour post(), la fonction reçoit les données envoyées ; pour get(), la fin de l'URL (par exemple l'id de
+    transaction/getData/<id>).
+    """
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.calls = []
+
+    def post(self, method, data):
+        self.calls.append((method, data))
+        return {'result': self.handlers[method](data)}
+
+    def get(self, method):
+        method, _, argument = method.rpartition('/')
+        self.calls.append((method, argument))
+        return {'result': self.handlers[method](argument)}
+
+
+class FakeDolibarr:
+    """
+    Liste d'objets paginée comme le fait l'API Dolibarr : la page commence à l'offset limit * page, et une page vide
+    donne une erreur 404. Si elle est donnée, la fonction sqlfilter(objects, sqlfilters) filtre les objets.
+    """
+
+    def __init__(self, objects, sqlfilter=None):
+        self.objects = objects
+        self.sqlfilter = sqlfilter
+        self.calls = []
+        self.queries = []
+
+    def get(self, model, limit=100, page=0, sqlfilters=None, **kwargs):
+        self.calls.append((limit, page))
+        self.queries.append(sqlfilters)
+        objects = self.objects
+        if sqlfilters and self.sqlfilter:
+            objects = self.sqlfilter(objects, sqlfilters)
+        objects = objects[limit * page:limit * (page + 1)]
+        if not objects:
+            raise DolibarrAPIException('404')
+        return objects
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    cache.clear()
+
+
+@pytest.fixture
+def fake_cyclos():
+    return FakeCyclos
+
+
+@pytest.fixture
+def fake_dolibarr():
+    return FakeDolibarr
+
+
+@pytest.fixture
+def cyclos_groups(settings, monkeypatch):
+    """
+    Cyclos renvoie le groupe de l'utilisateur dont le token est "<groupe>-token" (voir user_in_group).
+    """
+    settings.CYCLOS_CONSTANTS = {'groups': GROUPS}
+
+    def post(self, method, data, id=None, token=None):
+        if method == 'user/getCurrentUser':
+            return {'result': {'id': self.token}}
+        group = self.token.split('-')[0]
+        return {'result': {'group': {'id': GROUPS[group]}}}
+    monkeypatch.setattr(CyclosAPI, 'post', post)
+    return GROUPS
+
+
+@pytest.fixture
+def user_in_group(db):
+    """
+    Crée (ou renvoie) l'utilisateur dont la session Cyclos est dans le groupe donné.
+    """
+    def user_in_group(group):
+        user, created = User.objects.get_or_create(username=group)
+        user.profile.cyclos_token = '{}-token'.format(group)
+        user.profile.save()
+        return user
+    return user_in_group
@@ -0,0 +1,100 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+import pytest
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from auth_token import authentication
+from auth_token.authentication import CachedTokenAuthentication
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def token():
+    user = User.objects.create(username='E12345')
+    user.profile.dolibarr_token = 'dolibarr-1'
+    user.profile.cyclos_token = 'cyclos-1'
+    user.profile.save()
+    return Token.objects.create(user=user)
+
+
+def test_user_and_profile_are_cached(token, django_assert_num_queries):
+    with django_assert_num_queries(1):
+        user, _ = CachedTokenAuthentication().authenticate_credentials(token.key)
+    with django_assert_num_queries(0):
+        user, _ = CachedTokenAuthentication().authenticate_credentials(token.key)
+    assert user.profile.dolibarr_token == 'dolibarr-1'
+
+
+def test_profile_save_reloads_the_cached_user(token):
+    CachedTokenAuthentication().authenticate_credentials(token.key)
+
+    # Nouvelle connexion : les tokens Dolibarr et Cyclos changent, mais pas le token de l'API.
+    profile = User.objects.get(pk=token.user_id).profile
+    profile.dolibarr_token = 'dolibarr-2'
+    profile.cyclos_token = 'cyclos-2'
+    profile.save()
+
+    user, _ = CachedTokenAuthentication().authenticate_credentials(token.key)
+    assert user.profile.dolibarr_token == 'dolibarr-2'
+    assert user.profile.cyclos_token == 'cyclos-2'
+
+
+def test_inactive_user_is_rejected_once_saved(token):
+    CachedTokenAuthentication().authenticate_credentials(token.key)
+    User.objects.filter(pk=token.user_id).update(is_active=False)
+    User.objects.get(pk=token.user_id).save()
+    with pytest.raises(AuthenticationFailed):
+        CachedTokenAuthentication().authenticate_credentials(token.key)
+
+
+def test_deleted_token_is_rejected(token):
+    key = token.key
+    CachedTokenAuthentication().authenticate_credentials(key)
+    token.delete()
+    with pytest.raises(AuthenticationFailed):
+        CachedTokenAuthentication().authenticate_credentials(key)
+
+
+def test_evicted_version_reloads_the_user(token, django_assert_num_queries):
+    CachedTokenAuthentication().authenticate_credentials(token.key)
+    cache.delete('auth_token_version_{}'.format(token.user_id))
+    with django_assert_num_queries(1):
+        CachedTokenAuthentication().authenticate_credentials(token.key)
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    """
+    Dolibarr accepte le mot de passe "secret", Cyclos accepte tous les mots de passe.
+    """
+    cyclos_logins = []
+
+    def dolibarr_login(username, password):
+        if password != 'secret':
+            raise AuthenticationFailed()
+        return None, 'dolibarr-token'
+
+    def cyclos_login(username, password):
+        cyclos_logins.append(username)
+        return 'cyclos-token'
+
+    monkeypatch.setattr(authentication, '_dolibarr_login', dolibarr_login)
+    monkeypatch.setattr(authentication, '_dolibarr_user', lambda dolibarr, dolibarr_token, username: (
+        {'firstname': 'Amaia', 'lastname': 'Etxeberri'}, ''))
+    monkeypatch.setattr(authentication, '_cyclos_login', cyclos_login)
+    return cyclos_logins
+
+
+def test_login(backends):
+    user = authentication.authenticate('E12345', 'secret')
+    assert (user.profile.dolibarr_token, user.profile.cyclos_token) == ('dolibarr-token', 'cyclos-token')
+    assert user.profile.lastname == 'Etxeberri'
+
+
+def test_cyclos_login_is_not_tried_with_a_wrong_password(backends):
+    with pytest.raises(AuthenticationFailed):
+        authentication.authenticate('E12345', 'wrong')
+    assert backends == []
+    assert not User.objects.filter(username='E12345').exists()
@@ -0,0 +1,102 @@
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+from django.utils import timezone
+import pytest
+
+from gestioninterne import balances
+from gestioninterne.models import AccountHistoryEntry, AccountHistorySync, BalanceSnapshot
+
+pytestmark = pytest.mark.django_db
+
+
+@pytest.fixture
+def cyclos_with(fake_cyclos):
+    """
+    Cyclos qui répond à account/getAccountsSummary avec le solde du compte 'A1' à la date demandée.
+    """
+    def cyclos_with(balance='100.00'):
+        return fake_cyclos({'account/getAccountsSummary': lambda data: [
+            {'id': 'A1', 'owner': data[0], 'status': {'accountId': 'A1', 'balance': balance,
+                                                      'availableBalance': balance}}]})
+    return cyclos_with
+
+
+@pytest.fixture(autouse=True)
+def enable_snapshots(settings):
+    settings.BALANCE_SNAPSHOTS_ENABLED = True
+    settings.CYCLOS_LEDGER_ENABLED = True
+    settings.CYCLOS_LEDGER_OVERLAP = 3600
+
+
+def test_balance_of_today_is_always_asked_to_cyclos(cyclos_with):
+    cyclos = cyclos_with()
+    tomorrow = timezone.localdate() + timedelta(days=1)
+    balances.accounts_summary(cyclos, 'U1', tomorrow)
+    balances.accounts_summary(cyclos, 'U1', tomorrow)
+    assert len(cyclos.calls) == 2
+    assert not BalanceSnapshot.objects.exists()
+
+
+def test_balance_of_a_past_day_is_asked_once(cyclos_with):
+    cyclos = cyclos_with()
+    first = balances.accounts_summary(cyclos, 'U1', date(2020, 2, 1))
+    second = balances.accounts_summary(cyclos, 'U1', date(2020, 2, 1))
+    assert cyclos.calls == [('account/getAccountsSummary', ['U1', '2020-02-01'])]
+    assert first == second
+    snapshot = BalanceSnapshot.objects.get()
+    assert (snapshot.owner, snapshot.account, snapshot.date, snapshot.balance) == ('U1', 'A1', date(2020, 1, 31),
+                                                                                   Decimal('100.00'))
+
+
+def test_snapshots_disabled(settings, cyclos_with):
+    settings.BALANCE_SNAPSHOTS_ENABLED = False
+    cyclos = cyclos_with()
+    balances.accounts_summary(cyclos, 'U1', date(2020, 2, 1))
+    balances.accounts_summary(cyclos, 'U1', date(2020, 2, 1))
+    assert len(cyclos.calls) == 2
+    assert not BalanceSnapshot.objects.exists()
+
+
+def test_record_balances_ignores_unfinished_days(cyclos_with):
+    summaries = cyclos_with().post('account/getAccountsSummary', ['U1', ''])['result']
+    balances.record_balances('U1', timezone.localdate(), summaries)
+    assert not BalanceSnapshot.objects.exists()
+    balances.record_balances('U1', timezone.localdate() - timedelta(days=1), summaries)
+    # Une autre requête enregistre le même solde en même temps.
+    balances.record_balances('U1', timezone.localdate() - timedelta(days=1), summaries)
+    assert BalanceSnapshot.objects.count() == 1
+
+
+def add_entry(entry_id, when, amount):
+    AccountHistoryEntry.objects.create(account='A1', entry_id=entry_id, type_id='10', date=when, amount=amount,
+                                       data='{}')
+
+
+def test_balance_is_computed_from_the_local_account_history(cyclos_with):
+    balances.accounts_summary(cyclos_with('100.00'), 'U1', date(2020, 2, 1))
+    begin = timezone.make_aware(datetime(2020, 2, 1))
+    add_entry('1', begin + timedelta(hours=10), Decimal('20.00'))
+    add_entry('2', begin + timedelta(days=1, hours=10), Decimal('-5.50'))
+    # Après la fin de la journée demandée : pas compté.
+    add_entry('3', begin + timedelta(days=2, hours=10), Decimal('1000.00'))
+    AccountHistorySync.objects.create(account='A1', synced_from=begin, synced_until=begin + timedelta(days=10))
+
+    cyclos = cyclos_with()
+    summaries = balances.accounts_summary(cyclos, 'U1', date(2020, 2, 3))
+    assert cyclos.calls == []
+    assert summaries == [{'id': 'A1', 'owner': 'U1', 'status': {'accountId': 'A1', 'balance': '114.50'}}]
+    assert BalanceSnapshot.objects.get(date=date(2020, 2, 2)).balance == Decimal('114.50')
+
+
+def test_local_account_history_must_cover_the_period(cyclos_with):
+    balances.accounts_summary(cyclos_with('100.00'), 'U1', date(2020, 2, 1))
+    begin = timezone.make_aware(datetime(2020, 2, 1))
+    # La copie s'arrête à la fin de la journée, sans le recouvrement (CYCLOS_LEDGER_OVERLAP) : elle peut manquer des
+    # paiements enregistrés pendant la synchronisation.
+    AccountHistorySync.objects.create(account='A1', synced_from=begin, synced_until=begin + timedelta(days=2))
+
+    cyclos = cyclos_with('80.00')
+    summaries = balances.accounts_summary(cyclos, 'U1', date(2020, 2, 3))
+    assert len(cyclos.calls) == 1
+    assert summaries[0]['status']['balance'] == '80.00'
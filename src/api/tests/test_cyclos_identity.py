@@ -0,0 +1,68 @@
+from django.core.cache import cache
+import pytest
+
+from cyclos_api import CyclosAPI, CyclosAPIException, _identity_cache_key
+
+
+class FakeCyclosAPI(CyclosAPI):
+    """
+    Recherche des utilisateurs par login ou numéro de compte, dans une liste d'utilisateurs.
+    """
+
+    def __init__(self, users):
+        self.users = users
+        self.calls = []
+
+    def post(self, method, data, **kwargs):
+        self.calls.append(method)
+        if method == 'user/search':
+            items = [{'id': user['id'], 'display': user['name']} for user in self.users
+                     if data['keywords'] in (user['username'], user['account_number'])]
+            return {'result': {'totalCount': len(items), 'pageItems': items}}
+        if method == 'user/load':
+            return {'result': next(user for user in self.users if user['id'] == data)}
+        raise AssertionError(method)
+
+
+def test_identities_are_cached():
+    cyclos = FakeCyclosAPI([{'id': '1', 'name': 'Amaia', 'username': 'E00001', 'account_number': '123456789'}])
+    assert cyclos.resolve_account_number('123456789')['username'] == 'E00001'
+    cyclos.calls = []
+    assert cyclos.resolve_account_number('123456789')['name'] == 'Amaia'
+    assert cyclos.get_member_id_from_login('E00001') == '1'
+    assert cyclos.calls == []
+
+
+def test_unknown_users_are_not_cached():
+    cyclos = FakeCyclosAPI([])
+    assert cyclos.resolve_account_number('123456789') is None
+    with pytest.raises(CyclosAPIException):
+        cyclos.get_member_id_from_login('E00001')
+
+    # L'adhérent vient d'être créé.
+    cyclos.users.append({'id': '1', 'name': 'Amaia', 'username': 'E00001', 'account_number': '123456789'})
+    assert cyclos.get_member_id_from_login('E00001') == '1'
+    assert cyclos.resolve_account_number('123456789')['id'] == '1'
+
+
+def test_invalidate_identity():
+    user = {'id': '1', 'name': 'Amaia', 'username': 'E00001', 'account_number': '123456789'}
+    cyclos = FakeCyclosAPI([user])
+    cyclos.resolve_account_number('123456789')
+
+    user['name'] = 'Amaia Etxeberri'
+    CyclosAPI.invalidate_identity('E00001')
+    assert cyclos.resolve_account_number('123456789')['name'] == 'Amaia Etxeberri'
+
+
+def test_invalidate_identity_resolved_by_login_first():
+    user = {'id': '1', 'name': 'Amaia', 'username': 'E00001', 'account_number': '123456789'}
+    cyclos = FakeCyclosAPI([user])
+    cyclos.resolve_account_number('123456789')
+    # L'identité par login a été évincée du cache, puis l'id Cyclos est de nouveau demandé par login.
+    cache.delete(_identity_cache_key('login', 'E00001'))
+    assert cyclos.get_member_id_from_login('E00001') == '1'
+
+    user['name'] = 'Amaia Etxeberri'
+    CyclosAPI.invalidate_identity('E00001')
+    assert cyclos.resolve_account_number('123456789')['name'] == 'Amaia Etxeberri'
@@ -0,0 +1,67 @@
+import threading
+
+import pytest
+
+from cyclos_api import CyclosAPI
+
+
+class FakeCyclos(CyclosAPI):
+    """
+    Recherche paginée de `count` résultats. Avec `page_count`, les pages indiquent leur nombre (pageCount), comme le
+    fait account/searchAccountHistory ; sinon, comme user/search avec les paramètres par défaut, elles ne le donnent
+    pas.
+    """
+
+    def __init__(self, count, page_count=True):
+        super().__init__(mode='login', token='token')
+        self.items = list(range(count))
+        self.page_count = page_count
+        self.requested_pages = []
+        self.lock = threading.Lock()
+
+    def post(self, method, data):
+        with self.lock:
+            self.requested_pages.append(data['currentPage'])
+        page_size = data['pageSize']
+        start = page_size * data['currentPage']
+        result = {'pageItems': self.items[start:start + page_size]}
+        if self.page_count:
+            result['pageCount'] = (len(self.items) + page_size - 1) // page_size
+        return {'result': result}
+
+
+@pytest.mark.parametrize('page_count', [True, False])
+@pytest.mark.parametrize('count', [0, 1, 9, 10, 11, 35])
+def test_iter_search_returns_all_the_pages_in_order(count, page_count):
+    cyclos = FakeCyclos(count, page_count)
+    assert list(cyclos.iter_search('user/search', {'groups': [1]}, page_size=10)) == list(range(count))
+    assert sorted(cyclos.requested_pages) == cyclos.requested_pages
+    assert len(set(cyclos.requested_pages)) == len(cyclos.requested_pages)
+
+
+def test_iter_search_stops_with_the_known_page_count():
+    cyclos = FakeCyclos(20, page_count=True)
+    list(cyclos.iter_search('account/searchAccountHistory', {}, page_size=10))
+    assert cyclos.requested_pages == [0, 1]
+
+
+def test_iter_search_without_page_count_stops_at_a_short_page():
+    cyclos = FakeCyclos(20, page_count=False)
+    list(cyclos.iter_search('user/search', {}, page_size=10))
+    # La dernière page est pleine : il faut demander la suivante, vide, pour savoir qu'il n'y en a plus.
+    assert cyclos.requested_pages == [0, 1, 2]
+
+
+def test_iter_search_prefetches_only_the_next_page():
+    cyclos = FakeCyclos(100, page_count=True)
+    results = cyclos.iter_search('user/search', {}, page_size=10)
+    assert next(results) == 0
+    results.close()
+    assert set(cyclos.requested_pages) <= {0, 1}
+
+
+def test_search_all():
+    cyclos = FakeCyclos(25, page_count=True)
+    result = cyclos.search_all('user/search', {}, page_size=10)['result']
+    assert result['pageItems'] == list(range(25))
+    assert result['pageCount'] == 3
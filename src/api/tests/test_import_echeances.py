@@ -0,0 +1,77 @@
+from django.contrib.auth.models import User
+import pytest
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from gestioninterne import credits_comptes_prelevements_auto as credits
+from gestioninterne.models import Echeance
+
+pytestmark = pytest.mark.django_db
+
+HEADER = 'Référence;Débiteur;Code;Montant;Date exécution'
+
+
+def row(ref, montant='10,00 €', code='E12345', date='05/01/2020 00:00:00'):
+    return {'reference': ref, 'debiteur': 'Adhérent', 'code': code, 'montant': montant, 'date-execution': date}
+
+
+def import_rows(rows):
+    res = {'errors': [], 'ignore': 0, 'ok': []}
+    credits._import_rows(rows, res)
+    return res
+
+
+def test_rows_are_imported():
+    res = import_rows([row('REF1'), row('REF2', montant='1 234,50 €')])
+    assert [echeance['ref'] for echeance in res['ok']] == ['REF1', 'REF2']
+    assert all(echeance['id'] for echeance in res['ok'])
+    assert Echeance.objects.get(ref='REF2').montant == 1234.5
+    assert res['errors'] == [] and res['ignore'] == 0
+
+
+def test_duplicate_refs_are_ignored():
+    import_rows([row('REF1')])
+    res = import_rows([row('REF1'), row('REF2'), row('REF2')])
+    assert [echeance['ref'] for echeance in res['ok']] == ['REF2']
+    assert res['ignore'] == 2
+    assert Echeance.objects.count() == 2
+
+
+@pytest.mark.parametrize('invalid_row, field', [
+    (row('REF1', code='E1234567890'), 'adherent_id'),
+    (row('REF1', montant='10000,00 €'), 'montant'),
+    (row('R' * 51), 'ref'),
+])
+def test_invalid_rows_are_reported_without_failing_the_batch(invalid_row, field):
+    res = import_rows([invalid_row, row('REF2')])
+    assert [echeance['ref'] for echeance in res['ok']] == ['REF2']
+    assert len(res['errors']) == 1
+    assert res['errors'][0]['error'].startswith('{}:'.format(field))
+
+
+def test_unreadable_rows_are_reported():
+    res = import_rows([row('REF1', montant='dix euros'), row('REF2', date='05/01/2020')])
+    assert res['ok'] == []
+    assert [error['ref'] for error in res['errors']] == ['REF1', 'REF2']
+
+
+def test_file_is_imported_by_batches(monkeypatch):
+    monkeypatch.setattr(credits, 'IMPORT_BATCH_SIZE', 2)
+    batches = []
+    original_import_rows = credits._import_rows
+
+    def import_batch(rows, res):
+        batches.append(len(rows))
+        original_import_rows(rows, res)
+    monkeypatch.setattr(credits, '_import_rows', import_batch)
+
+    lines = [HEADER] + ['REF{};Adhérent;E{:05d};10,00 €;05/01/2020 00:00:00'.format(i, i) for i in range(5)]
+    content = '\r\n'.join(lines).encode('cp1252')
+    request = APIRequestFactory().post('/import/echeances.csv', content, content_type='text/csv',
+                                       HTTP_CONTENT_DISPOSITION='attachment; filename=echeances.csv')
+    force_authenticate(request, user=User.objects.create(username='gi'))
+    response = credits.import_csv(request, filename='echeances.csv')
+
+    assert response.status_code == 200
+    assert batches == [2, 2, 1]
+    assert [echeance['ref'] for echeance in response.data['ok']] == ['REF{}'.format(i) for i in range(5)]
+    assert Echeance.objects.get(ref='REF0').adherent_name == 'Adhérent'
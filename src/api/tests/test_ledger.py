@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta
+
+from django.utils import timezone
+import pytest
+
+from gestioninterne import ledger
+from gestioninterne.models import AccountHistoryEntry, AccountHistorySync
+
+pytestmark = pytest.mark.django_db
+
+PAYMENT = 'org.cyclos.model.banking.transactions.PaymentData'
+IMPORTED = 'org.cyclos.model.banking.transactions.ImportedTransactionData'
+
+
+@pytest.fixture
+def cyclos_with(fake_cyclos):
+    """
+    Cyclos qui répond à transaction/getData avec la classe de chaque transaction, et l'opposition éventuelle
+    ({transaction id: (classe, opposition)}).
+    """
+    def cyclos_with(transactions):
+        def get_data(transaction_id):
+            transaction_class, charged_back = transactions[transaction_id]
+            return {'class': transaction_class, 'transfer': {'chargedBackBy': {'id': 'cb'}} if charged_back else {}}
+        return fake_cyclos({'transaction/getData': get_data})
+    return cyclos_with
+
+
+class FakeCyclosHistory:
+    """
+    Historique d'un compte : account/searchAccountHistory renvoie les lignes de la période demandée.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.periods = []
+
+    def add_entry(self, entry_id, date):
+        self.entries.append({'id': entry_id, 'transactionId': 't{}'.format(entry_id), 'type': {'id': '10'},
+                             'date': date.isoformat(), 'amount': '10.00'})
+
+    def post(self, method, data):
+        begin = ledger.parse_cyclos_datetime(data['period']['begin'])
+        end = ledger.parse_cyclos_datetime(data['period']['end'])
+        self.periods.append((begin, end))
+        items = [entry for entry in self.entries if begin <= ledger.parse_cyclos_datetime(entry['date']) <= end]
+        return {'result': {'pageItems': items, 'pageCount': 1}}
+
+
+def stored_entry_ids():
+    return sorted(AccountHistoryEntry.objects.filter(account='1').values_list('entry_id', flat=True))
+
+
+def test_sync_fetches_only_what_is_missing(settings):
+    settings.CYCLOS_LEDGER_OVERLAP = 3600
+    overlap = timedelta(seconds=3600)
+    day = timezone.make_aware(datetime(2020, 1, 1))
+    cyclos = FakeCyclosHistory()
+    for i in range(1, 10):
+        cyclos.add_entry(str(i), day + timedelta(days=i))
+
+    ledger.sync_account_history(cyclos, 1, day + timedelta(days=3), day + timedelta(days=6))
+    assert cyclos.periods == [(day + timedelta(days=3), day + timedelta(days=6))]
+    assert stored_entry_ids() == ['3', '4', '5', '6']
+
+    # La période est déjà recopiée : Cyclos n'est pas interrogé.
+    cyclos.periods = []
+    ledger.sync_account_history(cyclos, 1, day + timedelta(days=4), day + timedelta(days=5))
+    assert cyclos.periods == []
+
+    # Seuls le début et la fin qui manquent sont téléchargés, la fin avec le recouvrement.
+    ledger.sync_account_history(cyclos, 1, day + timedelta(days=1), day + timedelta(days=8))
+    assert cyclos.periods == [(day + timedelta(days=1), day + timedelta(days=3)),
+                              (day + timedelta(days=6) - overlap, day + timedelta(days=8))]
+    assert stored_entry_ids() == ['1', '2', '3', '4', '5', '6', '7', '8']
+    state = AccountHistorySync.objects.get(account='1')
+    assert (state.synced_from, state.synced_until) == (day + timedelta(days=1), day + timedelta(days=8))
+
+
+def test_sync_overlap_catches_late_entries(settings):
+    settings.CYCLOS_LEDGER_OVERLAP = 3600
+    now = timezone.now()
+    cyclos = FakeCyclosHistory()
+    cyclos.add_entry('1', now - timedelta(hours=3))
+    ledger.sync_account_history(cyclos, 1, now - timedelta(days=1), now + timedelta(days=1))
+
+    # Un paiement daté d'avant la fin de la synchronisation précédente, mais enregistré dans Cyclos après elle.
+    synced_until = AccountHistorySync.objects.get(account='1').synced_until
+    assert synced_until <= timezone.now()
+    cyclos.add_entry('2', synced_until - timedelta(minutes=10))
+    ledger.sync_account_history(cyclos, 1, now - timedelta(days=1), timezone.now() + timedelta(days=1))
+    assert stored_entry_ids() == ['1', '2']
+
+
+def test_sync_of_the_future_does_nothing():
+    cyclos = FakeCyclosHistory()
+    ledger.sync_account_history(cyclos, 1, timezone.now() + timedelta(days=1), timezone.now() + timedelta(days=2))
+    assert cyclos.periods == []
+    assert not AccountHistorySync.objects.exists()
+
+
+def create_entries(transaction_ids):
+    for transaction_id in transaction_ids:
+        AccountHistoryEntry.objects.create(
+            account='1', entry_id='e{}'.format(transaction_id), transaction_id=transaction_id, type_id='10',
+            date=timezone.make_aware(datetime(2020, 1, 1)), amount=10, data='{}')
+    return [{'transactionId': transaction_id} for transaction_id in transaction_ids]
+
+
+def test_filter_charged_back(cyclos_with):
+    entries = create_entries(['1', '2', '3'])
+    cyclos = cyclos_with({'1': (PAYMENT, False), '2': (PAYMENT, True), '3': (IMPORTED, False)})
+    assert ledger.filter_charged_back(cyclos, entries, max_workers=1) == [{'transactionId': '1'},
+                                                                          {'transactionId': '3'}]
+    assert list(AccountHistoryEntry.objects.filter(charged_back=True).values_list('transaction_id', flat=True)) == ['2']
+
+
+def test_only_chargebacks_are_remembered(cyclos_with):
+    entries = create_entries(['1', '2'])
+    cyclos = cyclos_with({'1': (PAYMENT, False), '2': (PAYMENT, True)})
+    ledger.filter_charged_back(cyclos, entries, max_workers=1)
+
+    # L'opposition n'est plus demandée à Cyclos, mais le paiement sans opposition est vérifié de nouveau, et son
+    # opposition faite depuis la première vérification est vue.
+    cyclos = cyclos_with({'1': (PAYMENT, True)})
+    assert ledger.filter_charged_back(cyclos, entries, max_workers=1) == []
+    assert cyclos.calls == [('transaction/getData', '1')]
+
+
+def test_filter_charged_back_without_local_copy(settings, cyclos_with):
+    settings.CYCLOS_LEDGER_ENABLED = False
+    entries = create_entries(['1', '2'])
+    cyclos = cyclos_with({'1': (PAYMENT, False), '2': (PAYMENT, True)})
+    assert ledger.filter_charged_back(cyclos, entries, max_workers=1) == [{'transactionId': '1'}]
+    assert not AccountHistoryEntry.objects.filter(charged_back=True).exists()
@@ -0,0 +1,103 @@
+from datetime import datetime
+
+import pytest
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+import base_api
+from members import directory
+from members.models import MemberIndex
+from members.views import MembersAPIView
+
+pytestmark = pytest.mark.django_db
+
+
+def member(member_id, firstname='', lastname='', societe='', statut=1, datem=None, login=None):
+    return {
+        'id': str(member_id), 'login': login or 'E{:05d}'.format(member_id), 'email': '', 'statut': str(statut),
+        'firstname': firstname, 'lastname': lastname, 'societe': societe,
+        'datem': datem or int(datetime(2020, 1, 1).timestamp()),
+    }
+
+
+def sqlfilter(members, sqlfilters):
+    """
+    Seul le filtre "tms >= '...'" est compris, les autres filtres sont des recherches de "Etxe" dans le nom.
+    """
+    if sqlfilters.startswith('tms'):
+        since = datetime.strptime(sqlfilters.split("'")[1], '%Y-%m-%d %H:%M:%S').timestamp()
+        return [m for m in members if m['datem'] >= since]
+    return [m for m in members if 'Etxe' in m['lastname']]
+
+
+def test_trigrams():
+    assert directory.trigrams('etxe ab') == {'etx', 'txe'}
+
+
+def test_search_by_name():
+    for m in [member(1, 'Maite', 'Etxeberria'), member(2, 'Jon', 'Goikoetxea'), member(3, societe='Etxe Café'),
+              member(4, 'Peio', 'Etxeberria', statut=0), member(5, 'Ana', 'Etxart')]:
+        directory.index_member(m)
+
+    # Sans tenir compte des accents ni des majuscules, les noms qui commencent par le texte en premier.
+    assert [m['id'] for m in directory.search_by_name('ETXÉ')] == ['3', '1', '2']
+    assert [m['id'] for m in directory.search_by_name('cafe')] == ['3']
+    # Tous les trigrammes doivent être présents.
+    assert directory.search_by_name('etxeberria jon') == []
+    assert [m['id'] for m in directory.search_by_name('etxa')] == ['5']
+
+
+def test_incremental_sync(fake_dolibarr):
+    members = [member(i, 'Maite', 'Etxeberria', datem=int(datetime(2020, 1, i).timestamp())) for i in range(1, 6)]
+    dolibarr = fake_dolibarr(members, sqlfilter)
+    assert directory.sync_member_index(dolibarr) == 5
+    assert dolibarr.queries == [None]
+
+    # Seuls les adhérents modifiés depuis la dernière synchronisation (moins MEMBER_INDEX_OVERLAP) sont redemandés.
+    members[0].update(lastname='Goikoetxea', datem=int(datetime(2020, 2, 1).timestamp()))
+    dolibarr.queries = []
+    # Le dernier adhérent recopié est redemandé, car il est dans la période MEMBER_INDEX_OVERLAP.
+    assert directory.sync_member_index(dolibarr) == 2
+    assert dolibarr.queries[0].startswith("tms >= '2020-01-04")
+    assert [m['id'] for m in directory.search_by_name('goiko')] == ['1']
+
+    # Une synchronisation complète retire les adhérents supprimés dans Dolibarr.
+    del members[4]
+    assert directory.sync_member_index(dolibarr, full=True) == 4
+    assert MemberIndex.objects.count() == 4
+
+
+def search_members(monkeypatch, user, name, dolibarr):
+    monkeypatch.setattr(base_api, 'DolibarrAPI', lambda **kwargs: dolibarr)
+    request = APIRequestFactory().get('/members/', {'name': name})
+    force_authenticate(request, user=user)
+    return MembersAPIView.as_view({'get': 'list'})(request)
+
+
+def test_name_search_falls_back_to_dolibarr(cyclos_groups, user_in_group, fake_dolibarr, monkeypatch):
+    directory.index_member(member(1, 'Maite', 'Etxeberria'))
+    user = user_in_group('operateurs_bdc')
+
+    dolibarr = fake_dolibarr([], sqlfilter)
+    assert [m['id'] for m in search_members(monkeypatch, user, 'etxeberria', dolibarr).data] == ['1']
+    assert dolibarr.queries == []
+
+    # L'adhérent a été créé dans Dolibarr depuis la dernière synchronisation de l'index.
+    dolibarr = fake_dolibarr([member(2, 'Jon', 'Etxeto')], sqlfilter)
+    assert [m['id'] for m in search_members(monkeypatch, user, 'etxeto', dolibarr).data] == ['2']
+
+
+def test_other_users_search_in_dolibarr(cyclos_groups, user_in_group, fake_dolibarr, monkeypatch):
+    directory.index_member(member(1, 'Maite', 'Etxeberria'))
+
+    # L'index ne tient pas compte des droits Dolibarr : un adhérent cherche avec les siens.
+    dolibarr = fake_dolibarr([], sqlfilter)
+    response = search_members(monkeypatch, user_in_group('adherents_utilisateurs'), 'etxeberria', dolibarr)
+    assert response.status_code == 204
+    assert len(dolibarr.queries) == 1
+
+
+def test_name_search_returns_at_most_search_limit_members(monkeypatch):
+    monkeypatch.setattr(directory, 'SEARCH_LIMIT', 2)
+    for i, lastname in enumerate(['Etxeberria', 'Etxart', 'Etxeto'], 1):
+        directory.index_member(member(i, 'Maite', lastname))
+    assert [m['lastname'] for m in directory.search_by_name('etx')] == ['Etxart', 'Etxeberria']
@@ -0,0 +1,103 @@
+from datetime import timedelta
+
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.utils import timezone
+import pytest
+
+from outbox import mailer
+from outbox.models import OutgoingEmail
+
+pytestmark = pytest.mark.django_db
+
+
+class FailingBackend(EmailBackend):
+    """
+    Refuse les emails adressés à "refuse@...", envoie les autres dans mail.outbox.
+    """
+
+    def send_messages(self, messages):
+        if any(to.startswith('refuse@') for message in messages for to in message.to):
+            raise OSError('Connexion refusée')
+        return super().send_messages(messages)
+
+
+@pytest.fixture(autouse=True)
+def outbox_settings(settings):
+    settings.EMAIL_BACKEND = 'tests.test_outbox.FailingBackend'
+    settings.EMAIL_NOTIFICATION_GESTION = 'gestion@example.org'
+    settings.OUTBOX_MAX_ATTEMPTS = 3
+    settings.OUTBOX_RETRY_DELAY = 60
+
+
+def enqueue(to_email, html_message=''):
+    return mailer.enqueue('Sujet', 'Texte', to_email=to_email, from_email='api@example.org',
+                          html_message=html_message)
+
+
+def make_due(email):
+    OutgoingEmail.objects.filter(pk=email.pk).update(next_attempt_at=timezone.now())
+
+
+def test_an_email_is_claimed_by_a_single_batch():
+    emails = [enqueue('adherent{}@example.org'.format(i)) for i in range(3)]
+    first = mailer.claim_batch(2)
+    second = mailer.claim_batch(2)
+    assert [email.pk for email in first] == [email.pk for email in emails[:2]]
+    assert [email.pk for email in second] == [emails[2].pk]
+    assert first[0].claim_id != second[0].claim_id
+    assert mailer.claim_batch(2) == []
+
+    # Le worker qui avait pris le lot a été arrêté : le lot est repris après CLAIM_TIMEOUT.
+    OutgoingEmail.objects.filter(pk=emails[0].pk).update(
+        next_attempt_at=timezone.now() - timedelta(seconds=1))
+    assert [email.pk for email in mailer.claim_batch(2)] == [emails[0].pk]
+
+
+def test_emails_are_sent_in_one_batch():
+    for i in range(3):
+        enqueue('adherent{}@example.org'.format(i))
+    assert mailer.send_pending() == 3
+    assert len(mail.outbox) == 3
+    assert not OutgoingEmail.objects.exclude(statut=OutgoingEmail.ENVOYE).exists()
+
+
+def test_failed_email_is_sent_again_later_then_given_up():
+    email = enqueue('refuse@example.org')
+    enqueue('adherent@example.org')
+    assert mailer.send_pending() == 1
+
+    # Le délai double à chaque tentative.
+    for attempts, delay in ((1, 60), (2, 120)):
+        email.refresh_from_db()
+        assert (email.statut, email.attempts, email.error) == (OutgoingEmail.EN_ATTENTE, attempts, 'Connexion refusée')
+        expected = timezone.now() + timedelta(seconds=delay)
+        assert expected - timedelta(seconds=5) <= email.next_attempt_at <= expected
+        assert mailer.send_pending() == 0
+        make_due(email)
+        mailer.send_pending()
+
+    email.refresh_from_db()
+    assert (email.statut, email.attempts) == (OutgoingEmail.ERREUR, 3)
+    # Un email texte en erreur ne prévient pas la gestion.
+    assert not OutgoingEmail.objects.filter(to_email='gestion@example.org').exists()
+
+
+def test_gestion_is_told_about_html_emails_in_error(settings):
+    settings.OUTBOX_MAX_ATTEMPTS = 1
+    enqueue('refuse@example.org', html_message='<p>Votre <b>virement</b></p>')
+    mailer.send_pending()
+
+    notification = OutgoingEmail.objects.get(to_email='gestion@example.org')
+    assert notification.subject == 'Erreur envoi mail : api@example.org'
+    assert notification.body == 'Votre virement'
+    assert notification.statut == OutgoingEmail.ENVOYE
+    assert mail.outbox[0].to == ['gestion@example.org']
+
+
+def test_gestion_is_not_told_about_its_own_emails_in_error(settings):
+    settings.OUTBOX_MAX_ATTEMPTS = 1
+    settings.EMAIL_NOTIFICATION_GESTION = 'refuse@example.org'
+    enqueue('refuse@example.org', html_message='<p>Erreur</p>')
+    mailer.send_pending()
+    assert OutgoingEmail.objects.count() == 1
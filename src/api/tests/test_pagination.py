@@ -0,0 +1,96 @@
+import pytest
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from pagination import DolibarrPagination
+
+
+@pytest.fixture
+def dolibarr_with(fake_dolibarr):
+    """
+    Dolibarr avec `count` objets.
+    """
+    return lambda count: fake_dolibarr([{'id': str(i)} for i in range(count)])
+
+
+def paginate(dolibarr, query, api_key='key'):
+    paginator = DolibarrPagination()
+    request = Request(APIRequestFactory().get('/members/', query))
+    objects = paginator.paginate_dolibarr(dolibarr, request, model='members', api_key=api_key)
+    return paginator, objects
+
+
+@pytest.mark.parametrize('count', [0, 1, 9, 10, 11, 25, 99, 100, 101, 1234])
+def test_pages_are_contiguous(count, dolibarr_with):
+    dolibarr = dolibarr_with(count)
+    ids = []
+    page = 1
+    while True:
+        paginator, objects = paginate(dolibarr, {'page': page, 'page_size': 10})
+        ids.extend(obj['id'] for obj in objects)
+        if not paginator.has_next:
+            assert paginator.count == count
+            break
+        # Le total n'est connu qu'une fois la dernière page atteinte.
+        assert paginator.count is None
+        assert paginator.get_next_link() == '?page={}&page_size=10'.format(page + 1)
+        page += 1
+    assert ids == [str(i) for i in range(count)]
+
+
+def test_page_is_fetched_at_its_offset(dolibarr_with):
+    dolibarr = dolibarr_with(100)
+    paginator, objects = paginate(dolibarr, {'page': 3, 'page_size': 10})
+    assert dolibarr.calls[0] == (10, 2)
+    assert [obj['id'] for obj in objects] == [str(i) for i in range(20, 30)]
+    assert paginator.get_previous_link() == '?page=2&page_size=10'
+
+
+def test_last_page_needs_no_count_request(dolibarr_with):
+    dolibarr = dolibarr_with(25)
+    paginator, objects = paginate(dolibarr, {'page': 3, 'page_size': 10})
+    assert len(dolibarr.calls) == 1
+    assert paginator.count == 25
+    assert not paginator.has_next
+
+
+def test_page_after_the_last_one(dolibarr_with):
+    dolibarr = dolibarr_with(25)
+    paginator, objects = paginate(dolibarr, {'page': 5, 'page_size': 10})
+    assert objects == []
+    assert paginator.count is None
+    assert not paginator.has_next
+
+    paginate(dolibarr, {'page': 3, 'page_size': 10})
+    paginator, objects = paginate(dolibarr, {'page': 5, 'page_size': 10})
+    assert paginator.count == 25
+
+
+def test_full_page_needs_a_single_extra_request(dolibarr_with):
+    dolibarr = dolibarr_with(1000)
+    paginator, objects = paginate(dolibarr, {'page': 2, 'page_size': 10})
+    # La page, puis le premier objet de la page suivante.
+    assert dolibarr.calls == [(10, 1), (1, 20)]
+    assert paginator.has_next
+
+
+def test_count_is_known_once_the_last_page_was_fetched(dolibarr_with):
+    dolibarr = dolibarr_with(25)
+    paginate(dolibarr, {'page': 3, 'page_size': 10})
+    paginator, objects = paginate(dolibarr, {'page': 1, 'page_size': 10})
+    assert paginator.count == 25
+
+    # Le total est propre à chaque utilisateur : ses droits dans Dolibarr ne sont pas forcément les mêmes.
+    paginator, objects = paginate(dolibarr, {'page': 1, 'page_size': 10}, api_key='other-key')
+    assert paginator.count is None
+
+    # Des objets ont été ajoutés : le total mémorisé n'est plus cohérent avec la page.
+    dolibarr.objects.extend({'id': str(i)} for i in range(25, 40))
+    paginator, objects = paginate(dolibarr, {'page': 3, 'page_size': 10})
+    assert paginator.count is None
+    paginator, objects = paginate(dolibarr, {'page': 4, 'page_size': 10})
+    assert paginator.count == 40
+    dolibarr.objects = dolibarr.objects[:5]
+    paginator, objects = paginate(dolibarr, {'page': 2, 'page_size': 10})
+    assert objects == []
+    assert paginator.count is None
@@ -0,0 +1,139 @@
+from datetime import date
+import threading
+
+from django.core.cache import cache
+from django.utils import timezone
+import pytest
+
+from cyclos_api import CyclosAPIException
+from gestioninterne import credits_comptes_prelevements_auto as credits
+from gestioninterne.models import Echeance
+
+pytestmark = pytest.mark.django_db(transaction=True)
+
+
+CYCLOS_CONSTANTS = {
+    'groups': {'adherents_prestataires': 1, 'adherents_prestataires_avec_paiement_smartphone': 2,
+               'adherents_utilisateurs': 3},
+    'payment_types': {'change_numerique_en_ligne_versement_des_euro': 10,
+                      'change_numerique_en_ligne_versement_des_eusko': 11},
+    'currencies': {'euro': 20, 'eusko': 21},
+    'users': {'compte_dedie_eusko_numerique': 30},
+    'transaction_custom_fields': {'numero_de_transaction_banque': 40},
+}
+
+
+class FakeCyclos:
+
+    def __init__(self, failing_eusko_payments=(), lost_eusko_payments=()):
+        self.failing_eusko_payments = set(failing_eusko_payments)
+        # Paiements faits, mais dont la réponse de Cyclos est perdue.
+        self.lost_eusko_payments = set(lost_eusko_payments)
+        self.payments = []
+        self.lock = threading.Lock()
+
+    def get_member_id_from_login(self, member_login):
+        return 'cyclos-{}'.format(member_login)
+
+    def post(self, method, data):
+        if method == 'user/load':
+            return {'result': {'group': {'id': '3'}}}
+        ref = data['customValues'][0]['stringValue']
+        currency = 'euro' if data['currency'] == '20' else 'eusko'
+        if currency == 'eusko' and ref in self.failing_eusko_payments:
+            raise CyclosAPIException(detail='Paiement refusé')
+        with self.lock:
+            self.payments.append((ref, currency))
+            if currency == 'eusko' and ref in self.lost_eusko_payments:
+                raise ConnectionError('Pas de réponse')
+            return {'result': {'id': '{}-{}'.format(currency, len(self.payments))}}
+
+
+@pytest.fixture(autouse=True)
+def cyclos_constants(settings):
+    settings.CYCLOS_CONSTANTS = CYCLOS_CONSTANTS
+
+
+def create_echeances(count, **kwargs):
+    Echeance.objects.bulk_create([
+        Echeance(ref='REF{}'.format(i), adherent_name='Adhérent', adherent_id='E{:05d}'.format(i), montant=10,
+                 date=date(2020, 1, 5), **kwargs)
+        for i in range(count)
+    ])
+    return ['REF{}'.format(i) for i in range(count)]
+
+
+def test_each_echeance_is_paid_once_and_saved():
+    refs = create_echeances(5)
+    cyclos = FakeCyclos(failing_eusko_payments=['REF2'])
+    execution_id = credits.perform_echeances(cyclos, refs + refs, max_workers=3)
+
+    assert sorted(cyclos.payments) == sorted([(ref, 'euro') for ref in refs] +
+                                             [(ref, 'eusko') for ref in refs if ref != 'REF2'])
+    assert cache.get(credits._progress_cache_key(execution_id)) == {
+        'execution_id': execution_id, 'total': 5, 'done': 5, 'errors': 1, 'running': False}
+
+    failed = Echeance.objects.get(ref='REF2')
+    assert failed.cyclos_payment_id == ''
+    assert failed.cyclos_euro_payment_id != ''
+    assert failed.cyclos_error == 'Paiement refusé'
+    assert failed.execution_id == ''
+    assert Echeance.objects.exclude(ref='REF2').filter(cyclos_payment_id='').count() == 0
+
+    # Une nouvelle exécution ne refait que le paiement en eusko de l'échéance en erreur.
+    cyclos = FakeCyclos()
+    credits.perform_echeances(cyclos, refs, max_workers=3)
+    assert cyclos.payments == [('REF2', 'eusko')]
+
+
+def test_claim_of_an_interrupted_execution_is_taken_over():
+    refs = create_echeances(2)
+    # REF0 est réservée par une exécution en cours, REF1 par une exécution arrêtée depuis longtemps.
+    Echeance.objects.filter(ref='REF0').update(execution_id='running', claimed_at=timezone.now())
+    Echeance.objects.filter(ref='REF1').update(
+        execution_id='stopped', claimed_at=timezone.now() - credits.CLAIM_TIMEOUT * 2)
+
+    cyclos = FakeCyclos()
+    credits.perform_echeances(cyclos, refs, max_workers=1)
+    assert sorted(cyclos.payments) == [('REF1', 'euro'), ('REF1', 'eusko')]
+    assert Echeance.objects.get(ref='REF0').execution_id == 'running'
+
+
+def test_progress_of_concurrent_executions_are_kept_apart():
+    refs = create_echeances(3)
+    first = credits.perform_echeances(FakeCyclos(), refs[:1], max_workers=1)
+    second = credits.perform_echeances(FakeCyclos(), refs[1:], max_workers=1)
+    assert cache.get(credits._progress_cache_key(first))['total'] == 1
+    assert cache.get(credits._progress_cache_key(second))['total'] == 2
+
+
+def test_payment_without_answer_is_never_made_again():
+    refs = create_echeances(2)
+    cyclos = FakeCyclos(lost_eusko_payments=['REF1'])
+    credits.perform_echeances(cyclos, refs, max_workers=1)
+
+    uncertain = Echeance.objects.get(ref='REF1')
+    assert uncertain.cyclos_payment_id == ''
+    assert uncertain.payment_started_at is not None
+    assert uncertain.cyclos_error.startswith('Paiement peut-être fait')
+    assert list(Echeance.objects.exclude(cyclos_error='').values_list('ref', flat=True)) == ['REF1']
+
+    # Ni une nouvelle exécution, ni la reprise après CLAIM_TIMEOUT ne refont le paiement.
+    cyclos = FakeCyclos()
+    credits.perform_echeances(cyclos, refs, max_workers=1)
+    Echeance.objects.filter(ref='REF1').update(claimed_at=timezone.now() - credits.CLAIM_TIMEOUT * 2)
+    credits.perform_echeances(cyclos, refs, max_workers=1)
+    assert cyclos.payments == []
+
+
+def test_claim_of_an_execution_stopped_during_a_payment_is_not_taken_over():
+    refs = create_echeances(1)
+    Echeance.objects.filter(ref='REF0').update(execution_id='stopped', payment_started_at=timezone.now(),
+                                               claimed_at=timezone.now() - credits.CLAIM_TIMEOUT * 2)
+
+    cyclos = FakeCyclos()
+    credits.perform_echeances(cyclos, refs, max_workers=1)
+    assert cyclos.payments == []
+    echeance = Echeance.objects.get(ref='REF0')
+    assert echeance.execution_id == 'stopped'
+    assert echeance.cyclos_error.startswith('Paiement peut-être fait')
@@ -0,0 +1,37 @@
+from datetime import date
+
+from django.contrib.auth.models import User
+import pytest
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from gestioninterne import report_jobs
+from gestioninterne.models import ReportJob
+
+pytestmark = [pytest.mark.django_db, pytest.mark.usefixtures('cyclos_groups')]
+
+
+def submit(user):
+    request = APIRequestFactory().post('/report-jobs/', {'report': ReportJob.CALCULATE_3_PERCENT,
+                                                         'begin': '2020-01-01', 'end': '2020-01-31'}, format='json')
+    force_authenticate(request, user=user)
+    return report_jobs.submit(request)
+
+
+def test_gi_users_can_ask_for_reports(user_in_group):
+    response = submit(user_in_group('gestion_interne'))
+    assert response.status_code == 202
+    assert ReportJob.objects.count() == 1
+
+
+def test_other_users_cannot_ask_for_reports_or_read_them(user_in_group):
+    response = submit(user_in_group('adherents_utilisateurs'))
+    assert response.status_code == 403
+    assert not ReportJob.objects.exists()
+
+    job = ReportJob.objects.create(user=user_in_group('gestion_interne'), report=ReportJob.CALCULATE_3_PERCENT,
+                                   begin=date(2020, 1, 1), end=date(2020, 1, 31), statut=ReportJob.TERMINE,
+                                   result='{}')
+    for view in (report_jobs.detail, report_jobs.result):
+        request = APIRequestFactory().get('/report-jobs/{}/'.format(job.pk))
+        force_authenticate(request, user=User.objects.get(username='adherents_utilisateurs'))
+        assert view(request, pk=job.pk).status_code == 403
@@ -0,0 +1,111 @@
+import json
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+import pytest
+import requests
+
+from cel.views import create_cyclos_user
+import cyclos_api
+import dolibarr_api
+import service_sessions
+
+
+def response(status_code, data):
+    r = requests.models.Response()
+    r.status_code = status_code
+    r._content = json.dumps(data).encode('utf-8')
+    r.url = 'http://backend/'
+    r.request = requests.Request('POST', r.url).prepare()
+    return r
+
+
+class FakeSession:
+    """
+    Backend qui n'accepte que le token `valid`, passé dans l'en-tête Session-Token (Cyclos) ou dans l'URL (Dolibarr).
+    """
+
+    def __init__(self, rejected):
+        self.rejected = rejected
+        self.tokens = []
+
+    def request(self, http_method, url, headers=None, **kwargs):
+        token = (headers or {}).get('Session-Token') or url.split('api_key=')[-1].split('&')[0]
+        self.tokens.append(token)
+        if token == 'valid':
+            return response(200, {'result': 'ok'})
+        return self.rejected
+
+
+@pytest.mark.parametrize('status_code', [401, 500])
+def test_cyclos_session_is_renewed_when_logged_out(monkeypatch, status_code):
+    session = FakeSession(response(status_code, {'errorCode': 'LOGGED_OUT'}))
+    monkeypatch.setattr(cyclos_api, 'get_session', lambda *args: session)
+    monkeypatch.setattr(service_sessions, '_login_cyclos', lambda account: 'valid')
+    cache.set(service_sessions.CYCLOS_CACHE_KEY, 'expired')
+
+    cyclos = service_sessions.anonymous_cyclos()
+    assert cyclos.post(method='user/getCurrentUser', data=[]) == {'result': 'ok'}
+    assert session.tokens == ['expired', 'valid']
+    assert cache.get(service_sessions.CYCLOS_CACHE_KEY) == 'valid'
+
+
+def test_cyclos_other_errors_are_not_retried(monkeypatch):
+    session = FakeSession(response(500, {'errorCode': 'PERMISSION_DENIED'}))
+    monkeypatch.setattr(cyclos_api, 'get_session', lambda *args: session)
+    monkeypatch.setattr(service_sessions, '_login_cyclos', lambda account: 'valid')
+    cache.set(service_sessions.CYCLOS_CACHE_KEY, 'other')
+
+    with pytest.raises(cyclos_api.CyclosAPIException):
+        service_sessions.anonymous_cyclos().post(method='user/getCurrentUser', data=[])
+    assert session.tokens == ['other']
+
+
+def test_dolibarr_key_is_renewed_when_rejected(monkeypatch):
+    session = FakeSession(response(401, {'error': {'code': 401}}))
+    monkeypatch.setattr(dolibarr_api, 'get_session', lambda *args: session)
+    monkeypatch.setattr(service_sessions, '_login_dolibarr', lambda account: 'valid')
+    cache.set(service_sessions.DOLIBARR_CACHE_KEY, 'expired')
+
+    assert service_sessions.anonymous_dolibarr().get(model='members') == {'result': 'ok'}
+    assert session.tokens == ['expired', 'valid']
+
+
+def test_gi_session_is_kept_apart(monkeypatch, settings):
+    settings.GI_SERVICE_LOGIN = 'gi'
+    monkeypatch.setattr(service_sessions, '_login_cyclos', lambda account: 'token-{}'.format(account))
+    assert service_sessions.anonymous_cyclos().token == 'token-anonymous'
+    assert service_sessions.gi_cyclos().token == 'token-gi'
+    assert service_sessions.anonymous_cyclos().token == 'token-anonymous'
+
+
+def test_gi_session_must_be_configured(settings):
+    settings.GI_SERVICE_LOGIN = ''
+    with pytest.raises(ImproperlyConfigured):
+        service_sessions.gi_dolibarr()
+
+
+def test_cyclos_user_is_created_with_a_renewed_session(monkeypatch, settings):
+    settings.CYCLOS_CONSTANTS = {'groups': {'adherents_utilisateurs': 1}}
+    results = {
+        'user/search': {'totalCount': 0},
+        'user/register': {'user': {'id': 'U1'}},
+        'token/save': 'QR1',
+    }
+
+    class CyclosSession(FakeSession):
+        def request(self, http_method, url, headers=None, **kwargs):
+            r = super().request(http_method, url, headers=headers, **kwargs)
+            if r.status_code == 200:
+                return response(200, {'result': results.get(url.replace(settings.CYCLOS_URL + '/', ''))})
+            return r
+
+    session = CyclosSession(response(500, {'errorCode': 'LOGGED_OUT'}))
+    monkeypatch.setattr(cyclos_api, 'get_session', lambda *args: session)
+    monkeypatch.setattr(service_sessions, '_login_cyclos', lambda account: 'valid')
+    cache.set(service_sessions.CYCLOS_CACHE_KEY, 'expired')
+
+    assert create_cyclos_user(service_sessions.anonymous_cyclos(), 'adherents_utilisateurs', 'Nom', 'E00001',
+                              password='secret', pin_code='1234') == 'U1'
+    # Seule la première requête est faite avec la session expirée.
+    assert session.tokens == ['expired'] + ['valid'] * 7
@@ -0,0 +1,33 @@
+from datetime import date
+
+from django.contrib.auth.models import User
+import pytest
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from gestioninterne import statements
+from gestioninterne.models import StatementRun
+
+pytestmark = [pytest.mark.django_db, pytest.mark.usefixtures('cyclos_groups')]
+
+
+def submit(user):
+    request = APIRequestFactory().post('/statements/', {'month': '2020-01'}, format='json')
+    force_authenticate(request, user=user)
+    return statements.submit(request)
+
+
+def test_gi_users_can_ask_for_statements(user_in_group):
+    assert submit(user_in_group('gestion_interne')).status_code == 202
+    assert StatementRun.objects.count() == 1
+
+
+def test_other_users_cannot_ask_for_statements_or_read_them(user_in_group):
+    assert submit(user_in_group('adherents_utilisateurs')).status_code == 403
+    assert not StatementRun.objects.exists()
+
+    run = StatementRun.objects.create(user=user_in_group('gestion_interne'), month=date(2020, 1, 1),
+                                      statut=StatementRun.TERMINE)
+    for view in (statements.detail, statements.manifest):
+        request = APIRequestFactory().get('/statements/{}/'.format(run.pk))
+        force_authenticate(request, user=User.objects.get(username='adherents_utilisateurs'))
+        assert view(request, pk=run.pk).status_code == 403
@@ -16,6 +16,8 @@ import dolibarr_data.views as dolibarr_data_views
 import euskalmoneta_data.views as euskalmoneta_data_views
 import gestioninterne.views as gi_views
 import gestioninterne.credits_comptes_prelevements_auto as credits_views
+import gestioninterne.report_jobs as report_jobs_views
+import gestioninterne.statements as statements_views
 
 
 router = routers.SimpleRouter()
@@ -86,6 +88,12 @@ urlpatterns = [
     url(r'^validate-reconversions/$', gi_views.validate_reconversions),
     url(r'^calculate-3-percent/$', gi_views.calculate_3_percent),
     url(r'^export-vers-odoo/$', gi_views.export_vers_odoo),
+    url(r'^report-jobs/$', report_jobs_views.submit),
+    url(r'^report-jobs/(?P<pk>[0-9]+)/$', report_jobs_views.detail),
+    url(r'^report-jobs/(?P<pk>[0-9]+)/result/$', report_jobs_views.result),
+    url(r'^statements/$', statements_views.submit),
+    url(r'^statements/(?P<pk>[0-9]+)/$', statements_views.detail),
+    url(r'^statements/(?P<pk>[0-9]+)/manifest/$', statements_views.manifest),
     url(r'^change-par-virement/$', gi_views.execute_changes_par_virement),
     url(r'^paiement-cotisation-eusko-numerique/$', gi_views.paiement_cotisation_eusko_numerique),
     url(r'^resilier-adherent/$', gi_views.resiliation_adherent),
@@ -93,8 +101,9 @@ urlpatterns = [
     # Crédit des comptes Eusko par prélèvement automatique
     url(r'^credits-comptes-prelevement-auto/import/(?P<filename>[^/]+)$', credits_views.import_csv),
     url(r'^credits-comptes-prelevement-auto/perform/$', credits_views.perform),
+    url(r'^credits-comptes-prelevement-auto/perform/progress/$', credits_views.perform_progress),
     url(r'^credits-comptes-prelevement-auto/delete/$', credits_views.delete),
-    url(r'^credits-comptes-prelevement-auto/list/(?P<mode>[^/]+)$', credits_views.list),
+    url(r'^credits-comptes-prelevement-auto/list/(?P<mode>[^/]+)$', credits_views.list_echeances),
 
     # Endpoints for Compte en Ligne
     url(r'^first-connection/$', cel_views.first_connection),